@@ -0,0 +1,537 @@
+import fnmatch
+import io
+import os
+import queue
+import shutil
+import struct
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import py7zr
+import rarfile
+from py7zr.io import Py7zIO, WriterFactory
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ExtractionLimitExceeded(ValueError):
+    pass
+
+
+# Limits on what an archive may expand to, checked against the headers before
+# a member is extracted and against the bytes actually written while it is
+class ExtractionBudget:
+    def __init__(self, max_bytes, max_entries, max_ratio):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_ratio = max_ratio
+        self.entries = 0
+        self.declared_bytes = 0
+        self.bytes_written = 0
+
+    def check_entry(self, name, file_size, compress_size):
+        self.entries += 1
+        self.declared_bytes += file_size
+        if self.entries > self.max_entries:
+            raise ExtractionLimitExceeded(f"The archive has more than {self.max_entries} files.")
+        if self.declared_bytes > self.max_bytes:
+            raise ExtractionLimitExceeded(f"The archive expands to more than {self.max_bytes // (1024 * 1024)} MB.")
+        if compress_size and file_size / compress_size > self.max_ratio:
+            raise ExtractionLimitExceeded(f"'{name}' has a suspicious compression ratio.")
+
+    def add_bytes(self, count):
+        self.bytes_written += count
+        if self.bytes_written > self.max_bytes:
+            raise ExtractionLimitExceeded(f"The archive expands to more than {self.max_bytes // (1024 * 1024)} MB.")
+
+
+# Relative path of a member inside the destination, or None for names that
+# would escape it (absolute paths, '..' components)
+def safe_member_path(name):
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts:
+        return None
+    return os.path.join(*parts)
+
+
+# Copy a member stream to disk in chunks, counting the bytes against the budget
+def copy_member(source, target_path, budget):
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    with open(target_path, 'wb') as target:
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            budget.add_bytes(len(chunk))
+            target.write(chunk)
+
+
+# The functions below extract one member at a time and yield
+# (relative path, extracted path) as soon as each member is on disk.
+# The caller owns the extracted file and may delete it right away.
+# With `selected`, a set of member names, only those members are extracted.
+
+# Function to handle unzip operation
+def unzip_file(file_path, destination_dir, budget, selected=None):
+    try:
+        with zipfile.ZipFile(file_path, 'r') as zip_ref:
+            for info in zip_ref.infolist():
+                relative_path = safe_member_path(info.filename)
+                if info.is_dir() or relative_path is None or (selected is not None and info.filename not in selected):
+                    continue
+                budget.check_entry(info.filename, info.file_size, info.compress_size)
+                target_path = os.path.join(destination_dir, relative_path)
+                with zip_ref.open(info) as source:
+                    copy_member(source, target_path, budget)
+                yield relative_path, target_path
+    except zipfile.BadZipFile:
+        raise ValueError("The provided ZIP file is corrupted.")
+
+
+# Function to handle unrar operation
+def unrar_file(file_path, destination_dir, budget, selected=None):
+    try:
+        with rarfile.RarFile(file_path, 'r') as rar_ref:
+            for info in rar_ref.infolist():
+                relative_path = safe_member_path(info.filename)
+                if info.is_dir() or relative_path is None or (selected is not None and info.filename not in selected):
+                    continue
+                budget.check_entry(info.filename, info.file_size, info.compress_size)
+                target_path = os.path.join(destination_dir, relative_path)
+                with rar_ref.open(info) as source:
+                    copy_member(source, target_path, budget)
+                yield relative_path, target_path
+    except rarfile.BadRarFile:
+        raise ValueError("The provided RAR file is corrupted.")
+
+
+# Writes one 7z member to disk and hands it to the consumer once py7zr closes it
+class MemberWriter(Py7zIO):
+    def __init__(self, factory, relative_path):
+        self.factory = factory
+        self.relative_path = relative_path
+        self.target_path = None
+        self.file = None
+        if relative_path is not None:
+            self.target_path = os.path.join(factory.destination_dir, relative_path)
+            os.makedirs(os.path.dirname(self.target_path), exist_ok=True)
+            self.file = open(self.target_path, 'wb')
+
+    def write(self, s):
+        if self.factory.cancelled.is_set():
+            raise ExtractionLimitExceeded("Extraction cancelled.")
+        if self.file is None:
+            return len(s)
+        self.factory.budget.add_bytes(len(s))
+        return self.file.write(s)
+
+    def read(self, size=None):
+        return b''
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence) if self.file else 0
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+
+    def size(self):
+        return self.file.tell() if self.file else 0
+
+    def close(self):
+        if self.file and not self.file.closed:
+            self.file.close()
+            self.factory.put((self.relative_path, self.target_path))
+
+
+class MemberWriterFactory(WriterFactory):
+    def __init__(self, destination_dir, budget):
+        self.destination_dir = destination_dir
+        self.budget = budget
+        # A small queue lets extraction run only slightly ahead of the uploads
+        self.members = queue.Queue(maxsize=2)
+        self.cancelled = threading.Event()
+
+    def create(self, filename):
+        return MemberWriter(self, safe_member_path(filename))
+
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.members.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+
+# Function to handle un7z operation.
+# py7zr pushes members to a writer instead of letting us pull them, so the
+# archive is decompressed on a helper thread and members are handed over
+# through a bounded queue. In a solid archive the data before a selected
+# member still has to be decompressed, but it isn't written anywhere.
+def un7z_file(file_path, destination_dir, budget, selected=None):
+    try:
+        with py7zr.SevenZipFile(file_path, mode='r') as archive:
+            targets = []
+            for info in archive.list():
+                if info.is_directory or safe_member_path(info.filename) is None:
+                    continue
+                if selected is not None and info.filename not in selected:
+                    continue
+                budget.check_entry(info.filename, info.uncompressed, info.compressed)
+                targets.append(info.filename)
+
+            factory = MemberWriterFactory(destination_dir, budget)
+            done = object()
+
+            def extract():
+                try:
+                    if selected is None:
+                        archive.extractall(factory=factory)
+                    else:
+                        archive.extract(targets=targets, factory=factory)
+                    factory.put(done)
+                except Exception as e:
+                    factory.put(e)
+
+            thread = threading.Thread(target=extract, daemon=True)
+            thread.start()
+            try:
+                while True:
+                    item = factory.members.get()
+                    if item is done:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                factory.cancelled.set()
+                thread.join()
+    except py7zr.exceptions.Bad7zFile:
+        raise ValueError("The provided 7z file is corrupted.")
+
+
+EXTRACTORS = {
+    '.zip': unzip_file,
+    '.rar': unrar_file,
+    '.7z': un7z_file,
+}
+
+
+# Extract an archive member by member, picking the extractor from the file name.
+# Files yielded last are still there when the loop ends, so they can be sent in
+# a batch; on errors or an early stop the destination is removed.
+def extract_members(file_path, archive_name, destination_dir, budget, selected=None):
+    extension = os.path.splitext(archive_name.lower())[1]
+    if extension not in EXTRACTORS:
+        raise ValueError("Unsupported archive format.")
+    os.makedirs(destination_dir, exist_ok=True)
+    try:
+        yield from EXTRACTORS[extension](file_path, destination_dir, budget, selected)
+    except BaseException:
+        shutil.rmtree(destination_dir, ignore_errors=True)
+        raise
+
+
+def is_archive(name):
+    return os.path.splitext((name or '').lower())[1] in EXTRACTORS
+
+
+# The files in an archive as [name, size] pairs, in archive order. Only the
+# headers are read (the zip central directory, the rar block headers, the 7z
+# header), nothing is decompressed.
+def list_members(file_path, archive_name):
+    extension = os.path.splitext(archive_name.lower())[1]
+    try:
+        if extension == '.zip':
+            with zipfile.ZipFile(file_path, 'r') as zip_ref:
+                members = [(info.filename, info.file_size, info.is_dir()) for info in zip_ref.infolist()]
+        elif extension == '.rar':
+            with rarfile.RarFile(file_path, 'r') as rar_ref:
+                members = [(info.filename, info.file_size, info.is_dir()) for info in rar_ref.infolist()]
+        elif extension == '.7z':
+            with py7zr.SevenZipFile(file_path, mode='r') as archive:
+                members = [(info.filename, info.uncompressed, info.is_directory) for info in archive.list()]
+        else:
+            raise ValueError("Unsupported archive format.")
+    except (zipfile.BadZipFile, rarfile.BadRarFile, py7zr.exceptions.Bad7zFile):
+        raise ValueError(f"The provided {extension[1:].upper()} file is corrupted.")
+    return [[name, size] for name, size, is_dir in members if not is_dir and safe_member_path(name) is not None]
+
+
+# Names of the listed members matching any of the glob patterns, e.g. '*.pdf'
+# or 'docs/*'. Matching ignores case, and a pattern without a '/' is also
+# tried against the file name alone, so 'report.pdf' finds 'docs/report.pdf'.
+def select_members(listing, patterns):
+    patterns = [pattern.lower() for pattern in patterns]
+    selected = set()
+    for name, _ in listing:
+        lowered = name.lower()
+        base_name = lowered.rsplit('/', 1)[-1]
+        if any(fnmatch.fnmatchcase(lowered, pattern) or ('/' not in pattern and fnmatch.fnmatchcase(base_name, pattern))
+               for pattern in patterns):
+            selected.add(name)
+    return selected
+
+
+# Formats that are compressed already: deflating them again costs CPU and saves nothing
+STORED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.heic', '.pdf',
+    '.zip', '.rar', '.7z', '.gz', '.tgz', '.bz2', '.xz', '.zst',
+    '.mp3', '.m4a', '.ogg', '.opus', '.mp4', '.mkv', '.webm', '.mov', '.avi',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.epub', '.apk', '.jar',
+}
+
+
+def is_compressed(name):
+    return os.path.splitext(name.lower())[1] in STORED_EXTENSIONS
+
+
+# A write-only file that cuts what is written into volumes of at most
+# `volume_size` bytes, the way 7-Zip splits archives: 'name.001', 'name.002'...
+# are plain pieces of one archive that 7-Zip opens directly (or `cat` joins).
+# Every volume is handed to on_volume(path) as soon as it is full, and may be
+# sent and removed right away, so only one volume is on disk at a time. A
+# single volume keeps the plain name.
+#
+# With hold_first, the first volume stays open until finish() for writers that
+# seek back to the start to fill in a header (py7zr); it is then handed over
+# after the later ones.
+class VolumeWriter(io.RawIOBase):
+    def __init__(self, base_path, volume_size, on_volume, hold_first=False):
+        self.base_path = base_path
+        self.volume_size = volume_size
+        self.on_volume = on_volume
+        self.hold_first = hold_first
+        self.files = {}  # Volume number -> open file
+        self.volume_count = 0
+        self.position = 0
+        self.size = 0
+
+    def volume_path(self, number):
+        return f"{self.base_path}.{number + 1:03d}"
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    # Only within volumes that haven't been handed over yet
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset != self.size and offset // self.volume_size not in self.files:
+            raise io.UnsupportedOperation("That part of the archive was already sent.")
+        self.position = offset
+        return offset
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        written = 0
+        while written < len(data):
+            number, offset = divmod(self.position, self.volume_size)
+            file = self.files.get(number)
+            if file is None:
+                file = self.open_volume(number)
+            file.seek(offset)
+            count = min(len(data) - written, self.volume_size - offset)
+            file.write(data[written:written + count])
+            written += count
+            self.position += count
+            self.size = max(self.size, self.position)
+        return written
+
+    def open_volume(self, number):
+        if number < self.volume_count:
+            raise io.UnsupportedOperation("That part of the archive was already sent.")
+        self.volume_count = number + 1
+        # Writing moved on to a new volume, so the previous ones are complete
+        for previous in sorted(self.files):
+            if not (self.hold_first and previous == 0):
+                self.hand_over(previous)
+        file = self.files[number] = open(self.volume_path(number), 'w+b')
+        return file
+
+    def hand_over(self, number):
+        self.files.pop(number).close()
+        path = self.volume_path(number)
+        if self.volume_count == 1:
+            os.replace(path, self.base_path)
+            path = self.base_path
+        self.on_volume(path)
+
+    # Hand over the volumes still open once the archive is complete
+    def finish(self):
+        for number in sorted(self.files):
+            self.hand_over(number)
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files.clear()
+        super().close()
+
+
+DEFLATE_BLOCK_SIZE = 1024 * 1024
+DEFLATE_WINDOW = 32 * 1024
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FLAGS = 0x0808  # Sizes and CRC in a data descriptor after the data, UTF-8 names
+
+
+# Deflate one block of a member as part of a single raw deflate stream, the way
+# pigz does: primed with the end of the previous block and ended on a byte
+# boundary with a sync flush, so the compressed blocks simply concatenate
+def deflate_block(data, dictionary, last, level):
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def dos_date_time(timestamp):
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return (1 << 5) | 1, 0
+    return (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday, t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+
+
+# Writes a zip archive front to back, never seeking, so it can go straight into
+# a VolumeWriter. Members with compressed formats are stored; the others are
+# deflated in 1 MB blocks on `threads` threads (zlib releases the GIL), with
+# at most two blocks per thread in memory.
+class ZipStreamWriter:
+    def __init__(self, output, threads=1, level=6):
+        self.output = output
+        self.threads = threads
+        self.level = level
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='deflate')
+        self.entries = []
+        self.offset = 0
+
+    def write(self, data):
+        self.output.write(data)
+        self.offset += len(data)
+
+    def add(self, path, name):
+        file_size = os.path.getsize(path)
+        method = zipfile.ZIP_STORED if is_compressed(name) else zipfile.ZIP_DEFLATED
+        zip64 = file_size * 1.01 + 1024 >= ZIP64_LIMIT  # Room for deflate growing incompressible data
+        date, dos_time = dos_date_time(os.path.getmtime(path))
+        encoded_name = name.encode('utf-8')
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        header_offset = self.offset
+        self.write(struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, ZIP_FLAGS, method, dos_time, date, 0,
+            ZIP64_LIMIT if zip64 else 0, ZIP64_LIMIT if zip64 else 0, len(encoded_name), len(extra)
+        ) + encoded_name + extra)
+
+        data_start = self.offset
+        with open(path, 'rb') as file:
+            if method == zipfile.ZIP_STORED:
+                crc, size = self.copy(file)
+            else:
+                crc, size = self.deflate(file)
+        compressed_size = self.offset - data_start
+        if zip64:
+            self.write(struct.pack('<IIQQ', 0x08074b50, crc, compressed_size, size))
+        else:
+            self.write(struct.pack('<IIII', 0x08074b50, crc, compressed_size, size))
+        self.entries.append((encoded_name, method, dos_time, date, crc, compressed_size, size, header_offset))
+
+    def copy(self, file):
+        crc = size = 0
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                return crc, size
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            self.write(chunk)
+
+    def deflate(self, file):
+        crc = size = 0
+        pending = deque()
+        dictionary = b''
+        block = file.read(DEFLATE_BLOCK_SIZE)
+        while True:
+            next_block = file.read(DEFLATE_BLOCK_SIZE) if block else b''
+            last = not next_block
+            pending.append(self.pool.submit(deflate_block, block, dictionary, last, self.level))
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            dictionary = block[-DEFLATE_WINDOW:]
+            while pending and (last or len(pending) >= 2 * self.threads):
+                self.write(pending.popleft().result())
+            if last:
+                return crc, size
+            block = next_block
+
+    # Write the central directory (with Zip64 records when the archive needs them)
+    def close(self):
+        self.pool.shutdown()
+        directory_offset = self.offset
+        for encoded_name, method, dos_time, date, crc, compressed_size, size, header_offset in self.entries:
+            zip64_fields = [value for value in (size, compressed_size, header_offset) if value >= ZIP64_LIMIT]
+            extra = struct.pack(f'<HH{len(zip64_fields)}Q', 1, 8 * len(zip64_fields), *zip64_fields) if zip64_fields else b''
+            version = 45 if zip64_fields else 20
+            self.write(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version, ZIP_FLAGS, method, dos_time, date,
+                crc, min(compressed_size, ZIP64_LIMIT), min(size, ZIP64_LIMIT), len(encoded_name), len(extra),
+                0, 0, 0, 0o100644 << 16, min(header_offset, ZIP64_LIMIT)
+            ) + encoded_name + extra)
+        directory_size = self.offset - directory_offset
+
+        count = len(self.entries)
+        if count >= 0xFFFF or directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT:
+            end_offset = self.offset
+            self.write(struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, directory_size, directory_offset
+            ))
+            self.write(struct.pack('<IIQI', 0x07064b50, 0, end_offset, 1))
+        self.write(struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+            min(directory_size, ZIP64_LIMIT), min(directory_offset, ZIP64_LIMIT), 0
+        ))
+
+
+SEVEN_ZIP_PRESET = 5
+
+
+# py7zr compresses everything as one solid LZMA2 stream on a single thread.
+# When every member is compressed already they are stored instead.
+class SevenZipWriter:
+    def __init__(self, output, names):
+        if all(is_compressed(name) for name in names):
+            filters = [{'id': py7zr.FILTER_COPY}]
+        else:
+            filters = [{'id': py7zr.FILTER_LZMA2, 'preset': SEVEN_ZIP_PRESET}]
+        self.archive = py7zr.SevenZipFile(output, mode='w', filters=filters)
+
+    def add(self, path, name):
+        self.archive.write(path, name)
+
+    def close(self):
+        self.archive.close()
+
+
+ARCHIVE_FORMATS = ('zip', '7z')
+
+
+# Writer for a new archive of `names` into `output`, with add(path, name) and close()
+def create_archive(archive_format, output, names, threads=1):
+    if archive_format == 'zip':
+        return ZipStreamWriter(output, threads)
+    if archive_format == '7z':
+        return SevenZipWriter(output, names)
+    raise ValueError("Unsupported archive format.")
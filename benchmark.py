@@ -0,0 +1,644 @@
+# Offline benchmark of the bot's command flows.
+#
+# Runs the bot against a local stand-in for the Telegram Bot API (getUpdates,
+# getFile, file downloads, sendMessage/sendDocument/...) and replays generated
+# PDFs, images and archives from several chats at once. For every command it
+# reports throughput, end-to-end latency percentiles and peak RSS of the bot
+# and its worker processes.
+#
+#   python benchmark.py --chats 8 --rounds 3
+#   python benchmark.py --commands mergepdf,pdf2image --json results.json
+#   python benchmark.py --startup 10   # cold start only
+import argparse
+import io
+import itertools
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import fitz
+from PIL import Image
+
+COMMANDS = ('mergepdf', 'splitpdf', 'pdf2image', 'compresspdf', 'image2pdf', 'resizeimage', 'batchresize', 'unarchive', 'archive', 'pdftext')
+
+# Replies that end a flow without a result
+FAILURE = re.compile(r'^(Error|An error occurred|Failed|Sorry|Invalid|Too many|Total file size|Maximum file)')
+
+
+# Generated input files
+def make_pdf(pages):
+    document = fitz.open()
+    for number in range(pages):
+        page = document.new_page()
+        page.insert_text((72, 72), f"Benchmark page {number + 1}", fontsize=24)
+        for line in range(40):
+            page.insert_text((72, 120 + line * 16), "The quick brown fox jumps over the lazy dog. " * 2, fontsize=9)
+        page.draw_rect(fitz.Rect(300, 60, 540, 100), color=(0, 0, 1), fill=(0.8, 0.8, 1))
+    data = document.tobytes(garbage=1, deflate=True)
+    document.close()
+    return data
+
+
+def make_image(width, height, image_format='JPEG'):
+    # A gradient with noise compresses like a photo rather than like a flat colour
+    gradient = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 64)
+    image = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, quality=90)
+    return buffer.getvalue()
+
+
+def make_zip(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def make_corpus(pages, image_side):
+    pdf = make_pdf(pages)
+    photo = make_image(image_side, image_side * 3 // 4)
+    return {
+        'document.pdf': (pdf, 'application/pdf'),
+        'photo.jpg': (photo, 'image/jpeg'),
+        'archive.zip': (make_zip(
+            [('document.pdf', pdf), ('photo.jpg', photo), ('images/photo.png', make_image(640, 480, 'PNG'))]
+        ), 'application/zip'),
+    }
+
+
+# Stand-in for the Bot API: serves updates queued by the benchmark, serves
+# corpus files for downloads and records what the bot sends to every chat.
+# With flood_rate, more than that many messages to a chat within a second are
+# refused with a 429 like Telegram does. With local_dir it behaves like a Bot
+# API server in --local mode: getFile returns paths under local_dir and files
+# can be sent as file:// URIs.
+class FakeBotApi:
+    def __init__(self, corpus, flood_rate=None, local_dir=None):
+        self.corpus = corpus
+        self.local_dir = local_dir
+        if local_dir:
+            for name, (data, _) in corpus.items():
+                with open(os.path.join(local_dir, name), 'wb') as f:
+                    f.write(data)
+        self.flood_rate = flood_rate
+        self.recent_sends = {}  # chat_id -> times of the sends within the last second
+        self.throttled = 0
+        self.condition = threading.Condition()
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.unique_ids = itertools.count(1)
+        self.sent = {}  # chat_id -> list of texts sent by the bot
+        self.last_message_ids = {}  # chat_id -> id of the last message the bot sent there
+        self.uploaded_bytes = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self.handle_request()
+
+            def do_POST(self):
+                self.handle_request()
+
+            def handle_request(self):
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                parts = url.path.strip('/').split('/')
+                if parts[0] == 'file':
+                    self.send_file('/'.join(parts[2:]))
+                    return
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    params.update({key: values[0] for key, values in parse_qs(body.decode()).items()})
+                if api.flooded(parts[-1], params):
+                    self.send_json({
+                        'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                        'parameters': {'retry_after': 1},
+                    }, status=429)
+                    return
+                self.send_json({'ok': True, 'result': api.call(parts[-1], params, len(body))})
+
+            def send_file(self, name):
+                if name not in api.corpus:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                data = api.corpus[name][0]
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_json(self, payload, status=200):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def call(self, method, params, body_size):
+        if method == 'getUpdates':
+            return self.get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0)))
+        if method == 'getFile':
+            name = params['file_id']
+            file_path = os.path.join(self.local_dir, name) if self.local_dir else name
+            return {'file_id': name, 'file_unique_id': name, 'file_size': len(self.corpus[name][0]), 'file_path': file_path}
+        if method in ('sendMessage', 'sendDocument', 'sendPhoto'):
+            chat_id = int(params['chat_id'])
+            body_size += local_file_size(params.get('document', params.get('photo', '')))
+            message = self.bot_message(chat_id, method, params.get('text'))
+            self.record(chat_id, params.get('text', params.get('caption', '')), body_size, message['message_id'])
+            return message
+        if method == 'sendMediaGroup':
+            chat_id = int(params['chat_id'])
+            media = json.loads(params['media'])
+            body_size += sum(local_file_size(item['media']) for item in media)
+            self.record(chat_id, '', body_size)
+            return [self.bot_message(chat_id, 'sendPhoto' if item['type'] == 'photo' else 'sendDocument') for item in media]
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        return True
+
+    def flooded(self, method, params):
+        if not self.flood_rate or not method.startswith('send') or 'chat_id' not in params:
+            return False
+        now = time.monotonic()
+        with self.condition:
+            recent = [sent_at for sent_at in self.recent_sends.get(params['chat_id'], ()) if sent_at > now - 1]
+            if len(recent) >= self.flood_rate:
+                self.throttled += 1
+                return True
+            recent.append(now)
+            self.recent_sends[params['chat_id']] = recent
+            return False
+
+    def record(self, chat_id, text, body_size, message_id=None):
+        with self.condition:
+            self.uploaded_bytes += body_size
+            self.sent.setdefault(chat_id, []).append(text)
+            if message_id is not None:
+                self.last_message_ids[chat_id] = message_id
+            self.condition.notify_all()
+
+    def bot_message(self, chat_id, method, text=None):
+        message = {'message_id': next(self.message_ids), 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+        output = {'file_id': f"output-{next(self.unique_ids)}", 'file_unique_id': f"output-{next(self.unique_ids)}"}
+        if method == 'sendDocument':
+            message['document'] = output
+        elif method == 'sendPhoto':
+            message['photo'] = [dict(output, width=1, height=1)]
+        else:
+            message['text'] = text or ''
+        return message
+
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + min(timeout, 1)
+        with self.condition:
+            while True:
+                pending = [update for update in self.updates if update['update_id'] >= offset]
+                remaining = deadline - time.monotonic()
+                if pending or remaining <= 0:
+                    self.updates = pending
+                    return pending
+                self.condition.wait(remaining)
+
+    def push(self, update):
+        with self.condition:
+            update['update_id'] = next(self.update_ids)
+            self.updates.append(update)
+            self.condition.notify_all()
+
+    def sent_count(self, chat_id):
+        with self.condition:
+            return len(self.sent.get(chat_id, ()))
+
+    # Wait for a message to the chat after the first `start` ones that matches
+    # `pattern`; returns None when it came, otherwise the reason it didn't
+    def wait_for(self, chat_id, start, pattern, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for text in self.sent.get(chat_id, [])[start:]:
+                    if FAILURE.search(text):
+                        return text
+                    if pattern.search(text):
+                        return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return f"No '{pattern.pattern}' reply"
+                self.condition.wait(remaining)
+
+
+# Size of a file sent as a file:// URI, which must still exist when the request arrives
+def local_file_size(media):
+    if not media.startswith('file://'):
+        return 0
+    return os.path.getsize(media[len('file://'):])
+
+
+# One simulated user replaying command flows in its chat
+class Chat:
+    def __init__(self, api, chat_id, timeout):
+        self.api = api
+        self.chat_id = chat_id
+        self.timeout = timeout
+
+    def message(self, **content):
+        message = {
+            'message_id': next(self.api.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': self.chat_id, 'type': 'private'},
+            'from': {'id': self.chat_id, 'is_bot': False, 'first_name': 'bench'},
+        }
+        message.update(content)
+        return message
+
+    # A fresh file_unique_id every time, so the result cache never short-cuts the work
+    def file(self, name):
+        data, mime_type = self.api.corpus[name]
+        return {
+            'file_id': name,
+            'file_unique_id': f"{name}-{next(self.api.unique_ids)}",
+            'file_size': len(data),
+            'file_name': name,
+            'mime_type': mime_type,
+        }
+
+    def document(self, name):
+        return self.message(document=self.file(name))
+
+    def photo(self):
+        photo = self.file('photo.jpg')
+        del photo['file_name'], photo['mime_type']
+        return self.message(photo=[dict(photo, width=1024, height=768)])
+
+    # Send one update and wait for the reply that ends the step
+    def step(self, update, expect):
+        start = self.api.sent_count(self.chat_id)
+        self.api.push(update)
+        error = self.api.wait_for(self.chat_id, start, re.compile(expect), self.timeout)
+        if error:
+            raise RuntimeError(error)
+
+    def text(self, text, expect, reply_to=None):
+        message = self.message(text=text)
+        if reply_to:
+            message['reply_to_message'] = reply_to
+        self.step({'message': message}, expect)
+
+    # Tap an inline keyboard button of the last message the bot sent
+    def tap(self, data, expect):
+        with self.api.condition:
+            message_id = self.api.last_message_ids[self.chat_id]
+        self.step({'callback_query': {
+            'id': str(next(self.api.message_ids)),
+            'from': {'id': self.chat_id, 'is_bot': False, 'first_name': 'bench'},
+            'chat_instance': str(self.chat_id),
+            'data': data,
+            'message': dict(self.message(text='keyboard'), message_id=message_id),
+        }}, expect)
+
+    def run_mergepdf(self):
+        self.text('/mergepdf', 'send the PDFs')
+        for _ in range(3):
+            self.step({'message': self.document('document.pdf')}, 'PDFs received')
+        self.text('order 3 1 2', 'Merge order set')
+        self.text('pages 2 1-2,5', 'will be merged')
+        self.text('DONE', 'Merging completed')
+
+    def run_splitpdf(self):
+        self.text('/splitpdf', 'Splitting process completed', reply_to=self.document('document.pdf'))
+
+    def run_pdf2image(self):
+        self.text('/pdf2image dpi=72 jpeg', 'Conversion completed', reply_to=self.document('document.pdf'))
+
+    def run_compresspdf(self):
+        self.text('/compresspdf small', 'Compressed|already well optimized', reply_to=self.document('document.pdf'))
+
+    def run_pdftext(self):
+        document = self.document('document.pdf')
+        self.text('/pdftext', r'Text of \d+ pages extracted', reply_to=document)
+        # Answered from the index /pdftext built, without reading the PDF again
+        self.text('/pdfsearch benchmark page 3', r'Found on 1 of \d+ pages: 3\n', reply_to=document)
+        self.text('/pdfsearch qui* fox send=pdf', 'Found on', reply_to=document)
+        self.text('/pdfsearch unicorn', 'No page contains', reply_to=self.document('document.pdf'))
+
+    def run_image2pdf(self):
+        self.text('/image2pdf', 'Send the images')
+        for _ in range(4):
+            self.step({'message': self.photo()}, 'Received photo')
+        self.text('go', 'send a name')
+        self.text('/skip', 'Your PDF has been created')
+
+    def run_resizeimage(self):
+        photo = self.photo()
+        self.text('/resizeimage', 'choose the modification', reply_to=photo)
+        self.tap('modify_file_size', 'desired file size')
+        self.text('40', 'Resized Image Details')
+
+    def run_batchresize(self):
+        self.text('/batchresize 800x600', 'Send the photos')
+        # Progress is reported by editing one message, so the photos are sent without waiting
+        for _ in range(6):
+            self.api.push({'message': self.photo()})
+        self.text('done', r'Batch resize completed\. 6 images resized\.')
+
+    def run_unarchive(self):
+        self.step({'message': self.document('archive.zip')}, 'Extraction complete')
+        archive = self.document('archive.zip')
+        self.text('/unarchive list', r'archive\.zip: 3 files, page 1/1', reply_to=archive)
+        self.tap('unarchive:file:1', r'Extraction complete\. 1 files sent\.')
+        self.text('/unarchive *.png', r'Extraction complete\. 1 files sent\.', reply_to=archive)
+
+    def run_archive(self):
+        self.text('/archive zip bundle', 'Send the files')
+        for name in ('document.pdf', 'photo.jpg', 'archive.zip', 'document.pdf'):
+            self.api.push({'message': self.document(name)})
+        self.text('done', r'Archive created: 4 files')
+
+
+# Peak RSS of this process and its children (the CPU worker processes)
+class RssSampler:
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.running = False
+        self.thread.join()
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, current_rss())
+            time.sleep(self.interval)
+
+
+# Direct children of a process, over all its threads
+def child_pids(pid):
+    children = []
+    try:
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+# RSS of this process and every process below it: the CPU workers are
+# grandchildren, forked by the fork server rather than by us
+def current_rss():
+    pids = [os.getpid()]
+    for pid in pids:
+        pids.extend(child_pids(pid))
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            pass
+    return total
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+# Run `rounds` flows of one command in each of `chats` chats at the same time
+def run_command(api, command, chats, rounds, timeout, first_chat_id):
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def run_chat(chat):
+        for _ in range(rounds):
+            started_at = time.monotonic()
+            try:
+                getattr(chat, f"run_{command}")()
+            except RuntimeError as e:
+                with lock:
+                    failures.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.monotonic() - started_at)
+
+    threads = [
+        threading.Thread(target=run_chat, args=(Chat(api, first_chat_id + index, timeout),))
+        for index in range(chats)
+    ]
+    uploaded_before = api.uploaded_bytes
+    started_at = time.monotonic()
+    with RssSampler() as rss:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.monotonic() - started_at
+
+    return {
+        'command': command,
+        'flows': len(latencies),
+        'failed': len(failures),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'peak_rss_mb': rss.peak / (1024 * 1024),
+        'uploaded_mb': (api.uploaded_bytes - uploaded_before) / (1024 * 1024),
+        'errors': sorted(set(failures))[:5],
+    }
+
+
+# Settings have to be in place before the bot modules read them
+def bot_environment():
+    os.environ['Bot_token'] = '123456:benchmark'
+    os.environ.setdefault('CACHE_INDEX_PATH', '')
+    os.environ.setdefault('SESSION_DB_PATH', '')
+    # Measure the bot rather than its pacing; --flood exercises the 429 handling
+    os.environ.setdefault('SEND_CHAT_RATE', '60000')
+    os.environ.setdefault('SEND_GLOBAL_RATE', '1000')
+    return os.environ
+
+
+def start_bot(api, prewarm=False):
+    bot_environment()
+    if api.local_dir:
+        os.environ['LOCAL_BOT_API_URL'] = api.base_url
+    import telebot
+    import main
+
+    telebot.apihelper.API_URL = api.base_url + "/bot{0}/{1}"
+    main.downloader.file_url = api.base_url + "/file/bot{0}/{1}"
+    main.scheduler.start()
+    if prewarm:
+        main.prewarm()
+    thread = threading.Thread(
+        target=main.bot.polling,
+        kwargs={'non_stop': True, 'interval': 0, 'timeout': 5, 'long_polling_timeout': 1},
+        daemon=True
+    )
+    thread.start()
+    return main
+
+
+STARTUP_SCRIPT = '''
+import time
+started_at = time.perf_counter()
+import main
+imported_at = time.perf_counter()
+if {prewarm}:
+    main.prewarm()
+print(imported_at - started_at, time.perf_counter() - imported_at)
+main.scheduler.get_cpu_pool().shutdown()
+'''
+
+
+# Cold start in fresh interpreters: importing the bot, then optionally prewarm()
+def run_startup(runs, prewarm):
+    imports, warmups, processes = [], [], []
+    for _ in range(runs):
+        started_at = time.monotonic()
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT.format(prewarm=prewarm)],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=bot_environment(),
+            capture_output=True, text=True, check=True
+        ).stdout
+        processes.append(time.monotonic() - started_at)
+        import_seconds, warm_seconds = map(float, output.split()[-2:])
+        imports.append(import_seconds)
+        warmups.append(warm_seconds)
+    return {
+        'runs': runs,
+        'prewarm': prewarm,
+        'import_p50': percentile(imports, 50),
+        'import_min': min(imports),
+        'prewarm_p50': percentile(warmups, 50),
+        'process_p50': percentile(processes, 50),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's command flows against a local fake Bot API.")
+    parser.add_argument('--commands', default=','.join(COMMANDS), help="comma separated, default: all")
+    parser.add_argument('--chats', type=int, default=4, help="chats running flows at the same time")
+    parser.add_argument('--rounds', type=int, default=3, help="flows per chat and command")
+    parser.add_argument('--pages', type=int, default=10, help="pages of the generated PDF")
+    parser.add_argument('--image-side', type=int, default=1600, help="width of the generated photo")
+    parser.add_argument('--timeout', type=float, default=120, help="seconds to wait for one reply")
+    parser.add_argument('--flood', type=int, metavar='N', help="answer 429 past N messages per second to a chat")
+    parser.add_argument('--local', action='store_true', help="act as a Bot API server in --local mode")
+    parser.add_argument('--prewarm', action='store_true', help="call prewarm() before the first flow")
+    parser.add_argument('--startup', type=int, metavar='RUNS', help="only measure cold starts over RUNS interpreters")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.startup:
+        result = run_startup(args.startup, args.prewarm)
+        print(
+            f"Cold start over {result['runs']} runs: import p50 {result['import_p50']:.3f}s "
+            f"(min {result['import_min']:.3f}s), whole process p50 {result['process_p50']:.3f}s"
+        )
+        if args.prewarm:
+            print(f"prewarm() p50 {result['prewarm_p50']:.3f}s")
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'startup': result}, f, indent=2)
+        return
+
+    commands = [command.strip() for command in args.commands.split(',') if command.strip()]
+    unknown = set(commands) - set(COMMANDS)
+    if unknown:
+        parser.error(f"unknown commands: {', '.join(sorted(unknown))}")
+
+    local_dir = tempfile.mkdtemp(prefix='bench-bot-api-') if args.local else None
+    api = FakeBotApi(make_corpus(args.pages, args.image_side), flood_rate=args.flood, local_dir=local_dir)
+    api.start()
+    started_at = time.monotonic()
+    bot_module = start_bot(api, args.prewarm)
+    startup = time.monotonic() - started_at
+
+    results = []
+    for index, command in enumerate(commands):
+        results.append(run_command(api, command, args.chats, args.rounds, args.timeout, (index + 1) * 100000))
+
+    print(f"Startup {startup:.2f}s, {args.chats} chats x {args.rounds} rounds\n")
+    print(f"{'command':<12} {'flows':>5} {'failed':>6} {'flows/s':>8} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'peak RSS MB':>11}")
+    for result in results:
+        print(
+            f"{result['command']:<12} {result['flows']:>5} {result['failed']:>6} {result['throughput']:>8.2f} "
+            f"{result['p50']:>7.2f} {result['p95']:>7.2f} {result['p99']:>7.2f} {result['peak_rss_mb']:>11.1f}"
+        )
+        for error in result['errors']:
+            print(f"    {error}")
+    if args.flood:
+        print(f"\n{api.throttled} sends refused with 429, {bot_module.api_sender.throttled} seen by the bot")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'startup_seconds': startup,
+                'chats': args.chats,
+                'rounds': args.rounds,
+                'results': results,
+                'stages': {f"{operation}/{stage}": stats for (operation, stage), stats in bot_module.metrics.tracer.stats().items()},
+            }, f, indent=2)
+
+    bot_module.bot.stop_polling()
+    bot_module.scheduler.get_cpu_pool().shutdown(cancel_futures=True)
+    api.stop()
+    if local_dir:
+        shutil.rmtree(local_dir, ignore_errors=True)
+    # Job and download threads never return, don't wait for them
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+# Maps (file_unique_id, operation, params) to the Telegram file_ids of the
+# outputs that were already uploaded for it, so a repeated request can be
+# answered by re-sending those file_ids without downloading or computing.
+#
+# Entries are evicted least-recently-used beyond max_entries and after ttl
+# seconds. The index is kept in a JSON file so it survives restarts; it is
+# rewritten at most once per save_delay seconds however many entries change,
+# and once more at exit.
+class ResultCache:
+    def __init__(self, index_path, max_entries=5000, ttl=7 * 24 * 3600, save_delay=5):
+        self.index_path = index_path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.save_delay = save_delay
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # One writer of the index file at a time
+        self.save_timer = None
+        self.entries = OrderedDict()  # key -> {'outputs': [...], 'created': ts}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.load()
+        if self.index_path:
+            atexit.register(self.save)
+
+    @staticmethod
+    def make_key(file_unique_id, operation, params=None):
+        return json.dumps([file_unique_id, operation, params or {}], sort_keys=True, separators=(',', ':'))
+
+    # Outputs as a list of {'file_id', 'kind'} dicts, or None on a miss
+    def get(self, file_unique_id, operation, params=None):
+        key = self.make_key(file_unique_id, operation, params)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry['created'] > self.ttl:
+                del self.entries[key]
+                self.dirty = True
+                self.schedule_save()
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry['outputs']
+
+    def put(self, file_unique_id, operation, params, outputs):
+        if not outputs:
+            return
+        key = self.make_key(file_unique_id, operation, params)
+        with self.lock:
+            self.entries[key] = {'outputs': outputs, 'created': time.time()}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+            self.schedule_save()
+
+    # Called with the lock held
+    def schedule_save(self):
+        if not self.index_path or self.save_timer is not None:
+            return
+        self.save_timer = threading.Timer(self.save_delay, self.save)
+        self.save_timer.daemon = True
+        self.save_timer.start()
+
+    def load(self):
+        if not self.index_path or not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        # Stored oldest first, so the LRU order survives a restart
+        for key, entry in stored:
+            if now - entry['created'] <= self.ttl:
+                self.entries[key] = entry
+
+    def save(self):
+        if not self.index_path:
+            return
+        with self.save_lock:
+            with self.lock:
+                self.save_timer = None
+                if not self.dirty:
+                    return
+                stored = list(self.entries.items())
+                self.dirty = False
+            # Write to a temporary file first so a crash never leaves a truncated index
+            temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(stored, f)
+            os.replace(temp_path, self.index_path)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,98 @@
+import os
+import tempfile
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return int(value)
+
+
+# Job scheduler
+MAX_WORKERS = env_int('MAX_WORKERS', 4)  # Jobs running at the same time across all chats
+MAX_BLOCKED_WORKERS = env_int('MAX_BLOCKED_WORKERS', MAX_WORKERS)  # Extra workers standing in for jobs waiting on send pacing
+CPU_WORKERS = env_int('CPU_WORKERS', os.cpu_count() or 1)  # Processes for rendering / Pillow work
+MAX_JOBS_PER_CHAT = env_int('MAX_JOBS_PER_CHAT', 1)  # Jobs running at the same time for one chat
+MAX_QUEUED_PER_CHAT = env_int('MAX_QUEUED_PER_CHAT', 50)  # Pending jobs accepted for one chat
+
+# Self-hosted Bot API server (telegram-bot-api --local on this machine or a shared volume).
+# Files are then read where the server stores them and uploaded by path, up to 2 GB.
+LOCAL_BOT_API_URL = os.environ.get('LOCAL_BOT_API_URL', '')  # e.g. http://localhost:8081; empty uses api.telegram.org
+MAX_FILE_SIZE = env_int('MAX_FILE_SIZE', 2000 * 1024 * 1024 if LOCAL_BOT_API_URL else 20 * 1024 * 1024)  # Largest input file
+
+# Scratch space for jobs
+SCRATCH_DIR = os.environ.get('SCRATCH_DIR', os.path.join(tempfile.gettempdir(), 'multi_op2'))
+RAM_SCRATCH_DIR = os.environ.get('RAM_SCRATCH_DIR', '/dev/shm/multi_op2')  # tmpfs, used when a job fits
+RAM_SCRATCH_BUDGET = env_int('RAM_SCRATCH_BUDGET', 256 * 1024 * 1024)  # Bytes of RAM scratch shared by all jobs
+
+# PDF to image
+PDF2IMAGE_DPI = env_int('PDF2IMAGE_DPI', 288)  # Default render resolution (4x zoom)
+PDF2IMAGE_MAX_DPI = env_int('PDF2IMAGE_MAX_DPI', 600)
+PDF2IMAGE_WINDOW = env_int('PDF2IMAGE_WINDOW', 2 * CPU_WORKERS)  # Pages rendered ahead of the upload
+PDF2IMAGE_SHEET_COLUMNS = env_int('PDF2IMAGE_SHEET_COLUMNS', 5)  # Contact sheet ('/pdf2image sheet') layout
+PDF2IMAGE_SHEET_ROWS = env_int('PDF2IMAGE_SHEET_ROWS', 6)
+PDF2IMAGE_THUMB_WIDTH = env_int('PDF2IMAGE_THUMB_WIDTH', 240)  # Pixels; cells are A4-shaped
+
+# PDF text search
+TEXT_INDEX_CACHE_ENTRIES = env_int('TEXT_INDEX_CACHE_ENTRIES', 50)  # Word indexes of PDFs kept for /pdfsearch
+
+# PDF merge (done in memory: inputs + merged document + output buffer, written to disk past the budget).
+# The merged document is always built in RAM, so these stay tied to the budget in local Bot API mode too.
+MERGE_MEMORY_BUDGET = env_int('MERGE_MEMORY_BUDGET', 45 * 1024 * 1024)  # Bytes of RAM one merge may use
+MERGE_MAX_TOTAL_SIZE = env_int('MERGE_MAX_TOTAL_SIZE', MERGE_MEMORY_BUDGET // 3)
+MERGE_MAX_FILE_SIZE = env_int('MERGE_MAX_FILE_SIZE', min(5 * 1024 * 1024, MERGE_MAX_TOTAL_SIZE))
+MERGE_MAX_FILES = env_int('MERGE_MAX_FILES', 5)
+
+# Batch resize
+BATCH_RESIZE_MAX_IMAGES = env_int('BATCH_RESIZE_MAX_IMAGES', 100)  # Images in one /batchresize session
+
+# Archive extraction limits (zip-bomb protection)
+UNARCHIVE_MAX_BYTES = env_int('UNARCHIVE_MAX_BYTES', 500 * 1024 * 1024)  # Total uncompressed size
+UNARCHIVE_MAX_ENTRIES = env_int('UNARCHIVE_MAX_ENTRIES', 1000)
+UNARCHIVE_MAX_RATIO = env_int('UNARCHIVE_MAX_RATIO', 200)  # Uncompressed / compressed size of one member
+LISTING_CACHE_ENTRIES = env_int('LISTING_CACHE_ENTRIES', 200)  # Archive file lists kept for '/unarchive list'
+
+# Archive creation (/archive)
+ARCHIVE_MAX_FILES = env_int('ARCHIVE_MAX_FILES', 100)
+ARCHIVE_MAX_TOTAL_SIZE = env_int('ARCHIVE_MAX_TOTAL_SIZE', 10 * MAX_FILE_SIZE)  # Inputs of one archive
+ARCHIVE_VOLUME_SIZE = env_int('ARCHIVE_VOLUME_SIZE', 2000 * 1024 * 1024 if LOCAL_BOT_API_URL else 50 * 1024 * 1024)  # Upload limit
+ARCHIVE_THREADS = env_int('ARCHIVE_THREADS', CPU_WORKERS)  # Threads deflating one zip
+
+# Result cache (file_ids of outputs already uploaded)
+CACHE_INDEX_PATH = os.environ.get('CACHE_INDEX_PATH', 'result_cache.json')  # Empty to keep it in memory only
+CACHE_MAX_ENTRIES = env_int('CACHE_MAX_ENTRIES', 5000)
+CACHE_TTL = env_int('CACHE_TTL', 7 * 24 * 3600)  # Seconds
+CACHE_SAVE_DELAY = env_int('CACHE_SAVE_DELAY', 5)  # Seconds changes wait before the index is rewritten
+
+# Per-chat sessions (image2pdf, mergepdf, resizeimage, splitpdf)
+SESSION_DB_PATH = os.environ.get('SESSION_DB_PATH', '')  # SQLite file shared across restarts and workers; empty keeps sessions in memory
+SESSION_TTL = env_int('SESSION_TTL', 3600)  # Seconds of inactivity before a session is dropped
+SESSION_MAX_BYTES = env_int('SESSION_MAX_BYTES', 64 * 1024 * 1024)  # Records plus PDFs being merged, idle LRU sessions are dropped beyond it
+SESSION_MAX_SESSION_BYTES = env_int('SESSION_MAX_SESSION_BYTES', 32 * 1024 * 1024)  # One session's share, new input is refused beyond it
+
+# Downloads from Telegram
+DOWNLOAD_WORKERS = env_int('DOWNLOAD_WORKERS', 8)  # Files fetched from Telegram at the same time
+DOWNLOAD_POOL_SIZE = env_int('DOWNLOAD_POOL_SIZE', 16)  # Keep-alive connections
+DOWNLOAD_CHUNK_SIZE = env_int('DOWNLOAD_CHUNK_SIZE', 256 * 1024)
+
+# Outgoing messages (Telegram flood limits)
+SEND_GLOBAL_RATE = env_int('SEND_GLOBAL_RATE', 30)  # Messages per second across all chats
+SEND_CHAT_RATE = env_int('SEND_CHAT_RATE', 60)  # Messages per minute to one chat
+SEND_CHAT_BURST = env_int('SEND_CHAT_BURST', 5)  # Messages to one chat sent without pacing after a quiet spell
+SEND_RETRIES = env_int('SEND_RETRIES', 5)  # Attempts after a 429 or a connection error
+
+# Startup
+PREWARM = env_int('PREWARM', 0)  # 1 to load the PDF/image libraries and start the CPU workers right after startup
+
+# Monitoring
+ADMIN_IDS = {int(user_id) for user_id in os.environ.get('ADMIN_IDS', '').split(',') if user_id.strip()}  # Telegram user ids allowed to use /stats
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # Bearer token required by /metrics when set
+
+# Webhook mode (used instead of long polling when WEBHOOK_URL is set)
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')  # Public base URL, e.g. https://bot.example.com
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')  # Required in webhook mode, Telegram sends it with every update
+WEBHOOK_QUEUE_SIZE = env_int('WEBHOOK_QUEUE_SIZE', 1000)  # Updates waiting for dispatch before we answer 503
+WEBHOOK_WORKERS = env_int('WEBHOOK_WORKERS', 4)
+WEBHOOK_MAX_CONNECTIONS = env_int('WEBHOOK_MAX_CONNECTIONS', 40)
+PORT = env_int('PORT', 3021)
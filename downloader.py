@@ -0,0 +1,93 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+TELEGRAM_FILE_URL = "https://api.telegram.org/file/bot{0}/{1}"
+
+
+class DownloadError(Exception):
+    pass
+
+
+def pooled_session(pool_size, retries):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Fetches Telegram files over one pooled keep-alive session, and holds the
+# pooled session used for Bot API calls.
+# Files are streamed in chunks into their destination (a file or bytes)
+# instead of being read whole into memory first, and several files can be
+# fetched at the same time.
+#
+# With local_files, getFile paths that exist on this machine (a Bot API server
+# running with --local) are used where they are instead of being downloaded.
+class Downloader:
+    def __init__(self, token, pool_size=16, workers=8, chunk_size=256 * 1024, file_url=None, local_files=False):
+        self.token = token
+        self.chunk_size = chunk_size
+        self.file_url = file_url or TELEGRAM_FILE_URL
+        self.local_files = local_files
+
+        # Downloads are GETs, safe to retry after a timeout or a 5xx
+        self.session = pooled_session(pool_size, Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504)))
+        # Bot API calls only retry failing to connect: a POST that timed out or
+        # got a 5xx may have been delivered, and must never be sent twice
+        self.api_session = pooled_session(pool_size, Retry(total=3, connect=3, read=0, status=0, other=0, backoff_factor=0.5))
+
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download')
+
+    def url(self, file_path):
+        return self.file_url.format(self.token, file_path)
+
+    def iter_chunks(self, file_path):
+        with metrics.tracer.trace('download') as span:
+            with self.session.get(self.url(file_path), stream=True, timeout=(10, 120)) as response:
+                if response.status_code != 200:
+                    raise DownloadError(f"Download of {file_path} failed with HTTP {response.status_code}")
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if chunk:
+                        span.add_bytes(len(chunk))
+                        yield chunk
+
+    # Stream a file into an open binary file object, returning the number of bytes
+    def fetch_into(self, file_path, target):
+        size = 0
+        for chunk in self.iter_chunks(file_path):
+            target.write(chunk)
+            size += len(chunk)
+        return size
+
+    def fetch_to(self, file_path, target_path):
+        with open(target_path, 'wb') as target:
+            self.fetch_into(file_path, target)
+        return target_path
+
+    def fetch_bytes(self, file_path):
+        return b''.join(self.iter_chunks(file_path))
+
+    # The Bot API server's own copy of a file, if it is on this machine
+    def local_path(self, file_path):
+        if self.local_files and os.path.isabs(file_path) and os.path.isfile(file_path):
+            return file_path
+        return None
+
+    # A path to the file: the server's copy when it is local, otherwise downloaded to target_path.
+    # The server's copy must not be modified or removed.
+    def fetch_path(self, file_path, target_path):
+        return self.local_path(file_path) or self.fetch_to(file_path, target_path)
+
+    # The server's copy of the file when it is local, otherwise its bytes
+    def fetch_source(self, file_path):
+        return self.local_path(file_path) or self.fetch_bytes(file_path)
+
+    def submit(self, fetch, *args):
+        return self.pool.submit(metrics.bind(fetch), *args)
@@ -0,0 +1,218 @@
+from io import BytesIO
+
+from PIL import Image
+
+
+# The functions below run in the scheduler's process pool, so they only take
+# and return picklable values (paths, bytes and PIL images).
+
+# image2pdf quality presets: (longest side in pixels, JPEG quality), None keeps the original
+PDF_QUALITY_PRESETS = {
+    'original': None,
+    'high': (3000, 85),
+    'small': (1600, 70),
+}
+
+
+# Turn an image file into something PyMuPDF can embed, as (data, width, height).
+# With the 'original' preset JPEGs are passed through untouched; everything
+# else is decoded once, converted to RGB and encoded as JPEG.
+def prepare_pdf_image(image_path, quality='original'):
+    preset = PDF_QUALITY_PRESETS[quality]
+    with Image.open(image_path) as image:
+        if preset is None and image.format == 'JPEG' and image.mode in ('RGB', 'L'):
+            with open(image_path, 'rb') as f:
+                return f.read(), image.width, image.height
+
+        max_side, jpeg_quality = preset or (None, 95)
+        if max_side and image.format == 'JPEG':
+            # Let the JPEG decoder scale down by a power of two while decoding
+            image.draft('RGB', (max_side, max_side))
+        image = flatten(image)
+        if max_side:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        output = BytesIO()
+        image.save(output, format='JPEG', quality=jpeg_quality)
+        return output.getvalue(), image.width, image.height
+
+
+# An RGB or grayscale version of the image, with transparency flattened onto white like a printed page
+def flatten(image):
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    if image.mode not in ('RGB', 'L'):
+        return image.convert('RGB')
+    return image
+
+
+MIN_QUALITY = 30  # Below this, downscaling looks better than more compression
+MAX_QUALITY = 95
+PROXY_SIDE = 512  # Side of the proxy used to estimate sizes cheaply
+PROXY_TILES = 4  # The proxy is a PROXY_TILES x PROXY_TILES mosaic of full-resolution tiles
+GUESS_SPAN = 8  # Quality bracket searched around the proxy's estimate
+CLOSE_ENOUGH = 0.95  # An encoding this close to the target ends the search
+MIN_SIDE = 16
+MAX_ENCODES = {'JPEG': 3, 'WEBP': 3, 'AVIF': 2}  # Full-size encodes spent confirming the proxy's estimate
+
+SIZE_FORMATS = {
+    'jpg': 'JPEG',
+    'jpeg': 'JPEG',
+    'webp': 'WEBP',
+    'avif': 'AVIF',
+}
+
+
+def encode(image, image_format, quality, subsampling):
+    output = BytesIO()
+    if image_format == 'JPEG':
+        image.save(output, format='JPEG', quality=quality, subsampling=subsampling, optimize=False)
+    else:
+        image.save(output, format=image_format, quality=quality)
+    return output.getvalue()
+
+
+# Highest quality in [low, high] whose encoding fits in target_bytes, as (quality, data),
+# or `best` if none does. The first probe is `guess`; when it's given, the search stays
+# within GUESS_SPAN of it and only widens to the rest of the range if nothing in that
+# bracket fits. At most `encodes` encodes are made when a limit is given, and
+# the search stops early at an encoding within CLOSE_ENOUGH of the target.
+def search_quality(image, image_format, subsampling, target_bytes, low, high, guess=None, best=None, encodes=None):
+    lowest = low
+    found = False
+    while low <= high and encodes != 0:
+        if guess is not None and low <= guess <= high:
+            quality = guess
+        else:
+            quality = (low + high + 1) // 2
+        data = encode(image, image_format, quality, subsampling)
+        if encodes is not None:
+            encodes -= 1
+        if len(data) <= target_bytes:
+            best = (quality, data)
+            found = True
+            if len(data) >= CLOSE_ENOUGH * target_bytes:
+                break
+            low = quality + 1
+            if guess is not None:
+                high = min(high, guess + GUESS_SPAN)
+        else:
+            high = quality - 1
+            if guess is not None:
+                low = max(low, guess - GUESS_SPAN)
+        guess = None
+    if not found and low > lowest and encodes != 0:
+        return search_quality(image, image_format, subsampling, target_bytes, lowest, low - 1, best=best, encodes=encodes)
+    return best
+
+
+# Tiles cut evenly across the image, pasted into one small image. Unlike a
+# thumbnail it keeps the full-size detail, so it costs about as many bytes per
+# pixel to encode as the image itself. None for images too small to sample.
+def make_proxy(image):
+    tile = min(PROXY_SIDE, image.width, image.height) // PROXY_TILES // 16 * 16  # Whole JPEG blocks
+    if tile == 0 or image.width * image.height <= PROXY_SIDE * PROXY_SIDE:
+        return None
+    proxy = Image.new(image.mode, (tile * PROXY_TILES, tile * PROXY_TILES))
+    for row in range(PROXY_TILES):
+        for column in range(PROXY_TILES):
+            left = (image.width - tile) * column // (PROXY_TILES - 1)
+            top = (image.height - tile) * row // (PROXY_TILES - 1)
+            proxy.paste(image.crop((left, top, left + tile, top + tile)), (column * tile, row * tile))
+    return proxy
+
+
+# Estimate the quality that reaches target_bytes by searching on a small proxy
+# of the image and scaling the target by the pixel ratio. Returns (guess, min_size):
+# the guess is None for images that are already small, and min_size, the
+# estimated size at MIN_QUALITY, is only worked out when no quality fits.
+def estimate_quality(image, image_format, subsampling, target_bytes):
+    proxy = make_proxy(image)
+    if proxy is None:
+        return None, None
+    pixel_ratio = (proxy.width * proxy.height) / (image.width * image.height)
+    best = search_quality(proxy, image_format, subsampling, target_bytes * pixel_ratio, MIN_QUALITY, MAX_QUALITY)
+    if best:
+        return best[0], None
+    return MIN_QUALITY, len(encode(proxy, image_format, MIN_QUALITY, subsampling)) / pixel_ratio
+
+
+def shrink(image, scale):
+    width, height = int(image.width * scale), int(image.height * scale)
+    if min(width, height) < MIN_SIDE:
+        raise ValueError("The target size is too small for this image.")
+    return image.resize((width, height), Image.LANCZOS)
+
+
+# Encode the image so it fits in target_kb, returning (data, width, height, quality).
+# The quality is estimated on a small proxy and confirmed with at most
+# MAX_ENCODES full-size encodes; if even the lowest quality is too big, the
+# image is downscaled to where the proxy says it fits and quality is searched
+# again there.
+def compress_to_size(image, target_kb, image_format='JPEG'):
+    target_bytes = int(target_kb * 1024)
+    if target_bytes <= 0:
+        raise ValueError("The target size must be positive.")
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    encodes = MAX_ENCODES[image_format]
+    subsampling = 2 if image_format == 'JPEG' else None
+    guess, min_size = estimate_quality(image, image_format, subsampling, target_bytes)
+    # Leave some slack, the proxy is only an estimate
+    if min_size is None or min_size <= 1.1 * target_bytes:
+        # Images at or below the proxy size are cheap enough to search fully
+        best = search_quality(image, image_format, subsampling, target_bytes, MIN_QUALITY, MAX_QUALITY, guess,
+                              encodes=encodes if guess is not None else None)
+        if best:
+            quality, data = best
+            return data, image.width, image.height, quality
+
+    # Quality alone can't reach the target: shrink until the lowest quality fits.
+    # Bytes shrink a bit slower than the pixel count, so each step aims a little low.
+    if min_size is not None and min_size > target_bytes:
+        image = shrink(image, 0.97 * (target_bytes / min_size) ** 0.5)
+    data = encode(image, image_format, MIN_QUALITY, subsampling)
+    while len(data) > target_bytes:
+        image = shrink(image, max(0.5, min(0.95, 0.97 * (target_bytes / len(data)) ** 0.5)))
+        data = encode(image, image_format, MIN_QUALITY, subsampling)
+    # The last step usually leaves some room, so spend it on quality
+    guess, _ = estimate_quality(image, image_format, subsampling, target_bytes)
+    quality, data = search_quality(image, image_format, subsampling, target_bytes,
+                                   MIN_QUALITY + 1, MAX_QUALITY, guess, (MIN_QUALITY, data), encodes)
+    return data, image.width, image.height, quality
+
+
+# /batchresize output formats when resizing to dimensions
+RESIZE_FORMATS = {
+    'jpg': 'JPEG',
+    'jpeg': 'JPEG',
+    'png': 'PNG',
+    'webp': 'WEBP',
+}
+
+
+# Resize an image file into output_path, returning (width, height, quality).
+# With `size` the image is shrunk to fit in (width, height), keeping the
+# aspect ratio; JPEGs are DCT-scaled while decoding, so a 12 MP photo going to
+# 1280 px is never decoded at full size. With `target_kb` it is then encoded
+# to fit in that many kilobytes, otherwise at `quality`.
+def resize_image_file(image_path, output_path, image_format='JPEG', size=None, target_kb=None, quality=90):
+    with Image.open(image_path) as image:
+        if size:
+            image.draft(None, size)
+        if image_format == 'JPEG' or target_kb:
+            image = flatten(image)
+        if size:
+            image.thumbnail(size, Image.LANCZOS)
+        if target_kb:
+            data, width, height, quality = compress_to_size(image, target_kb, image_format)
+        else:
+            data = encode(image, image_format, quality, 2)
+            width, height = image.size
+    with open(output_path, 'wb') as f:
+        f.write(data)
+    return width, height, quality
@@ -0,0 +1,18 @@
+import importlib
+
+
+# Stands in for a module and imports it on first attribute access, so heavy
+# libraries are only loaded by the first command that needs them.
+# importlib's module locks make the first access safe from several threads.
+class LazyModule:
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def load(self):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
@@ -1,347 +1,964 @@
 import telebot
 from telebot.types import Message
-import fitz  # PyMuPDF
-from PIL import Image
 from io import BytesIO
 import os
-from PyPDF2 import PdfReader, PdfWriter, PdfMerger
+import re
+import threading
+from collections import deque
 import zipfile
-import rarfile
-import shutil
-import py7zr
-from webserver import keep_alive
+from itertools import islice
+from functools import partial
+import config
+from cache import ResultCache
+from downloader import Downloader
+from lazy import LazyModule
+import metrics
+from router import Router
+from scheduler import JobScheduler
+from sender import RATE_LIMITED_PREFIXES, Outbox, Sender, local_upload, output_of
+from sessions import SessionStore, SqliteBackend
+from workspace import Workspace, sweep_stale_workspaces
+
+# Loaded by the first command that uses them, or up front by prewarm()
+Image = LazyModule('PIL.Image')
+PyPDF2 = LazyModule('PyPDF2')
+archives = LazyModule('archives')
+imagetools = LazyModule('imagetools')
+pdftools = LazyModule('pdftools')
+HEAVY_MODULES = (Image, PyPDF2, archives, imagetools, pdftools)
 
 telegram_token = os.environ['Bot_token']
-bot = telebot.TeleBot(telegram_token)
+# Handlers only resolve the route and queue a job, so updates are taken in
+# the polling thread itself; the work runs on the scheduler's workers
+bot = telebot.TeleBot(telegram_token, threaded=False)
+
+
+def reject_job(chat_id):
+    bot.send_message(chat_id, "Too many pending requests. Please wait for the current ones to finish.")
+
+
+# Heavy handlers only enqueue their work here and return right away
+scheduler = JobScheduler(
+    max_workers=config.MAX_WORKERS,
+    max_blocked=config.MAX_BLOCKED_WORKERS,
+    cpu_workers=config.CPU_WORKERS,
+    max_per_chat=config.MAX_JOBS_PER_CHAT,
+    max_queued_per_chat=config.MAX_QUEUED_PER_CHAT,
+    on_reject=reject_job,
+    cpu_preload=('imagetools', 'pdftools')
+)
+
+# Telegram file_ids of outputs we already uploaded, keyed by input and operation
+result_cache = ResultCache(config.CACHE_INDEX_PATH, config.CACHE_MAX_ENTRIES, config.CACHE_TTL, config.CACHE_SAVE_DELAY)
+
+# Archive file lists for '/unarchive list', by file_unique_id (kept in memory only)
+listing_cache = ResultCache('', config.LISTING_CACHE_ENTRIES, config.CACHE_TTL)
+
+# Word -> pages indexes of PDFs for /pdfsearch, by file_unique_id (kept in memory only)
+text_index_cache = ResultCache('', config.TEXT_INDEX_CACHE_ENTRIES, config.CACHE_TTL)
+
+# Pooled keep-alive connections for file downloads and for the Bot API calls
+downloader = Downloader(
+    telegram_token,
+    pool_size=config.DOWNLOAD_POOL_SIZE,
+    workers=config.DOWNLOAD_WORKERS,
+    chunk_size=config.DOWNLOAD_CHUNK_SIZE,
+    file_url=config.LOCAL_BOT_API_URL + "/file/bot{0}/{1}" if config.LOCAL_BOT_API_URL else None,
+    local_files=bool(config.LOCAL_BOT_API_URL)
+)
+telebot.apihelper.session = downloader.api_session
+if config.LOCAL_BOT_API_URL:
+    telebot.apihelper.API_URL = config.LOCAL_BOT_API_URL + "/bot{0}/{1}"
+    Outbox.local_uploads = True
+
+# Paces messages to Telegram's flood limits and retries them on 429s. While a
+# job waits for its turn, the scheduler runs other chats' jobs in its slot.
+api_sender = Sender(
+    downloader.api_session,
+    global_rate=config.SEND_GLOBAL_RATE,
+    chat_rate=config.SEND_CHAT_RATE / 60,
+    chat_burst=config.SEND_CHAT_BURST,
+    retries=config.SEND_RETRIES,
+    blocking=scheduler.blocking
+)
+
+# Bot API methods traced as stages of the operation calling them
+API_STAGES = {
+    'getFile': 'get_file',
+    'sendDocument': 'send',
+    'sendPhoto': 'send',
+    'sendMediaGroup': 'send',
+}
+
+
+# Send every Bot API request over the pooled session, timing getFile and uploads.
+# Requests posting into a chat go through api_sender's rate limits and retries.
+def send_api_request(method, url, **kwargs):
+    api_method = url.rsplit('/', 1)[-1]
+    params = kwargs.get('params') or {}
+    if api_method.startswith(RATE_LIMITED_PREFIXES) and 'chat_id' in params:
+        request = partial(api_sender.request, params['chat_id'])
+    else:
+        request = downloader.api_session.request
+    stage = API_STAGES.get(api_method)
+    if stage is None:
+        return request(method, url, **kwargs)
+    with metrics.tracer.trace(stage) as span:
+        span.add_bytes(upload_size(kwargs.get('files')))
+        return request(method, url, **kwargs)
+
+
+# Bytes about to be uploaded in a multipart request
+def upload_size(files):
+    size = 0
+    for value in (files or {}).values():
+        if isinstance(value, tuple):
+            value = value[1]
+        if isinstance(value, bytes):
+            size += len(value)
+        elif hasattr(value, 'seek'):
+            position = value.tell()
+            size += value.seek(0, os.SEEK_END) - position
+            value.seek(position)
+    return size
+
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = send_api_request
+
+
+# Release what an ended or expired session still holds in this process
+def release_session(runtime):
+    for future in runtime.get('pages', ()):
+        future.cancel()
+    if 'builder' in runtime:
+        runtime['builder'].close()
+    if 'merger' in runtime:
+        runtime['merger'].close()
+    if 'workspace' in runtime:
+        runtime['workspace'].cleanup()
+
+
+# Only merges are charged: an image2pdf builder mostly holds photos passed
+# through as they are, and a PDF of a few dozen phone photos must still fit
+def session_runtime_size(runtime):
+    return runtime['merger'].size if 'merger' in runtime else 0
+
+
+# A session with jobs queued or running, or downloads still writing into its
+# builder or workspace, must not be released under them
+def session_busy(chat_id, runtime):
+    return scheduler.has_jobs(chat_id) or any(not future.done() for future in runtime.get('pages', ()))
+
+
+# Per-chat session state (image2pdf, mergepdf, resizeimage, splitpdf), expired
+# after SESSION_TTL and bounded by SESSION_MAX_BYTES. With SESSION_DB_PATH set
+# it is kept in SQLite, so it survives restarts and is shared between workers.
+sessions = SessionStore(
+    SqliteBackend(config.SESSION_DB_PATH) if config.SESSION_DB_PATH else None,
+    ttl=config.SESSION_TTL,
+    max_bytes=config.SESSION_MAX_BYTES,
+    max_session_bytes=config.SESSION_MAX_SESSION_BYTES,
+    on_release=release_session,
+    runtime_size=session_runtime_size,
+    busy=session_busy
+)
+
+
+# A chat is in at most one interactive flow at a time (image2pdf, mergepdf or
+# resizeimage). Its record's 'state' is what messages are routed on.
+def start_flow(chat_id, state, session):
+    sessions.end(chat_id, 'flow')  # Drops the previous flow along with its workspace and builder
+    session['state'] = state
+    sessions.put(chat_id, 'flow', session)
+
+
+# The chat's flow record if it is in one of `states`, otherwise None
+def get_flow(chat_id, *states):
+    session = sessions.get(chat_id, 'flow')
+    if session is not None and session['state'] in states:
+        return session
+    return None
+
 
-# Dictionary to store user session data (img2pdf)
-user_images = {}
-user_pdf_name = {}
+def chat_state(chat_id):
+    session = sessions.get(chat_id, 'flow')
+    return session['state'] if session is not None else None
 
-# Dictionary to store user settings (image resize)
-user_settings = {}
 
-# Dictionary to track the processing status for each chat (pdf splitter)
-processing_status = {}
+# Every message is dispatched by one lookup on (chat state, content type, trigger),
+# see the @router.route registrations below
+router = Router(chat_state, job=scheduler.job)
 
-# Pdf merger objects
-pdfs_received = []
-pdfs_received_messages = []
-progress_message = None
-merge_in_progress = False
+
+@bot.message_handler(func=lambda message: True, content_types=['text', 'photo', 'document'])
+def route_message(message):
+    router.dispatch(message)
 
 
 # handle help command
-@bot.message_handler(commands=['help'])
+@router.route('text', '/help', job=True)
 def handle_help(message):
     help_text = """
 This bot can perform various operations with PDF files and images.
 
 <b>PDF Operations:</b>
-/mergepdf - Merge multiple PDF files into a single PDF.\n
+/mergepdf - Merge multiple PDF files into a single PDF.
+    While sending them, 'order 3 1 2' reorders the PDFs and 'pages 2 1-5' picks pages of one.\n
 
 /splitpdf - Split a PDF file into individual pages.
-    Reply to a PDF file with the '/splitpdf' command.\n
+    Reply to a PDF file with '/splitpdf [pages] [every=N] [zip]',
+    e.g. '/splitpdf 1-10 every=2 zip' sends one zip of 2-page PDFs.\n
+
+/pdf2image - Convert PDF pages to images.
+    Reply to a PDF file with '/pdf2image [pages] [dpi=N] [png|jpeg|webp] [album]',
+    e.g. '/pdf2image 1-5,8 dpi=150 jpeg album'.
+    Add 'sheet' for a quick preview: small thumbnails tiled into a few images,
+    e.g. '/pdf2image 1-60 sheet gray'.\n
+
+/compresspdf - Shrink a PDF by recompressing its images.
+    Reply to a PDF file with '/compresspdf [small|medium|high]' (default medium).\n
+
+/pdftext - Extract the text of a PDF as a .txt file.
+    Reply to a PDF file with '/pdftext [pages]', e.g. '/pdftext 1-5,8'.\n
+
+/pdfsearch - Find the pages of a PDF containing some words.
+    Reply to a PDF file with '/pdfsearch words [send=pdf]'; 'invoic*' matches
+    any word starting with 'invoic', and 'send=pdf' also sends those pages as a PDF.\n
 
 <b>Image Operations:</b>
 /resizeimage - Resize an image.\n
 
+/batchresize - Resize many images at once.
+    '/batchresize 1280x720 [jpeg|png|webp] [zip]' or '/batchresize 200kb [jpeg|webp|avif] [zip]',
+    then send the images and type 'done'.\n
+
 <b>Image to pdf:</b>
-/image2pdf - convert images to pdf.\n
+/image2pdf - convert images to pdf.
+    Optional presets: '/image2pdf [fit|a4|letter] [original|high|small]'.\n
 
 <b>Archive Operations:</b>
 /unarchive - Unarchive a compressed file (zip, rar, 7z).
+    Reply to an archive with '/unarchive list' to browse it and pick files,
+    or with '/unarchive *.pdf docs/*' to extract only the matching ones.
+
+/archive - Pack files into a zip or 7z archive.
+    '/archive [zip|7z] [name]', then send the files and type 'done'.
+    Archives larger than the upload limit are sent in parts.
 
 """
     bot.reply_to(message, help_text, parse_mode="HTML")
 
 # handle mergerpdf command
-@bot.message_handler(commands=['mergepdf'])
+@router.route('text', '/mergepdf', job=True)
 def handle_mergepdf(message):
-    global pdfs_received, pdfs_received_messages, progress_message, merge_in_progress
-    pdfs_received = []
-    pdfs_received_messages = []
-    progress_message = None
-    merge_in_progress = True
-    bot.reply_to(message, "Please send the PDFs one by one. Send '`DONE`' when finished.", parse_mode="Markdown")
+    # PDFs are recorded as [file_id, size, file_unique_id]; 'order' and 'pages'
+    # hold the input order and per-input page ranges chosen by the user
+    start_flow(message.chat.id, 'mergepdf', {
+        'started': message.date,
+        'pdfs': [],
+        'order': None,
+        'pages': {},
+        'status_message_id': None
+    })
+    bot.reply_to(
+        message,
+        "Please send the PDFs one by one. Send '`DONE`' when finished.\n"
+        "Optionally reorder them with '`order 3 1 2`' or pick pages with '`pages 2 1-5,8`'.",
+        parse_mode="Markdown"
+    )
 
 
-@bot.message_handler(content_types=['document'], func=lambda message: message.document.mime_type == 'application/pdf')
+@router.route('document', 'pdf', state='mergepdf', job=True)
 def handle_pdf(message):
-    global pdfs_received, pdfs_received_messages, progress_message, merge_in_progress
-    if merge_in_progress and message.document.mime_type == 'application/pdf':
+    chat_id = message.chat.id
+    session = get_flow(chat_id, 'mergepdf')
+    if session is not None and message.document.mime_type == 'application/pdf':
         file_size = message.document.file_size
-        if file_size > 5 * 1024 * 1024:
-            bot.reply_to(message, "File size exceeds the limit of 5 MB")
+        if file_size > config.MERGE_MAX_FILE_SIZE:
+            bot.reply_to(message, f"File size exceeds the limit of {format_size(config.MERGE_MAX_FILE_SIZE)}")
             return
 
-        if len(pdfs_received) >= 5:
-            bot.reply_to(message, "Maximum file limit of 5 reached. Please send 'done' to start merging.")
+        if len(session['pdfs']) >= config.MERGE_MAX_FILES:
+            bot.reply_to(message, f"Maximum file limit of {config.MERGE_MAX_FILES} reached. Please send 'done' to start merging.")
+            return
+        if sum(size for _, size, _ in session['pdfs']) + file_size > config.MERGE_MAX_TOTAL_SIZE:
+            bot.reply_to(message, f"The PDFs would add up to more than {format_size(config.MERGE_MAX_TOTAL_SIZE)}. "
+                                  "Please send 'done' to merge the ones received so far.")
+            return
+        if sessions.over_limit(chat_id, 'flow'):
+            bot.reply_to(message, "This merge holds as much as one session may. Please send 'done' to start merging.")
             return
 
-        pdfs_received.append((message.document.file_id, file_size))
-        count = len(pdfs_received)
-        if len(pdfs_received_messages) > 0:
+        # Download and append it in the background right away, so 'done' only has to finalize
+        runtime = merge_runtime(chat_id, session)
+        session['pdfs'].append([message.document.file_id, file_size, message.document.file_unique_id])
+        add_merge_input(runtime, message.document.file_id)
+
+        count = len(session['pdfs'])
+        if session['status_message_id'] is not None:
             try:
-                bot.delete_message(message.chat.id, pdfs_received_messages[-1].message_id)
-                pdfs_received_messages.pop()
+                bot.delete_message(chat_id, session['status_message_id'])
             except telebot.apihelper.ApiTelegramException:
                 pass
-        pdfs_received_messages.append(bot.reply_to(message, f"{count} PDFs received so far. Please send '`DONE`' when finished.", parse_mode="Markdown"))
+        status_message = bot.reply_to(message, f"{count} PDFs received so far. Please send '`DONE`' when finished.", parse_mode="Markdown")
+        session['status_message_id'] = status_message.message_id
+        sessions.put(chat_id, 'flow', session)
 
-@bot.message_handler(func=lambda message: message.text.lower() == 'done')
-def handle_merge(message):
-    global pdfs_received, pdfs_received_messages, progress_message, merge_in_progress
-    if merge_in_progress:
-        merge_in_progress = False
-        merger = PdfMerger()
 
-        if len(pdfs_received) == 0:
-            bot.reply_to(message, "No PDFs received. Send the PDFs first.")
-            return
+# The merger and pending downloads of a merge session. They only exist in this
+# process, so they are rebuilt from the file_ids in the record when needed.
+def merge_runtime(chat_id, session):
+    runtime = sessions.runtime(chat_id, 'flow')
+    if runtime.get('started') != session.get('started') or 'merger' not in runtime:
+        release_session(runtime)
+        runtime.clear()
+        runtime['started'] = session.get('started')
+        runtime['merger'] = pdftools.PdfMerger()
+        runtime['pages'] = []
+    for file_id, _, _ in session['pdfs'][len(runtime['pages']):]:
+        add_merge_input(runtime, file_id)
+    return runtime
 
-        total_size = sum(size for _, size in pdfs_received)
-        if total_size > 15 * 1024 * 1024:
-            bot.reply_to(message, "Total file size exceeds the limit of 15 MB. Please send smaller PDFs.")
-            return
 
-        for msg in pdfs_received_messages:
-            try:
-                bot.delete_message(message.chat.id, msg.message_id)
-            except telebot.apihelper.ApiTelegramException:
-                pass
+def add_merge_input(runtime, file_id):
+    index = len(runtime['pages'])
+    runtime['pages'].append(downloader.submit(fetch_merge_input, runtime['merger'], index, file_id))
 
-        progress_message = bot.reply_to(message, "Merging in progress...")
 
-        for index, (file_id, _) in enumerate(pdfs_received):
-            file_info = bot.get_file(file_id)
-            downloaded_file = bot.download_file(file_info.file_path)
-            file_path = os.path.join('merged_pdfs', f"file_{index}.pdf")
+# Local server files are opened where they are, others are merged from memory
+def fetch_merge_input(merger, index, file_id):
+    merger.add(index, download_source(file_id))
 
-            with open(file_path, 'wb') as f:
-                f.write(downloaded_file)
 
-            merger.append(file_path)
+# 'order 3 1 2' and 'pages 2 1-5,8' while PDFs are being collected
+@router.route('text', state='mergepdf', job=True)
+def handle_merge_option(message):
+    chat_id = message.chat.id
+    session = get_flow(chat_id, 'mergepdf')
+    if session is None:
+        return
+    args = message.text.lower().split()
+    count = len(session['pdfs'])
+    try:
+        if args[0] == 'order' and len(args) > 1:
+            session['order'] = [merge_input_index(number, count) for number in ' '.join(args[1:]).replace(',', ' ').split()]
+            reply = "Merge order set: " + ', '.join(str(index + 1) for index in session['order']) + "."
+        elif args[0] == 'pages' and len(args) == 3:
+            index = merge_input_index(args[1], count)
+            # Only the syntax is checked here, the page numbers are checked against the PDF at 'done'
+            if not PAGE_RANGES.fullmatch(args[2]):
+                raise ValueError(f"Invalid page range '{args[2]}'.")
+            session['pages'][str(index)] = args[2]
+            reply = f"Pages {args[2]} of PDF {index + 1} will be merged."
+        else:
+            bot.reply_to(message, "Send more PDFs, '`order 3 1 2`', '`pages 2 1-5,8`' or '`DONE`'.", parse_mode="Markdown")
+            return
+    except ValueError as e:
+        bot.reply_to(message, f"Error: {e}")
+        return
+    sessions.put(chat_id, 'flow', session)
+    bot.reply_to(message, reply)
 
-        merged_file_path = get_unique_file_path('merged_pdfs/merged.pdf')
-        merger.write(merged_file_path)
-        merger.close()
 
-        try:
-            with open(merged_file_path, 'rb') as f:
-                bot.send_document(message.chat.id, f)
+PAGE_RANGES = re.compile(r'(\d+|\d*-\d*)(,(\d+|\d*-\d*))*')
 
-            merged_count = len(pdfs_received)
-            bot.reply_to(message, f"Merging completed. {merged_count} PDFs merged.")
 
-        except Exception as e:
-            bot.reply_to(message, "Failed to send the merged PDF.")
+def merge_input_index(number, count):
+    if not number.isdigit() or not 1 <= int(number) <= count:
+        raise ValueError(f"PDF numbers go from 1 to {count}.")
+    return int(number) - 1
 
-        for index in range(len(pdfs_received)):
-            file_path = os.path.join('merged_pdfs', f"file_{index}.pdf")
-            if os.path.exists(file_path):
-                os.remove(file_path)
 
-        if os.path.exists(merged_file_path):
-            os.remove(merged_file_path)
+@router.route('text', 'done', job=True)
+def handle_merge(message):
+    chat_id = message.chat.id
+    session = get_flow(chat_id, 'mergepdf')
+    if session is None:
+        bot.reply_to(message, "Invalid command. Send '/help' for more information.")
+        return
 
+    pdfs_received = session['pdfs']
+    if len(pdfs_received) == 0:
+        sessions.end(chat_id, 'flow')
+        bot.reply_to(message, "No PDFs received. Send the PDFs first.")
+        return
+
+    total_size = sum(size for _, size, _ in pdfs_received)
+    if total_size > config.MERGE_MAX_TOTAL_SIZE:
+        sessions.end(chat_id, 'flow')
+        bot.reply_to(message, f"Total file size exceeds the limit of {format_size(config.MERGE_MAX_TOTAL_SIZE)}. Please send smaller PDFs.")
+        return
+
+    if session['status_message_id'] is not None:
         try:
-            bot.delete_message(message.chat.id, progress_message.message_id)
+            bot.delete_message(chat_id, session['status_message_id'])
         except telebot.apihelper.ApiTelegramException:
             pass
 
-        pdfs_received = []
-        pdfs_received_messages = []
+    progress_message = bot.reply_to(message, "Merging in progress...")
 
-        # Remove the 'merged_pdfs' directory
-        shutil.rmtree('merged_pdfs')
+    # The same PDFs in the same order with the same pages give the same merged file
+    order = session.get('order') or list(range(len(pdfs_received)))
+    page_ranges = session.get('pages', {})
+    merge_key = ','.join(
+        pdfs_received[index][2] + (f"[{page_ranges[str(index)]}]" if str(index) in page_ranges else '')
+        for index in order
+    )
+    cached = result_cache.get(merge_key, 'mergepdf')
 
-    else:
-        bot.reply_to(message, "Invalid command. Send '/help' for more information.")
+    try:
+        if cached:
+            send_cached(chat_id, cached)
+        else:
+            runtime = merge_runtime(chat_id, session)
+            merger = runtime['merger']
+            with metrics.tracer.trace('processing'):  # Includes waiting for the inputs still downloading
+                for number, future in enumerate(runtime['pages'], 1):
+                    try:
+                        future.result()
+                    except Exception:
+                        raise ValueError(f"PDF {number} could not be read.")
+                merger.finish([
+                    (index, pdftools.parse_page_ranges(page_ranges[str(index)], merger.page_count(index))
+                     if str(index) in page_ranges else None)
+                    for index in order
+                ])
+            if total_size <= config.MERGE_MEMORY_BUDGET // 3:
+                sent = bot.send_document(chat_id, named_buffer(merger.tobytes(), 'merged.pdf'))
+            else:
+                # Too big to hold the output as well, write it to disk and upload from there
+                with Workspace('merge', size_hint=total_size) as ws:
+                    sent = send_file(bot, chat_id, merger.save(ws.path('merged.pdf')))
+            result_cache.put(merge_key, 'mergepdf', None, [output_of(sent)])
+
+        bot.reply_to(message, f"Merging completed. {len(order)} PDFs merged.")
+
+    except ValueError as e:
+        bot.reply_to(message, f"Error: {e}")
+    except Exception as e:
+        bot.reply_to(message, "Failed to send the merged PDF.")
+    finally:
+        sessions.end(chat_id, 'flow')
 
-def get_unique_file_path(file_path):
-    base_dir = os.path.dirname(file_path)
-    base_name, ext = os.path.splitext(os.path.basename(file_path))
-    suffix = 1
-    while os.path.exists(file_path):
-        file_path = os.path.join(base_dir, f"{base_name}_{suffix}{ext}")
-        suffix += 1
-    return file_path
+    try:
+        bot.delete_message(chat_id, progress_message.message_id)
+    except telebot.apihelper.ApiTelegramException:
+        pass
 
 
-if not os.path.exists('merged_pdfs'):
-    os.makedirs('merged_pdfs')
+# A Telegram file as bytes, or as the local Bot API server's path to it
+def download_source(file_id):
+    file_info = bot.get_file(file_id)
+    return downloader.fetch_source(file_info.file_path)
+
+
+# Stream a Telegram file to disk without holding it in memory. Returns the
+# path to use, which is the local Bot API server's copy if there is one.
+def download_to(file_id, target_path):
+    file_info = bot.get_file(file_id)
+    return downloader.fetch_path(file_info.file_path, target_path)
 
 
-# Directory for operations
-WORK_DIR = "PDF2IMG"
-os.makedirs(WORK_DIR, exist_ok=True)
+# In-memory file with a name, so it can be uploaded like a file on disk
+def named_buffer(data, name):
+    buffer = BytesIO(data)
+    buffer.name = name
+    return buffer
 
-@bot.message_handler(commands=['pdf2image'])
+
+# Re-send outputs from the result cache by file_id, without downloading or computing anything
+def send_cached(chat_id, outputs, album=True):
+    outbox = Outbox(bot, chat_id, album=album)
+    current_dir = ''
+    for output in outputs:
+        if output.get('dir', '') != current_dir:
+            current_dir = output['dir']
+            outbox.add_text(directory_header(current_dir))
+        outbox.add_output(output)
+    outbox.flush()
+
+
+def directory_header(directory):
+    return f"Files in {directory or 'the archive root'}:"
+
+
+def format_size(size):
+    if size >= 1024 * 1024:
+        return f"{size / (1024 * 1024):g} MB"
+    return f"{size / 1024:g} KB"
+
+
+@router.route('text', '/pdf2image', job=True)
 def pdf2image_command(message: Message):
     if message.reply_to_message and message.reply_to_message.document:
-        file_info = bot.get_file(message.reply_to_message.document.file_id)
-        file_path = file_info.file_path
-        file_extension = message.reply_to_message.document.file_name.split('.')[-1].lower()
+        document = message.reply_to_message.document
+        file_extension = document.file_name.split('.')[-1].lower()
 
         if file_extension != 'pdf':
             bot.reply_to(message, "The file you replied to is not a PDF. Please reply to a valid PDF file.")
             return
 
-        # Download the PDF file into the working directory
-        file_name = os.path.join(WORK_DIR, f"{message.reply_to_message.document.file_id}.pdf")
-        downloaded_file = bot.download_file(file_path)
-        with open(file_name, 'wb') as pdf_file:
-            pdf_file.write(downloaded_file)
-
-        bot.reply_to(message, "Converting PDF to images. Please wait...")
-
         try:
-            # Open the PDF using PyMuPDF
-            pdf_document = fitz.open(file_name)
-            image_files = []
-
-            for page_number in range(len(pdf_document)):
-                page = pdf_document[page_number]
-
-                # Use a very high DPI for rendering to closely match the original quality
-                zoom_x = 4  # Horizontal zoom (higher = better quality)
-                zoom_y = 4  # Vertical zoom
-                matrix = fitz.Matrix(zoom_x, zoom_y)
-                pix = page.get_pixmap(matrix=matrix)
+            options = parse_pdf2image_options(message.text)
+        except ValueError as e:
+            bot.reply_to(message, f"Error: {e}")
+            return
 
-                image_file_name = os.path.join(WORK_DIR, f"page_{page_number + 1}.png")
-                pix.save(image_file_name)
-                image_files.append(image_file_name)
+        cached = result_cache.get(document.file_unique_id, 'pdf2image', options)
+        if cached:
+            send_cached(message.chat.id, cached, album=options['album'] or options['sheet'])
+            bot.reply_to(message, pdf2image_summary(options, cached))
+            return
 
-            pdf_document.close()
+        # The workspace and everything rendered into it is removed when the job ends
+        with Workspace('pdf2image') as ws:
+            # Download the PDF file into the working directory
+            file_name = download_to(document.file_id, ws.path('input.pdf'))
 
-            # Send images back as documents
-            for image_file in image_files:
-                with open(image_file, 'rb') as img:
-                    bot.send_document(message.chat.id, img)
+            bot.reply_to(message, "Converting PDF to images. Please wait...")
 
-            bot.reply_to(message, f"Conversion completed! {len(image_files)} pages sent as documents.")
+            try:
+                total_pages = scheduler.run_cpu(pdftools.page_count, file_name)
+                if options['pages']:
+                    page_numbers = pdftools.parse_page_ranges(options['pages'], total_pages)
+                else:
+                    page_numbers = range(total_pages)
+
+                if options['sheet']:
+                    outputs = send_contact_sheets(message.chat.id, ws, file_name, page_numbers, options)
+                else:
+                    outputs = stream_pdf_pages(message.chat.id, ws, file_name, page_numbers, options)
+                result_cache.put(document.file_unique_id, 'pdf2image', options, outputs)
+
+                bot.reply_to(message, pdf2image_summary(options, outputs))
+
+            except Exception as e:
+                bot.reply_to(message, f"An error occurred: {str(e)}")
+    else:
+        bot.reply_to(message, "Please reply to an already uploaded PDF file with this command.")
+
+
+# Parse '/pdf2image [pages] [dpi=N] [png|jpeg|webp] [album] [sheet] [gray]'
+def parse_pdf2image_options(text):
+    options = {'pages': None, 'dpi': config.PDF2IMAGE_DPI, 'format': 'png', 'album': False, 'sheet': False, 'gray': False}
+    for arg in text.split()[1:]:
+        arg = arg.lower()
+        if arg.startswith('dpi='):
+            options['dpi'] = int(arg[4:])
+            if not 1 <= options['dpi'] <= config.PDF2IMAGE_MAX_DPI:
+                raise ValueError(f"DPI must be between 1 and {config.PDF2IMAGE_MAX_DPI}.")
+        elif arg.lstrip('.') in pdftools.IMAGE_FORMATS:
+            options['format'] = pdftools.IMAGE_FORMATS[arg.lstrip('.')]
+        elif arg in ('album', 'sheet', 'gray'):
+            options[arg] = True
+        elif arg[0].isdigit() or arg[0] == '-':
+            options['pages'] = arg
+        else:
+            raise ValueError(f"Unknown option '{arg}'.")
+    return options
+
+
+# Render pages in the process pool and upload each one as soon as it is ready.
+# At most PDF2IMAGE_WINDOW pages are rendered ahead of the upload, which bounds
+# both memory and scratch disk use regardless of the page count.
+def stream_pdf_pages(chat_id, ws, pdf_path, page_numbers, options):
+    extension = 'jpg' if options['format'] == 'jpeg' else options['format']
+    page_iter = iter(page_numbers)
+    pending = deque()
+    outbox = Outbox(bot, chat_id, album=options['album'])
+
+    def render_ahead():
+        while len(pending) < config.PDF2IMAGE_WINDOW:
+            page_number = next(page_iter, None)
+            if page_number is None:
+                return
+            image_path = ws.path(f"page_{page_number + 1}.{extension}")
+            pending.append(scheduler.submit_cpu(
+                pdftools.render_page, pdf_path, page_number, options['dpi'], options['format'], image_path, options['gray']
+            ))
 
-        except Exception as e:
-            bot.reply_to(message, f"An error occurred: {str(e)}")
+    try:
+        render_ahead()
+        while pending:
+            image_file = pending.popleft().result()
+            render_ahead()
+            outbox.add_file(image_file, remove=True)
+        return outbox.flush()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+# Render low-resolution thumbnails of the selected pages in parallel and tile
+# them into contact sheets of PDF2IMAGE_SHEET_COLUMNS x PDF2IMAGE_SHEET_ROWS
+# pages, sent as photo albums. Only the next sheet is rendered ahead of the one
+# being tiled, so a long page range never piles up in memory.
+def send_contact_sheets(chat_id, ws, pdf_path, page_numbers, options):
+    columns = config.PDF2IMAGE_SHEET_COLUMNS
+    per_sheet = columns * config.PDF2IMAGE_SHEET_ROWS
+    batch_size = -(-per_sheet // config.CPU_WORKERS)
+    cell_size = (config.PDF2IMAGE_THUMB_WIDTH, round(config.PDF2IMAGE_THUMB_WIDTH * 1.414))
+    page_iter = iter(page_numbers)
+    pending = deque()  # Thumbnail batches of the sheets being rendered
+    outbox = Outbox(bot, chat_id)
+
+    def render_ahead():
+        while len(pending) < 2:
+            pages = list(islice(page_iter, per_sheet))
+            if not pages:
+                return
+            pending.append([
+                scheduler.submit_cpu(pdftools.render_thumbnails, pdf_path, pages[start:start + batch_size], cell_size, options['gray'])
+                for start in range(0, len(pages), batch_size)
+            ])
 
-        finally:
-            # Cleanup temporary files
-            for file in os.listdir(WORK_DIR):
-                file_path = os.path.join(WORK_DIR, file)
-                if os.path.exists(file_path):
-                    os.remove(file_path)
+    try:
+        render_ahead()
+        while pending:
+            thumbnails = [thumbnail for future in pending.popleft() for thumbnail in future.result()]
+            render_ahead()
+            sheet_path = ws.path(f"pages_{thumbnails[0][0] + 1}-{thumbnails[-1][0] + 1}.jpg")
+            scheduler.run_cpu(pdftools.tile_contact_sheet, thumbnails, columns, cell_size, sheet_path, options['gray'])
+            outbox.add_file(sheet_path, kind='photo', remove=True)
+        return outbox.flush()
+    finally:
+        for futures in pending:
+            for future in futures:
+                future.cancel()
+
+
+def pdf2image_summary(options, outputs):
+    if options['sheet']:
+        return f"Preview completed! {len(outputs)} contact sheet{'s' if len(outputs) != 1 else ''} sent."
+    return f"Conversion completed! {len(outputs)} pages sent as {options['format'].upper()} documents."
+
+
+# Define a handler for the /unarchive command.
+# As a reply to an archive: '/unarchive' extracts everything, '/unarchive list'
+# shows the files to pick from and '/unarchive *.pdf docs/*' extracts the matching ones.
+@router.route('text', '/unarchive', job=True)
+def handle_unarchive_command(message):
+    replied = message.reply_to_message
+    document = replied.document if replied is not None else None
+    if document is None or not archives.is_archive(document.file_name):
+        bot.reply_to(message, "Please upload a .zip, .rar, or .7z file to unarchive.\n"
+                              "Reply to one with '/unarchive list' to pick files, or '/unarchive *.pdf' to extract only matching ones.")
+        return
+    args = message.text.split()[1:]
+    if [arg.lower() for arg in args] == ['list']:
+        show_listing(message, archive_record(document))
     else:
-        bot.reply_to(message, "Please reply to an already uploaded PDF file with this command.")    
-    
+        unarchive(message, archive_record(document), patterns=args or None)
+
 
-# Define a handler for the /unarchive command
-@bot.message_handler(commands=['unarchive'])
-def handle_unarchive_command(message):
-    bot.reply_to(message, "Please upload a .zip, .rar, or .7z file to unarchive.")
 # Define a handler for messages containing documents
-@bot.message_handler(content_types=['document'], func=lambda message: message.document.mime_type != 'application/pdf')
+@router.route('document', job=True)
 def handle_document(message):
     file_name = message.document.file_name
     if file_name.endswith('.zip') or file_name.endswith('.rar') or file_name.endswith('.7z'):
+        unarchive(message, archive_record(message.document))
+
+
+# What the listing session and the extraction need to know about an archive
+def archive_record(document):
+    return {'file_id': document.file_id, 'file_unique_id': document.file_unique_id, 'file_name': document.file_name}
+
+
+# Extract the archive and send the files, all of them or only the members
+# matching `patterns` (globs) or named in `members`
+def unarchive(message, archive, patterns=None, members=None):
+    chat_id = message.chat.id
+    file_name = archive['file_name']
+    params = {'patterns': patterns} if patterns else {'members': members} if members else None
+    cached = result_cache.get(archive['file_unique_id'], 'unarchive', params)
+    if cached:
+        send_cached(chat_id, cached)
+        bot.send_message(chat_id, f"Extraction complete. {len(cached)} files sent.")
+        return
+
+    # The downloaded archive and the extracted files are removed with the workspace
+    with Workspace('unarchive') as ws:
         try:
             # Send acknowledgment message
-            bot.send_message(message.chat.id, "File received. Extracting...")
-
-            # Download the document (compressed file)
-            file_info = bot.get_file(message.document.file_id)
-            downloaded_file = bot.download_file(file_info.file_path)
-
-            # Save the downloaded file
-            with open(file_name, 'wb') as new_file:
-                new_file.write(downloaded_file)
-
-            # Determine the type of compressed file and extract accordingly
-            if file_name.endswith('.zip'):
-                destination_dir = os.path.join(os.getcwd(), 'extracted_files_zip')
-                os.makedirs(destination_dir, exist_ok=True)
-                unzip_file(file_name, destination_dir)
-            elif file_name.endswith('.rar'):
-                destination_dir = os.path.join(os.getcwd(), 'extracted_files_rar')
-                os.makedirs(destination_dir, exist_ok=True)
-                unrar_file(file_name, destination_dir)
-            elif file_name.endswith('.7z'):
-                destination_dir = os.path.join(os.getcwd(), 'extracted_files_7z')
-                os.makedirs(destination_dir, exist_ok=True)
-                un7z_file(file_name, destination_dir)
-
-            # Iterate over subdirectories and send files sequentially
-            for subdir, _, _ in os.walk(destination_dir):
-                if subdir != destination_dir:
-                    bot.send_message(
-                        message.chat.id,
-                        f"Files in {os.path.relpath(subdir, destination_dir)}:")
-                    send_files_in_directory(bot, message.chat.id, subdir)
+            bot.send_message(chat_id, "File received. Extracting...")
+
+            # Download the document (compressed file), never trusting the user supplied name as a path
+            archive_path = download_to(archive['file_id'], ws.path('archive' + os.path.splitext(file_name)[1]))
+
+            selected = set(members) if members else None
+            if patterns:
+                selected = archives.select_members(archive_listing(archive, archive_path), patterns)
+                if not selected:
+                    bot.reply_to(message, f"No files in the archive match {' '.join(patterns)}.")
+                    return
+
+            # Extract member by member within the size/entry/ratio budget and
+            # send every file as soon as it is out, including top-level ones
+            budget = archives.ExtractionBudget(
+                config.UNARCHIVE_MAX_BYTES, config.UNARCHIVE_MAX_ENTRIES, config.UNARCHIVE_MAX_RATIO
+            )
+            current_dir = ''
+            outbox = Outbox(bot, chat_id)
+            for relative_path, extracted_path in archives.extract_members(
+                archive_path, file_name, ws.path('extracted'), budget, selected
+            ):
+                member_dir = os.path.dirname(relative_path)
+                if member_dir != current_dir:
+                    current_dir = member_dir
+                    outbox.add_text(directory_header(member_dir))
+                outbox.add_file(extracted_path, remove=True, dir=member_dir)
+            outputs = outbox.flush()
+            result_cache.put(archive['file_unique_id'], 'unarchive', params, outputs)
 
             # Send completion message
-            bot.send_message(message.chat.id, "Extraction complete.")
-
-            # Clean up: delete the downloaded and extracted files
-            os.remove(file_name)
-            shutil.rmtree(destination_dir)
+            bot.send_message(chat_id, f"Extraction complete. {len(outputs)} files sent.")
 
+        except archives.ExtractionLimitExceeded as e:
+            hint = "" if selected else "\nReply to the archive with '/unarchive list' to pick the files you need."
+            bot.reply_to(message, f"Error: {e}{hint}")
         except ValueError as e:
             bot.reply_to(message, f"Error: {e}")
         except Exception as e:
             bot.reply_to(message, f"An error occurred: {e}")
-            os.remove(file_name)  # Clean up: delete the downloaded file
 
-# Function to handle unzip operation
-def unzip_file(file_path, destination_dir):
-    try:
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            zip_ref.extractall(destination_dir)
-    except zipfile.BadZipFile:
-        os.remove(file_path)
-        raise ValueError("The provided ZIP file is corrupted.")
+
+# The archive's [name, size] file list, read from its headers once per
+# file_unique_id. The archive is downloaded when no path is given.
+def archive_listing(archive, archive_path=None):
+    listing = listing_cache.get(archive['file_unique_id'], 'listing')
+    if listing is not None:
+        return listing
+    if archive_path is None:
+        with Workspace('listing') as ws:
+            archive_path = download_to(archive['file_id'], ws.path('archive' + os.path.splitext(archive['file_name'])[1]))
+            listing = archives.list_members(archive_path, archive['file_name'])
+    else:
+        listing = archives.list_members(archive_path, archive['file_name'])
+    listing_cache.put(archive['file_unique_id'], 'listing', None, listing)
+    return listing
+
+
+LISTING_PAGE_SIZE = 10
 
 
-# Function to handle unrar operation
-def unrar_file(file_path, destination_dir):
+# Show the first page of the archive's files; the chat's 'listing' session
+# remembers which archive the buttons of that message belong to
+def show_listing(message, archive):
+    chat_id = message.chat.id
     try:
-        with rarfile.RarFile(file_path, 'r') as rar_ref:
-            rar_ref.extractall(destination_dir)
-    except rarfile.BadRarFile:
-        os.remove(file_path)
-        raise ValueError("The provided RAR file is corrupted.")
+        listing = archive_listing(archive)
+    except ValueError as e:
+        bot.reply_to(message, f"Error: {e}")
+        return
+    if not listing:
+        bot.reply_to(message, "The archive has no files.")
+        return
+    text, markup = listing_page(archive, listing, 0)
+    sent = bot.send_message(chat_id, text, reply_markup=markup)
+    sessions.put(chat_id, 'listing', dict(archive, message_id=sent.message_id))
 
 
-# Function to handle un7z operation
-def un7z_file(file_path, destination_dir):
+def listing_page(archive, listing, page):
+    pages = -(-len(listing) // LISTING_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    start = page * LISTING_PAGE_SIZE
+    lines = [f"{archive['file_name']}: {len(listing)} files, page {page + 1}/{pages}", ""]
+    markup = telebot.types.InlineKeyboardMarkup()
+    for index, (name, size) in enumerate(listing[start:start + LISTING_PAGE_SIZE], start):
+        lines.append(f"{index + 1}. {name} ({format_size(size)})")
+        label = name.rsplit('/', 1)[-1]
+        if len(label) > 40:
+            label = label[:37] + '...'
+        markup.row(telebot.types.InlineKeyboardButton(f"{index + 1}. {label}", callback_data=f"unarchive:file:{index}"))
+    navigation = []
+    if page > 0:
+        navigation.append(telebot.types.InlineKeyboardButton('« Previous', callback_data=f"unarchive:page:{page - 1}"))
+    if page < pages - 1:
+        navigation.append(telebot.types.InlineKeyboardButton('Next »', callback_data=f"unarchive:page:{page + 1}"))
+    if navigation:
+        markup.row(*navigation)
+    lines.append("")
+    lines.append("Tap a file to extract it, or reply to the archive with '/unarchive *.pdf' for all matching files.")
+    return '\n'.join(lines), markup
+
+
+# Page buttons edit the listing in place, file buttons extract that one member
+def handle_listing_callback(call):
+    chat_id = call.message.chat.id
+    archive = sessions.get(chat_id, 'listing')
+    if archive is None or archive['message_id'] != call.message.message_id:
+        bot.answer_callback_query(call.id, "This listing has expired. Reply to the archive with '/unarchive list' again.")
+        return
+    _, action, value = call.data.split(':')
     try:
-        with py7zr.SevenZipFile(file_path, mode='r') as archive:
-            archive.extractall(destination_dir)
-    except py7zr.exceptions.Bad7zFile:
-        os.remove(file_path)
-        raise ValueError("The provided 7z file is corrupted.")
+        listing = archive_listing(archive)
+    except ValueError as e:
+        bot.answer_callback_query(call.id, str(e))
+        return
+    if action == 'page':
+        bot.answer_callback_query(call.id)
+        text, markup = listing_page(archive, listing, int(value))
+        try:
+            bot.edit_message_text(text, chat_id, call.message.message_id, reply_markup=markup)
+        except telebot.apihelper.ApiTelegramException:
+            pass  # Tapped twice, the message is already showing that page
+    elif action == 'file' and int(value) < len(listing):
+        name = listing[int(value)][0]
+        bot.answer_callback_query(call.id, f"Extracting {name.rsplit('/', 1)[-1]}")
+        sessions.put(chat_id, 'listing', archive)  # Keeps the listing alive while it is being used
+        unarchive(call.message, archive, members=[name])
 
 
 # Function to send file to the user
 def send_file(bot, chat_id, file_path):
+    if Outbox.local_uploads:
+        return bot.send_document(chat_id, local_upload(file_path))
     with open(file_path, 'rb') as file:
-        bot.send_document(chat_id, file)
+        return bot.send_document(chat_id, file)
 
 
-# Function to send files in a directory to the user
-def send_files_in_directory(bot, chat_id, directory_path):
-    files = [
-        f for f in os.listdir(directory_path)
-        if os.path.isfile(os.path.join(directory_path, f))
-    ]
-    for file in files:
-        send_file(bot, chat_id, os.path.join(directory_path, file))
+# handle archive command: '/archive [zip|7z] [name]', then send the files and 'done'
+@router.route('text', '/archive', job=True)
+def start_archive(message):
+    archive_format, name = 'zip', 'archive'
+    for arg in message.text.split()[1:]:
+        if arg.lower().lstrip('.') in archives.ARCHIVE_FORMATS:
+            archive_format = arg.lower().lstrip('.')
+        else:
+            name = safe_file_name(arg, name)
+    # Files are recorded as [file_id, member name, size], in the order they were sent
+    start_flow(message.chat.id, 'archive', {
+        'started': message.date,
+        'format': archive_format,
+        'name': name,
+        'files': [],
+        'status_message_id': None
+    })
+    bot.reply_to(message, f"Send the files to put in {name}.{archive_format}.\nWhen you're done, type '`done`'.", parse_mode='Markdown')
+
+
+# A file name without any directory part
+def safe_file_name(name, default):
+    name = os.path.basename((name or '').replace('\\', '/')).strip()
+    return name if name not in ('', '.', '..') else default
+
+
+@router.route('document', state='archive', job=True)
+@router.route('document', 'pdf', state='archive', job=True)
+@router.route('document', 'image', state='archive', job=True)
+def handle_archive_file(message):
+    chat_id = message.chat.id
+    session = get_flow(chat_id, 'archive')
+    if session is None:
+        return
+    document = message.document
+    if len(session['files']) >= config.ARCHIVE_MAX_FILES:
+        bot.reply_to(message, f"Maximum of {config.ARCHIVE_MAX_FILES} files reached. Please send 'done' to create the archive.")
+        return
+    if document.file_size > config.MAX_FILE_SIZE:
+        bot.reply_to(message, f"Sorry, the maximum file size allowed is {format_size(config.MAX_FILE_SIZE)}.")
+        return
+    if sum(size for _, _, size in session['files']) + document.file_size > config.ARCHIVE_MAX_TOTAL_SIZE:
+        bot.reply_to(message, f"The files would add up to more than {format_size(config.ARCHIVE_MAX_TOTAL_SIZE)}. Please send 'done' to create the archive.")
+        return
+
+    # Two files with the same name become 'name.pdf' and 'name (2).pdf'
+    name = safe_file_name(document.file_name, f"file_{len(session['files']) + 1}")
+    names = {member_name for _, member_name, _ in session['files']}
+    stem, extension = os.path.splitext(name)
+    copy = 1
+    while name in names:
+        copy += 1
+        name = f"{stem} ({copy}){extension}"
+
+    # Download it in the background right away, so 'done' only has to compress
+    runtime = archive_runtime(chat_id, session)
+    session['files'].append([document.file_id, name, document.file_size])
+    add_archive_file(runtime, document.file_id)
+
+    text = f"{len(session['files'])} files received. Send more or type '`done`'."
+    if session['status_message_id'] is not None:
+        try:
+            bot.edit_message_text(text, chat_id, session['status_message_id'], parse_mode='Markdown')
+        except telebot.apihelper.ApiTelegramException:
+            session['status_message_id'] = None
+    if session['status_message_id'] is None:
+        session['status_message_id'] = bot.send_message(chat_id, text, parse_mode='Markdown').message_id
+    sessions.put(chat_id, 'flow', session)
+
+
+# The workspace and pending downloads of an archive session, rebuilt from
+# the file_ids in the record when this process doesn't have them
+def archive_runtime(chat_id, session):
+    runtime = sessions.runtime(chat_id, 'flow')
+    if runtime.get('started') != session['started']:
+        release_session(runtime)
+        runtime.clear()
+        runtime['started'] = session['started']
+        runtime['workspace'] = Workspace('archive').open()
+        runtime['pages'] = []
+    for file_id, _, _ in session['files'][len(runtime['pages']):]:
+        add_archive_file(runtime, file_id)
+    return runtime
+
+
+def add_archive_file(runtime, file_id):
+    input_path = runtime['workspace'].path('inputs', str(len(runtime['pages'])))
+    runtime['pages'].append(downloader.submit(download_to, file_id, input_path))
+
+
+# Compress the files in the order they were sent, straight into volumes of at
+# most ARCHIVE_VOLUME_SIZE bytes. Each volume is uploaded as soon as it is
+# full and then removed, while the next one is being written.
+@router.route('text', 'done', state='archive', job=True)
+def finish_archive(message):
+    chat_id = message.chat.id
+    session = get_flow(chat_id, 'archive')
+    if session is None:
+        return
+    if not session['files']:
+        bot.reply_to(message, "You haven't sent any files yet.")
+        return
 
+    runtime = archive_runtime(chat_id, session)
+    ws = runtime['workspace']
+    archive_name = f"{session['name']}.{session['format']}"
+    bot.send_message(chat_id, f"Creating {archive_name} from {len(session['files'])} files...")
+    volumes = []
 
+    def send_volume(path):
+        send_file(bot, chat_id, path)
+        os.remove(path)
+        volumes.append(path)
+
+    try:
+        names = [name for _, name, _ in session['files']]
+        with archives.VolumeWriter(ws.path('output', archive_name), config.ARCHIVE_VOLUME_SIZE, send_volume,
+                                   hold_first=session['format'] == '7z') as output:
+            writer = archives.create_archive(session['format'], output, names, threads=config.ARCHIVE_THREADS)
+            for future, name in zip(runtime['pages'], names):
+                input_path = future.result()
+                writer.add(input_path, name)
+                if input_path.startswith(ws.directory):
+                    os.remove(input_path)  # Local Bot API server files are only read
+            writer.close()
+            output.finish()
+    except Exception as e:
+        bot.reply_to(message, f"An error occurred: {e}")
+        return
+    finally:
+        sessions.end(chat_id, 'flow')
+
+    if len(volumes) > 1:
+        # 7z parts are sent with the first one last, so name it rather than the first one sent
+        bot.send_message(chat_id, f"Archive created: {len(names)} files in {len(volumes)} parts. "
+                                  f"Open {os.path.basename(output.volume_path(0))} with 7-Zip, or join the parts with cat first.")
+    else:
+        bot.send_message(chat_id, f"Archive created: {len(names)} files.")
 
 
 # handle splitpdf command
-@bot.message_handler(commands=['splitpdf'])
+@router.route('text', '/splitpdf', job=True)
 def handle_split_pdf(message):
     chat_id = message.chat.id
 
@@ -361,92 +978,357 @@ def handle_split_pdf(message):
         bot.send_message(chat_id, "Invalid file format. Please send a PDF file.")
         return
 
-    if file_size > 20000000:  # 20 MB
-        bot.send_message(chat_id, "Sorry, the maximum file size allowed is 20 MB.")
+    if file_size > config.MAX_FILE_SIZE:
+        bot.send_message(chat_id, f"Sorry, the maximum file size allowed is {format_size(config.MAX_FILE_SIZE)}.")
         return
 
-    if chat_id in processing_status and processing_status[chat_id]:
+    if sessions.get(chat_id, 'splitpdf') is not None:
         bot.send_message(chat_id, "Sorry, another PDF file is currently being processed. Please wait for the current process to complete.")
         return
 
-    # Set the processing status for the current chat to True
-    processing_status[chat_id] = True
+    try:
+        options = parse_split_options(message.text)
+    except ValueError as e:
+        bot.send_message(chat_id, f"Error: {e}")
+        return
+
+    cached = result_cache.get(replied_document.file_unique_id, 'splitpdf', options)
+    if cached:
+        send_cached(chat_id, cached)
+        bot.send_message(chat_id, "Splitting process completed.")
+        return
+
+    # Mark the chat as busy; the marker expires with the session TTL should the bot die mid-split
+    sessions.put(chat_id, 'splitpdf', {'file_unique_id': replied_document.file_unique_id})
 
     bot.send_message(chat_id, "PDF file received. Splitting process started...")
 
-    # Download the PDF file
-    file_info = bot.get_file(file_id)
-    file_path = file_info.file_path
-    downloaded_file = bot.download_file(file_path)
+    try:
+        with Workspace('split', size_hint=2 * file_size) as ws:
+            # Download the PDF file
+            pdf_path = download_to(file_id, ws.path('input.pdf'))
+
+            # Split the PDF lazily, only one output part is in memory at a time
+            parts = split_pdf_pages(pdf_path, options['pages'], options['every'])
+
+            if options['zip']:
+                # Bundle all parts into a single upload
+                zip_path = ws.path(os.path.splitext(os.path.basename(file_name))[0] + '_pages.zip')
+                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zip_file:
+                    for part_name, part_data in parts:
+                        zip_file.writestr(part_name, part_data)
+                outputs = [output_of(send_file(bot, chat_id, zip_path))]
+            else:
+                # Send the parts in albums of up to 10 files
+                outbox = Outbox(bot, chat_id)
+                for part_name, part_data in parts:
+                    outbox.add_data(part_data, part_name)
+                outputs = outbox.flush()
+            result_cache.put(replied_document.file_unique_id, 'splitpdf', options, outputs)
+    except ValueError as e:
+        bot.send_message(chat_id, f"Error: {e}")
+        return
+    finally:
+        # Clear the processing status for the current chat
+        sessions.end(chat_id, 'splitpdf')
 
-    # Save the PDF file locally
-    pdf_path = 'temp.pdf'
-    with open(pdf_path, 'wb') as f:
-        f.write(downloaded_file)
+    bot.send_message(chat_id, "Splitting process completed.")
 
-    # Split the PDF into individual pages
-    pages = split_pdf_pages(pdf_path)
+# Parse '/splitpdf [pages] [every=N] [zip]'
+def parse_split_options(text):
+    options = {'pages': None, 'every': 1, 'zip': False}
+    for arg in text.split()[1:]:
+        arg = arg.lower()
+        if arg.startswith('every='):
+            options['every'] = int(arg[6:])
+            if options['every'] < 1:
+                raise ValueError("'every' must be at least 1.")
+        elif arg == 'zip':
+            options['zip'] = True
+        elif arg[0].isdigit() or arg[0] == '-':
+            options['pages'] = arg
+        else:
+            raise ValueError(f"Unknown option '{arg}'.")
+    return options
 
-    # Send each page as a separate file
-    for i, page in enumerate(pages):
-        page_name = f'page_{i + 1}.pdf'
-        with open(page_name, 'wb') as f:
-            page.write(f)
-        with open(page_name, 'rb') as f:
-            bot.send_document(chat_id, f)
 
-        # Remove the generated page file
-        os.remove(page_name)
+# Yield (file name, PDF bytes) for every chunk of `every` selected pages.
+# Each writer is built only when its chunk is reached and dropped after it is yielded.
+def split_pdf_pages(file_path, pages=None, every=1):
+    input_pdf = PyPDF2.PdfReader(file_path)
+    total_pages = len(input_pdf.pages)
+    if pages:
+        page_numbers = iter(pdftools.parse_page_ranges(pages, total_pages))
+    else:
+        page_numbers = iter(range(total_pages))
 
-    # Remove the downloaded PDF file
-    os.remove(pdf_path)
+    while True:
+        chunk = list(islice(page_numbers, every))
+        if not chunk:
+            return
+        output = PyPDF2.PdfWriter()
+        for page_number in chunk:
+            output.add_page(input_pdf.pages[page_number])
+        buffer = BytesIO()
+        output.write(buffer)
+        if len(chunk) == 1:
+            part_name = f'page_{chunk[0] + 1}.pdf'
+        else:
+            part_name = f'pages_{chunk[0] + 1}-{chunk[-1] + 1}.pdf'
+        yield part_name, buffer.getvalue()
 
-    # Set the processing status for the current chat to False
-    processing_status[chat_id] = False
 
-    bot.send_message(chat_id, "Splitting process completed.")
+# handle compresspdf command: '/compresspdf [small|medium|high]' as a reply to a PDF
+@router.route('text', '/compresspdf', job=True)
+def handle_compress_pdf(message):
+    chat_id = message.chat.id
+    document = message.reply_to_message.document if message.reply_to_message else None
+    if not document or not (document.file_name or '').lower().endswith('.pdf'):
+        bot.reply_to(message, "Please reply to a PDF file with /compresspdf [small|medium|high].")
+        return
+
+    args = message.text.lower().split()[1:]
+    preset = args[0] if args else 'medium'
+    if preset not in pdftools.COMPRESS_PRESETS or len(args) > 1:
+        bot.reply_to(message, "Unknown preset. Use /compresspdf small, medium or high.")
+        return
+
+    if document.file_size > config.MAX_FILE_SIZE:
+        bot.reply_to(message, f"Sorry, the maximum file size allowed is {format_size(config.MAX_FILE_SIZE)}.")
+        return
+
+    params = {'preset': preset}
+    cached = result_cache.get(document.file_unique_id, 'compresspdf', params)
+    if cached:
+        send_cached(chat_id, cached)
+        bot.send_message(chat_id, cached[0]['details'])
+        return
+
+    bot.reply_to(message, f"Compressing PDF ({preset} quality). Please wait...")
+    target_dpi, quality = pdftools.COMPRESS_PRESETS[preset]
+
+    try:
+        with Workspace('compress', size_hint=3 * document.file_size) as ws:
+            pdf_path = download_to(document.file_id, ws.path('input.pdf'))
+            original_size = os.path.getsize(pdf_path)
+
+            # Recompress the images in parallel, a couple of batches per CPU worker
+            images = scheduler.run_cpu(pdftools.find_images, pdf_path, target_dpi)
+            batch_count = max(1, min(len(images), 2 * config.CPU_WORKERS))
+            futures = [
+                scheduler.submit_cpu(pdftools.recompress_images, pdf_path, images[start::batch_count], quality)
+                for start in range(batch_count)
+            ]
+            recompressed = [image for future in futures for image in future.result()]
+
+            output_path = ws.path(os.path.splitext(os.path.basename(document.file_name))[0] + '_compressed.pdf')
+            new_size = scheduler.run_cpu(pdftools.write_compressed_pdf, pdf_path, recompressed, output_path)
+
+            if new_size >= original_size:
+                bot.send_message(chat_id, f"This PDF is already well optimized ({format_size(original_size)}), nothing to save.")
+                return
+
+            saved = original_size - new_size
+            details = (f"Compressed {format_size(original_size)} to {format_size(new_size)}, "
+                       f"saving {format_size(saved)} ({saved * 100 // original_size}%). "
+                       f"{len(recompressed)} of {len(images)} images recompressed.")
+            output = output_of(send_file(bot, chat_id, output_path))
+            output['details'] = details
+            result_cache.put(document.file_unique_id, 'compresspdf', params, [output])
+            bot.send_message(chat_id, details)
+    except Exception as e:
+        bot.send_message(chat_id, f"An error occurred: {str(e)}")
+
+
+# handle pdftext command: '/pdftext [pages]' as a reply to a PDF
+@router.route('text', '/pdftext', job=True)
+def handle_pdf_text(message):
+    chat_id = message.chat.id
+    document = replied_pdf(message)
+    if document is None:
+        bot.reply_to(message, "Please reply to a PDF file with /pdftext [pages], e.g. '/pdftext 1-5,8'.")
+        return
+    args = message.text.split()[1:]
+    if len(args) > 1:
+        bot.reply_to(message, "Usage: /pdftext [pages], e.g. '/pdftext 1-5,8'.")
+        return
+    if document.file_size > config.MAX_FILE_SIZE:
+        bot.reply_to(message, f"Sorry, the maximum file size allowed is {format_size(config.MAX_FILE_SIZE)}.")
+        return
+
+    params = {'pages': args[0] if args else None}
+    cached = result_cache.get(document.file_unique_id, 'pdftext', params)
+    if cached:
+        send_cached(chat_id, cached)
+        bot.send_message(chat_id, cached[0]['details'])
+        return
+
+    bot.reply_to(message, "Extracting text. Please wait...")
+    try:
+        with Workspace('pdftext') as ws:
+            pdf_path = download_to(document.file_id, ws.path('input.pdf'))
+            total_pages = scheduler.run_cpu(pdftools.page_count, pdf_path)
+            page_numbers = pdftools.parse_page_ranges(args[0], total_pages) if args else list(range(total_pages))
+
+            # Extracting every page builds the search index on the way
+            index = pdftools.TextIndex(total_pages) if not args else None
+            text_path = ws.path(os.path.splitext(os.path.basename(document.file_name))[0] + '.txt')
+            characters = 0
+            with open(text_path, 'w', encoding='utf-8') as text_file:
+                for chunk_pages, texts, postings in extract_pdf_text(pdf_path, page_numbers):
+                    for page_number, text in zip(chunk_pages, texts):
+                        text_file.write(f"--- Page {page_number + 1} ---\n{text}\n")
+                        characters += len(text.strip())
+                    if index is not None:
+                        index.add(postings)
+            if index is not None:
+                text_index_cache.put(document.file_unique_id, 'pdftext', None, index)
+
+            if not characters:
+                bot.send_message(chat_id, "No text found. The pages are probably scanned images, which this bot can't read.")
+                return
+            details = f"Text of {len(page_numbers)} pages extracted, {characters} characters."
+            output = output_of(send_file(bot, chat_id, text_path))
+            output['details'] = details
+            result_cache.put(document.file_unique_id, 'pdftext', params, [output])
+            bot.send_message(chat_id, details)
+    except ValueError as e:
+        bot.reply_to(message, f"Error: {e}")
+    except Exception as e:
+        bot.send_message(chat_id, f"An error occurred: {str(e)}")
+
+
+# handle pdfsearch command: '/pdfsearch words [send=pdf]' as a reply to a PDF
+@router.route('text', '/pdfsearch', job=True)
+def handle_pdf_search(message):
+    chat_id = message.chat.id
+    document = replied_pdf(message)
+    args = message.text.split()[1:]
+    send_pdf = 'send=pdf' in (arg.lower() for arg in args)
+    query = ' '.join(arg for arg in args if arg.lower() != 'send=pdf')
+    if document is None or not query:
+        bot.reply_to(message, "Please reply to a PDF file with /pdfsearch words [send=pdf], e.g. '/pdfsearch invoice total'.")
+        return
+    if document.file_size > config.MAX_FILE_SIZE:
+        bot.reply_to(message, f"Sorry, the maximum file size allowed is {format_size(config.MAX_FILE_SIZE)}.")
+        return
+
+    try:
+        with Workspace('pdfsearch') as ws:
+            index = text_index_cache.get(document.file_unique_id, 'pdftext')
+            pdf_path = None
+            if index is None:
+                bot.reply_to(message, "Indexing the PDF, later searches will be instant. Please wait...")
+                pdf_path = download_to(document.file_id, ws.path('input.pdf'))
+                index = pdftools.TextIndex(scheduler.run_cpu(pdftools.page_count, pdf_path))
+                for _, _, postings in extract_pdf_text(pdf_path, list(range(index.page_count))):
+                    index.add(postings)
+                text_index_cache.put(document.file_unique_id, 'pdftext', None, index)
+
+            page_numbers = index.search(query)
+            if not page_numbers:
+                bot.reply_to(message, f"No page contains {query}.")
+                return
+            selection = pdftools.format_page_ranges(page_numbers)
+            bot.reply_to(message, f"Found on {len(page_numbers)} of {index.page_count} pages: {selection}\n"
+                                  f"Use these pages with /splitpdf or /pdf2image, e.g. '/pdf2image {selection}'.")
+            if send_pdf:
+                params = {'pages': selection}
+                cached = result_cache.get(document.file_unique_id, 'pdfsearch', params)
+                if cached:
+                    send_cached(chat_id, cached)
+                    return
+                if pdf_path is None:
+                    pdf_path = download_to(document.file_id, ws.path('input.pdf'))
+                output_path = ws.path(os.path.splitext(os.path.basename(document.file_name))[0] + '_matches.pdf')
+                scheduler.run_cpu(pdftools.extract_pages, pdf_path, page_numbers, output_path)
+                result_cache.put(document.file_unique_id, 'pdfsearch', params, [output_of(send_file(bot, chat_id, output_path))])
+    except ValueError as e:
+        bot.reply_to(message, f"Error: {e}")
+    except Exception as e:
+        bot.send_message(chat_id, f"An error occurred: {str(e)}")
+
+
+# The PDF document the command replies to, or None
+def replied_pdf(message):
+    document = message.reply_to_message.document if message.reply_to_message else None
+    if not document or not (document.file_name or '').lower().endswith('.pdf'):
+        return None
+    return document
+
+
+# Extract the text of the pages in the process pool, in chunks of consecutive
+# pages spread over the CPU workers. Yields (page numbers, texts, postings)
+# per chunk, in page order.
+def extract_pdf_text(pdf_path, page_numbers):
+    chunk_size = max(PDFTEXT_MIN_CHUNK, -(-len(page_numbers) // (2 * config.CPU_WORKERS)))
+    chunks = [page_numbers[start:start + chunk_size] for start in range(0, len(page_numbers), chunk_size)]
+    futures = [scheduler.submit_cpu(pdftools.extract_text, pdf_path, chunk) for chunk in chunks]
+    try:
+        for chunk, future in zip(chunks, futures):
+            texts, postings = future.result()
+            yield chunk, texts, postings
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+PDFTEXT_MIN_CHUNK = 8  # Pages; smaller chunks cost more in opening the PDF than they gain
 
-def split_pdf_pages(file_path):
-    input_pdf = PdfReader(file_path)
-    pages = []
-    for i in range(len(input_pdf.pages)):
-        output = PdfWriter()
-        output.add_page(input_pdf.pages[i])
-        pages.append(output)
-    return pages
-    
 
 # Handler for Images to PDF /image2pdf
-@bot.message_handler(commands=['image2pdf'])
+@router.route('text', '/image2pdf', job=True)
 def start_image_to_pdf(message):
     chat_id = message.chat.id
-    user_images[chat_id] = []  # Initialize an empty list for storing images
+
+    # Page size and image quality presets
+    page_size, image_quality = 'fit', 'original'
+    for arg in message.text.lower().split()[1:]:
+        if arg in pdftools.PAGE_PRESETS:
+            page_size = arg
+        elif arg in imagetools.PDF_QUALITY_PRESETS:
+            image_quality = arg
+        else:
+            bot.send_message(chat_id, f"Unknown option '{arg}'. Use fit, a4 or letter and original, high or small.")
+            return
+
+    # A new session replaces the previous one along with its workspace and builder.
+    # Images are recorded as [file_id, extension], in the order they were sent.
+    start_flow(chat_id, 'image2pdf', {
+        'started': message.date,
+        'page_size': page_size,
+        'image_quality': image_quality,
+        'images': []
+    })
     bot.send_message(
         chat_id,
         "Send the images you want to convert to PDF.\nWhen you're done, type '`go`'.",
         parse_mode='Markdown'
     )
 
-@bot.message_handler(content_types=['photo', 'document'])
+@router.route('photo', state='image2pdf', job=True)
+@router.route('document', 'image', state='image2pdf', job=True)
+@router.route('photo', job=True)  # Photos sent with no flow running get the hint below
 def handle_image(message):
     chat_id = message.chat.id
 
-    
+    session = get_flow(chat_id, 'image2pdf')
+    if session is None:
+        bot.send_message(chat_id, "Send /image2pdf first to start converting images to a PDF.")
+        return
+    if sessions.over_limit(chat_id, 'flow'):
+        bot.send_message(chat_id, "This PDF holds as much as one session may. Type '`go`' to create it.", parse_mode='Markdown')
+        return
+
     if message.content_type == 'photo':
         # Handle photos (compressed by Telegram)
         file_id = message.photo[-1].file_id
-        file_info = bot.get_file(file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-
-        # Generate a unique filename for the photo
-        filename = f"{chat_id}_{len(user_images[chat_id])}.jpg"
-        with open(filename, 'wb') as new_file:
-            new_file.write(downloaded_file)
 
-        user_images[chat_id].append(filename)
+        # Add it in the background, so several photos are fetched at once
+        add_session_image(chat_id, session, file_id, 'jpg')
         bot.send_message(
             chat_id,
-            f"Received photo {len(user_images[chat_id])}. Send more or type '`go`'.",
+            f"Received photo {len(session['images'])}. Send more or type '`go`'.",
             parse_mode='Markdown'
         )
 
@@ -456,24 +1338,17 @@ def handle_image(message):
 
         # Check if the document MIME type is an image
         if document.mime_type.startswith('image/'):
-            file_info = bot.get_file(document.file_id)
-            downloaded_file = bot.download_file(file_info.file_path)
-
             # Use the original file extension if available
             ext = document.file_name.split('.')[-1].lower()
             if ext not in ['jpg', 'jpeg', 'png', 'bmp', 'gif', 'tiff']:
                 bot.send_message(chat_id, "Unsupported image format. Please upload JPG, PNG, or similar.")
                 return
 
-            # Generate a unique filename for the document
-            filename = f"{chat_id}_{len(user_images[chat_id])}.{ext}"
-            with open(filename, 'wb') as new_file:
-                new_file.write(downloaded_file)
-
-            user_images[chat_id].append(filename)
+            # Add it in the background
+            add_session_image(chat_id, session, document.file_id, ext)
             bot.send_message(
                 chat_id,
-                f"Received image document {len(user_images[chat_id])}. Send more or type '`go`'.",
+                f"Received image document {len(session['images'])}. Send more or type '`go`'.",
                 parse_mode='Markdown'
             )
         else:
@@ -483,10 +1358,58 @@ def handle_image(message):
         bot.send_message(chat_id, "Unsupported file type. Please send images only.")
 
 
-@bot.message_handler(func=lambda message: message.text and message.text.lower() == 'go')
+def add_session_image(chat_id, session, file_id, ext):
+    runtime = image2pdf_runtime(chat_id, session)
+    session['images'].append([file_id, ext])
+    sessions.put(chat_id, 'flow', session)
+    add_pdf_image(runtime, file_id, ext)
+
+
+# The workspace, PDF builder and pending downloads of an image2pdf session.
+# They only exist in this process, so after a restart or when another worker
+# handled the earlier messages they are rebuilt from the file_ids in the record.
+def image2pdf_runtime(chat_id, session):
+    runtime = sessions.runtime(chat_id, 'flow')
+    if runtime.get('started') != session['started']:
+        release_session(runtime)
+        runtime.clear()
+        runtime['started'] = session['started']
+        runtime['workspace'] = Workspace('image2pdf').open()
+        runtime['builder'] = pdftools.PdfBuilder(session['page_size'], session['image_quality'])
+        runtime['pages'] = []
+    for file_id, ext in session['images'][len(runtime['pages']):]:
+        add_pdf_image(runtime, file_id, ext)
+    return runtime
+
+
+def add_pdf_image(runtime, file_id, ext):
+    index = len(runtime['pages'])
+    filename = runtime['workspace'].path(f"{index}.{ext}")
+    runtime['pages'].append(downloader.submit(fetch_pdf_image, runtime['builder'], index, file_id, filename))
+
+
+# Download one image, prepare it in the process pool and hand it to the PDF builder
+def fetch_pdf_image(builder, index, file_id, filename):
+    try:
+        image_path = download_to(file_id, filename)
+        image = scheduler.run_cpu(imagetools.prepare_pdf_image, image_path, builder.image_quality)
+        if image_path == filename:
+            os.remove(filename)
+    except Exception:
+        builder.skip(index)
+        raise
+    builder.add(index, image)
+
+
+def has_images(chat_id):
+    session = get_flow(chat_id, 'image2pdf')
+    return session is not None and len(session['images']) > 0
+
+
+@router.route('text', 'go', job=True)
 def ask_pdf_name(message):
     chat_id = message.chat.id
-    if chat_id not in user_images or len(user_images[chat_id]) == 0:
+    if not has_images(chat_id):
         bot.send_message(chat_id, "You haven't sent any images yet.")
         return
 
@@ -495,50 +1418,53 @@ def ask_pdf_name(message):
         "Please send a name for your PDF file. If you want to skip, click /skip."
     )
 
-@bot.message_handler(func=lambda message: message.chat.id in user_images and message.text and message.text != '/skip')
+@router.route('text', state='image2pdf', job=True)
 def set_pdf_name(message):
-    chat_id = message.chat.id
-    user_pdf_name[chat_id] = message.text.strip() + ".pdf"  # Save the user's custom name
-    create_pdf(message)
+    create_pdf(message, message.text.strip() + ".pdf")  # The user's custom name
 
-@bot.message_handler(func=lambda message: message.text and message.text.lower() == '/skip')
+@router.route('text', '/skip', job=True)
 def skip_pdf_name(message):
-    chat_id = message.chat.id
-    user_pdf_name[chat_id] = "images.pdf"  # Default PDF name
-    create_pdf(message)
+    create_pdf(message, "images.pdf")  # Default PDF name
 
-def create_pdf(message):
+def create_pdf(message, pdf_name):
     chat_id = message.chat.id
-    if chat_id not in user_images or len(user_images[chat_id]) == 0:
+    session = get_flow(chat_id, 'image2pdf')
+    if session is None or len(session['images']) == 0:
         bot.send_message(chat_id, "You haven't sent any images yet.")
         return
 
-    pdf_filename = user_pdf_name.get(chat_id, "images.pdf")
-    images = [Image.open(img).convert('RGB') for img in user_images[chat_id]]
-    total_pages = len(images)  # Count the number of images
-
-    # Save images to a single PDF
-    images[0].save(pdf_filename, save_all=True, append_images=images[1:])
-
-    # Send the PDF to the user
-    with open(pdf_filename, 'rb') as pdf_file:
-        bot.send_document(chat_id, pdf_file)
+    runtime = image2pdf_runtime(chat_id, session)
+    builder = runtime['builder']
+    pdf_filename = os.path.basename(pdf_name)
 
-    # Cleanup
-    for img in user_images[chat_id]:
-        os.remove(img)
-    os.remove(pdf_filename)
-    del user_images[chat_id]  # Clear the user's session data
-    del user_pdf_name[chat_id]  # Clear the user's PDF name
-
-    bot.send_message(
-        chat_id,
-        f"Your PDF has been created and sent! It contains {total_pages} pages."
-    )
+    try:
+        # Pages were added as the images arrived, only wait for the last ones
+        for page in runtime['pages']:
+            page.exception()
+        failed = list(builder.failed)
+        total_pages = builder.page_count
+
+        # Send the PDF to the user straight from memory
+        if total_pages:
+            bot.send_document(chat_id, named_buffer(builder.tobytes(), pdf_filename))
+
+    finally:
+        # Clear the user's session data, which closes the builder and removes the workspace
+        sessions.end(chat_id, 'flow')
+
+    if failed:
+        bot.send_message(chat_id, f"Skipped image {pdftools.format_page_ranges(failed)}, it could not be added to the PDF."
+                                  if len(failed) == 1 else
+                                  f"Skipped images {pdftools.format_page_ranges(failed)}, they could not be added to the PDF.")
+    if total_pages:
+        bot.send_message(
+            chat_id,
+            f"Your PDF has been created and sent! It contains {total_pages} pages."
+        )
     
 
 # Handler for the /resizeimage command
-@bot.message_handler(commands=['resizeimage'])
+@router.route('text', '/resizeimage', job=True)
 def handle_resize_image_command(message):
     chat_id = message.chat.id
 
@@ -547,29 +1473,32 @@ def handle_resize_image_command(message):
         bot.reply_to(message, "Please reply to an image with the /resizeimage command.")
         return
 
-    # Retrieve the photo ID from the replied-to message
-    photo_id = message.reply_to_message.photo[-1].file_id
+    # Retrieve the photo from the replied-to message
+    photo = message.reply_to_message.photo[-1]
 
-    # Download the photo using the photo ID
-    file_info = bot.get_file(photo_id)
-    downloaded_file = bot.download_file(file_info.file_path)
+    # Download the photo using the photo ID into the session's workspace, it's
+    # only decoded once the user has chosen what to do with it
+    file_info = bot.get_file(photo.file_id)
 
-    # Load the downloaded photo into Pillow
-    image = Image.open(BytesIO(downloaded_file))
+    # Store a reference to the image in the session
+    start_flow(chat_id, 'resizeimage:choose_modification', {
+        'file_id': photo.file_id,
+        'file_unique_id': photo.file_unique_id
+    })
 
-    # Store the image in user settings
-    user_settings[chat_id] = {
-        'command_state': 'choose_modification',
-        'image': image
-    }
+    runtime = sessions.runtime(chat_id, 'flow')
+    runtime['workspace'] = Workspace('resize').open()
+    image_path = runtime['image_path'] = downloader.fetch_path(file_info.file_path, runtime['workspace'].path('input.jpg'))
+    with Image.open(image_path) as image:
+        width, height = image.size
 
     # Get image details
     image_details = f"Image Details:\n\n" \
-                    f"File Name: {file_info.file_path}\n" \
+                    f"File Name: {os.path.basename(file_info.file_path)}\n" \
                     f"File Size: {file_info.file_size / (1024 * 1024):.2f} MB " \
                     f"({file_info.file_size / 1024:.2f} KB)\n" \
-                    f"Image Width: {image.width}px\n" \
-                    f"Image Height: {image.height}px\n"
+                    f"Image Width: {width}px\n" \
+                    f"Image Height: {height}px\n"
 
     # Ask the user for the desired modification
     markup = telebot.types.InlineKeyboardMarkup()
@@ -582,120 +1511,447 @@ def handle_resize_image_command(message):
 
 # Handler for inline keyboard button callbacks
 @bot.callback_query_handler(func=lambda call: True)
+@scheduler.job
 def handle_callback(call):
     chat_id = call.message.chat.id
+    if call.data.startswith('unarchive:'):
+        handle_listing_callback(call)
+        return
 
-    if chat_id in user_settings and user_settings[chat_id]['command_state'] == 'choose_modification':
+    session = get_flow(chat_id, 'resizeimage:choose_modification')
+    if session is not None:
         action = call.data
 
+        # The state is saved before asking, so a quick answer is routed to it
         if action == 'modify_file_size':
+            session['state'] = 'resizeimage:enter_file_size'
+            sessions.put(chat_id, 'flow', session)
             # Ask the user to enter the desired file size
-            bot.reply_to(call.message, "Please enter the desired file size in kilobytes (KB):")
-            user_settings[chat_id]['command_state'] = 'enter_file_size'
+            bot.reply_to(call.message, "Please enter the desired file size in kilobytes (KB), "
+                                       "optionally followed by a format (jpeg, webp or avif):")
 
         elif action == 'modify_file_dimensions':
+            session['state'] = 'resizeimage:enter_dimensions'
+            sessions.put(chat_id, 'flow', session)
             # Ask the user to enter the desired dimensions
             bot.reply_to(call.message, "Please enter the desired width and height in pixels (separated by a space):")
-            user_settings[chat_id]['command_state'] = 'enter_dimensions'
+
+
+RESIZE_STATES = ('resizeimage:choose_modification', 'resizeimage:enter_file_size', 'resizeimage:enter_dimensions')
 
 
 # Handler for receiving text messages
-@bot.message_handler(func=lambda message: message.content_type == 'text')
+@router.route('text', state='resizeimage:choose_modification', job=True)
+@router.route('text', state='resizeimage:enter_file_size', job=True)
+@router.route('text', state='resizeimage:enter_dimensions', job=True)
 def handle_text(message):
     chat_id = message.chat.id
 
     # Check if the user has a command state
-    if chat_id in user_settings:
-        # Check the command state for the user
-        if user_settings[chat_id]['command_state'] == 'enter_file_size':
-            try:
-                # Get the user's desired file size
-                target_file_size = float(message.text.strip())
-
-                # Retrieve the image from user settings
-                image = user_settings[chat_id]['image']
-
-                # Reduce the image quality to achieve the target file size
-                quality = 80  # Initial quality level
-                while True:
-                    output = BytesIO()
-                    image.save(output, format='JPEG', quality=quality)
-                    image_size = output.tell()
-                    if image_size / 1024 <= target_file_size:
-                        break
-                    quality -= 5  # Adjust the decrement value as needed
-
-                # Save the resized image to a temporary file
-                output.seek(0)
-                with open('resized_image.jpg', 'wb') as f:
-                    f.write(output.read())
-
-                # Send the resized image back to the user
-                with open('resized_image.jpg', 'rb') as f:
-                    bot.send_photo(chat_id, f)
-
-                # Get the details of the resized image
-                resized_image_details = f"Resized Image Details:\n\n" \
-                                        f"File Name: resized_image.jpg\n" \
-                                        f"File Size: {os.path.getsize('resized_image.jpg') / 1024:.2f} KB\n" \
-                                        f"Image Width: {Image.open('resized_image.jpg').size[0]}px\n" \
-                                        f"Image Height: {Image.open('resized_image.jpg').size[1]}px\n"
-
-                bot.send_message(chat_id, resized_image_details)
-
-                # Clean up the temporary file
-                os.remove('resized_image.jpg')
-
-            except ValueError:
-                bot.reply_to(message, "Invalid file size. Please enter a valid size in kilobytes (KB).")
-
-            # Clear user settings
-            del user_settings[chat_id]
-
-        elif user_settings[chat_id]['command_state'] == 'enter_dimensions':
-            try:
-                # Get the user's desired dimensions
-                dimensions = message.text.strip().split(' ')
-                width = int(dimensions[0])
-                height = int(dimensions[1])
+    session = get_flow(chat_id, *RESIZE_STATES)
+    if session is not None:
+        if session['state'] == 'resizeimage:choose_modification':
+            bot.reply_to(message, "Invalid command or input.")
+            return
 
-                # Retrieve the image from user settings
-                image = user_settings[chat_id]['image']
+        # The flow ends with this answer, whatever happens to it
+        try:
+            # The resized output lives in a per-job workspace
+            with Workspace('resize') as ws:
+                # Check the command state for the user
+                if session['state'] == 'resizeimage:enter_file_size':
+                    try:
+                        # Get the user's desired file size and optional output format
+                        args = message.text.strip().lower().split()
+                        target_file_size = float(args[0])
+                        extension = args[1].lstrip('.') if len(args) > 1 else 'jpg'
+                        image_format = imagetools.SIZE_FORMATS[extension]
+                        if target_file_size <= 0:
+                            raise ValueError
+                    except (IndexError, KeyError, ValueError):
+                        bot.reply_to(message, "Invalid file size. Please enter a valid size in kilobytes (KB).")
+                    else:
+                        cache_params = {'size': target_file_size, 'format': extension}
+                        if send_cached_resize(chat_id, session, cache_params):
+                            return
+
+                        output_name = f"resized_image.{extension}"
+                        output_path = ws.path(output_name)
+                        try:
+                            # Search the quality (and if needed the scale) that reaches the target file size.
+                            # The image is decoded in the worker process, only paths cross over.
+                            resized_width, resized_height, quality = scheduler.run_cpu(
+                                imagetools.resize_image_file, session_image_path(chat_id, session), output_path,
+                                image_format, None, target_file_size
+                            )
+                        except ValueError as e:  # The target can't be reached
+                            bot.reply_to(message, f"Error: {e}")
+                        else:
+                            # Send the resized image back to the user, as a document
+                            # unless it's a JPEG so Telegram doesn't re-encode it
+                            with open(output_path, 'rb') as f:
+                                if image_format == 'JPEG':
+                                    sent = bot.send_photo(chat_id, f)
+                                else:
+                                    sent = bot.send_document(chat_id, f)
+
+                            # Get the details of the resized image
+                            resized_image_details = f"Resized Image Details:\n\n" \
+                                                    f"File Name: {output_name}\n" \
+                                                    f"File Size: {os.path.getsize(output_path) / 1024:.2f} KB\n" \
+                                                    f"Image Width: {resized_width}px\n" \
+                                                    f"Image Height: {resized_height}px\n" \
+                                                    f"Quality: {quality}\n"
+
+                            bot.send_message(chat_id, resized_image_details)
+                            cache_resize(session, cache_params, sent, resized_image_details)
+
+                elif session['state'] == 'resizeimage:enter_dimensions':
+                    try:
+                        # Get the user's desired dimensions
+                        dimensions = message.text.strip().split(' ')
+                        width = int(dimensions[0])
+                        height = int(dimensions[1])
+
+                        cache_params = {'width': width, 'height': height}
+                        if send_cached_resize(chat_id, session, cache_params):
+                            return
+
+                        # Resize the image to the desired dimensions, decoding it at a reduced size when possible
+                        output_path = ws.path('resized_image.jpg')
+                        resized_width, resized_height, _ = scheduler.run_cpu(
+                            imagetools.resize_image_file, session_image_path(chat_id, session), output_path, 'JPEG', (width, height)
+                        )
+
+                        # Send the resized image back to the user
+                        with open(output_path, 'rb') as file:
+                            sent = bot.send_photo(chat_id, file)
+
+                        # Get the details of the resized image
+                        resized_image_details = f"Resized Image Details:\n\n" \
+                                                f"File Name: resized_image.jpg\n" \
+                                                f"File Size: {os.path.getsize(output_path) / 1024:.2f} KB\n" \
+                                                f"Image Width: {resized_width}px\n" \
+                                                f"Image Height: {resized_height}px\n"
+
+                        bot.send_message(chat_id, resized_image_details)
+                        cache_resize(session, cache_params, sent, resized_image_details)
+
+                    except (IndexError, ValueError):
+                        bot.reply_to(message, "Invalid dimensions. Please enter valid width and height values.")
+        except Exception as e:
+            bot.reply_to(message, f"An error occurred: {e}")
+        finally:
+            sessions.end(chat_id, 'flow')
 
-                # Resize the image to the desired dimensions
-                image.thumbnail((width, height), Image.LANCZOS)
 
-                # Save the resized image to a temporary file
-                output_path = 'resized_image.jpg'
-                image.save(output_path)
+# The photo of a resize session, downloaded again by file_id when it isn't on
+# disk in this process (after a restart or on another worker)
+def session_image_path(chat_id, session):
+    runtime = sessions.runtime(chat_id, 'flow')
+    if 'workspace' not in runtime:
+        runtime['workspace'] = Workspace('resize').open()
+        runtime['image_path'] = download_to(session['file_id'], runtime['workspace'].path('input.jpg'))
+    return runtime['image_path']
 
-                # Send the resized image back to the user
-                with open(output_path, 'rb') as file:
-                    bot.send_photo(chat_id, file)
 
-                # Get the details of the resized image
-                resized_image_details = f"Resized Image Details:\n\n" \
-                                        f"File Name: resized_image.jpg\n" \
-                                        f"File Size: {os.path.getsize(output_path) / 1024:.2f} KB\n" \
-                                        f"Image Width: {image.width}px\n" \
-                                        f"Image Height: {image.height}px\n"
+# handle batchresize command: '/batchresize [WxH] [NNNkb] [jpeg|png|webp|avif] [zip]'
+@router.route('text', '/batchresize', job=True)
+def start_batch_resize(message):
+    chat_id = message.chat.id
+    try:
+        options = parse_batch_resize_options(message.text)
+    except ValueError as e:
+        bot.reply_to(message, f"Error: {e}\nUsage: /batchresize 1280x720 [jpeg|png|webp] [zip] or /batchresize 200kb [jpeg|webp|avif] [zip]")
+        return
 
-                bot.send_message(chat_id, resized_image_details)
+    # Images are recorded as [file_id, output name], in the order they were sent
+    start_flow(chat_id, 'batchresize', dict(options, started=message.date, images=[], status_message_id=None))
+    bot.send_message(
+        chat_id,
+        "Send the photos or image files to resize, albums work too.\nWhen you're done, type '`done`'.",
+        parse_mode='Markdown'
+    )
+
+
+def parse_batch_resize_options(text):
+    options = {'size': None, 'target_kb': None, 'format': 'jpg', 'zip': False}
+    for arg in text.lower().split()[1:]:
+        width, _, height = arg.partition('x')
+        if width.isdigit() and height.isdigit():
+            options['size'] = [int(width), int(height)]
+            if min(options['size']) < 1:
+                raise ValueError("Dimensions must be positive.")
+        elif arg.endswith('kb'):
+            options['target_kb'] = float(arg[:-2])
+            if options['target_kb'] <= 0:
+                raise ValueError("The target size must be positive.")
+        elif arg.lstrip('.') in imagetools.RESIZE_FORMATS or arg.lstrip('.') in imagetools.SIZE_FORMATS:
+            options['format'] = arg.lstrip('.')
+        elif arg == 'zip':
+            options['zip'] = True
+        else:
+            raise ValueError(f"Unknown option '{arg}'.")
+    if not options['size'] and not options['target_kb']:
+        raise ValueError("Give the dimensions to fit in (e.g. 1280x720) and/or a file size (e.g. 200kb).")
+    if options['target_kb'] and options['format'] not in imagetools.SIZE_FORMATS:
+        raise ValueError("A file size target needs jpeg, webp or avif.")
+    if not options['target_kb'] and options['format'] not in imagetools.RESIZE_FORMATS:
+        raise ValueError("Resizing to dimensions supports jpeg, png and webp.")
+    return options
+
+
+@router.route('photo', state='batchresize', job=True)
+@router.route('document', 'image', state='batchresize', job=True)
+def handle_batch_image(message):
+    chat_id = message.chat.id
+    session = get_flow(chat_id, 'batchresize')
+    if session is None:
+        return
+    if len(session['images']) >= config.BATCH_RESIZE_MAX_IMAGES:
+        bot.reply_to(message, f"Maximum of {config.BATCH_RESIZE_MAX_IMAGES} images reached. Please send 'done' to start resizing.")
+        return
+
+    index = len(session['images'])
+    if message.content_type == 'photo':
+        file_id, stem = message.photo[-1].file_id, f"photo_{index + 1}"
+    else:
+        file_id, stem = message.document.file_id, os.path.splitext(os.path.basename(message.document.file_name or 'image'))[0]
+    name = f"{index + 1:03d}_{stem}.{batch_extension(session)}"
+
+    # Fetch and resize it in the background right away, so most of the work is done by 'done'
+    runtime = batch_resize_runtime(chat_id, session)
+    session['images'].append([file_id, name])
+    add_batch_image(runtime, session, file_id, name)
+
+    # One status message kept up to date instead of a reply per image
+    text = f"{len(session['images'])} images received. Send more or type '`done`'."
+    if session['status_message_id'] is not None:
+        try:
+            bot.edit_message_text(text, chat_id, session['status_message_id'], parse_mode='Markdown')
+        except telebot.apihelper.ApiTelegramException:
+            session['status_message_id'] = None
+    if session['status_message_id'] is None:
+        session['status_message_id'] = bot.send_message(chat_id, text, parse_mode='Markdown').message_id
+    sessions.put(chat_id, 'flow', session)
 
-                # Clean up the temporary file
-                os.remove(output_path)
 
-            except (IndexError, ValueError):
-                bot.reply_to(message, "Invalid dimensions. Please enter valid width and height values.")
+def batch_extension(options):
+    return 'jpg' if options['format'] == 'jpeg' else options['format']
 
-            # Clear user settings
-            del user_settings[chat_id]
 
+# The workspace and pending resizes of a batch resize session, rebuilt from
+# the file_ids in the record when this process doesn't have them
+def batch_resize_runtime(chat_id, session):
+    runtime = sessions.runtime(chat_id, 'flow')
+    if runtime.get('started') != session['started']:
+        release_session(runtime)
+        runtime.clear()
+        runtime['started'] = session['started']
+        runtime['workspace'] = Workspace('batchresize').open()
+        runtime['pages'] = []
+    for file_id, name in session['images'][len(runtime['pages']):]:
+        add_batch_image(runtime, session, file_id, name)
+    return runtime
+
+
+def add_batch_image(runtime, session, file_id, name):
+    input_path = runtime['workspace'].path(f"input_{len(runtime['pages'])}")
+    output_path = runtime['workspace'].path(name)
+    runtime['pages'].append(downloader.submit(fetch_batch_image, file_id, input_path, output_path, session))
+
+
+# Download one image and resize it in the process pool, returning the output path
+def fetch_batch_image(file_id, input_path, output_path, options):
+    image_path = download_to(file_id, input_path)
+    try:
+        scheduler.run_cpu(
+            imagetools.resize_image_file, image_path, output_path,
+            imagetools.SIZE_FORMATS.get(options['format']) or imagetools.RESIZE_FORMATS[options['format']],
+            tuple(options['size']) if options['size'] else None, options['target_kb']
+        )
+    finally:
+        if image_path == input_path:
+            os.remove(input_path)
+    return output_path
+
+
+@router.route('text', 'done', state='batchresize', job=True)
+def finish_batch_resize(message):
+    chat_id = message.chat.id
+    session = get_flow(chat_id, 'batchresize')
+    if session is None:
+        return
+    if not session['images']:
+        bot.reply_to(message, "You haven't sent any images yet.")
+        return
+
+    runtime = batch_resize_runtime(chat_id, session)
+    bot.send_message(chat_id, f"Resizing {len(session['images'])} images...")
+    failed = 0
+    try:
+        if session['zip']:
+            # Resized images are already compressed, store them as they are
+            zip_path = runtime['workspace'].path('resized_images.zip')
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zip_file:
+                for future in runtime['pages']:
+                    try:
+                        output_path = future.result()
+                    except Exception:
+                        failed += 1
+                        continue
+                    zip_file.write(output_path, os.path.basename(output_path))
+                    os.remove(output_path)
+            if failed < len(runtime['pages']):
+                send_file(bot, chat_id, zip_path)
         else:
-            bot.reply_to(message, "Invalid command or input.")
+            # Sent as documents in albums of 10, so the files arrive exactly as encoded
+            outbox = Outbox(bot, chat_id)
+            for future in runtime['pages']:
+                try:
+                    outbox.add_file(future.result(), remove=True)
+                except Exception:
+                    failed += 1
+            outbox.flush()
+    finally:
+        sessions.end(chat_id, 'flow')
+
+    resized = len(session['images']) - failed
+    bot.send_message(chat_id, f"Batch resize completed. {resized} images resized" + (f", {failed} failed." if failed else "."))
+
+
+# Admin-only summary of the scheduler, caches and per-stage timings
+@router.route('text', '/stats', job=True)
+def handle_stats(message):
+    if message.from_user.id not in config.ADMIN_IDS:
+        bot.reply_to(message, "This command is only available to the bot admins.")
+        return
+    bot.reply_to(message, f"<pre>{format_stats()[:4000]}</pre>", parse_mode="HTML")
+
+
+def format_stats():
+    jobs = scheduler.stats()
+    cache = result_cache.stats()
+    listings = listing_cache.stats()
+    text_indexes = text_index_cache.stats()
+    store = sessions.stats()
+    sends = api_sender.stats()
+    lines = [
+        f"Jobs: {jobs['running']}/{jobs['workers']} running, {jobs['queue_depth']} queued (max {jobs['max_queue_depth']})",
+        f"  {jobs['completed']} done, {jobs['failed']} failed, {jobs['rejected']} rejected",
+        f"  wait p50/p99 {jobs['wait_p50']:.2f}/{jobs['wait_p99']:.2f}s, run p50/p99 {jobs['run_p50']:.2f}/{jobs['run_p99']:.2f}s",
+        f"Cache: {cache['entries']} entries, {cache['hit_rate']:.0%} hits; "
+        f"archive listings {listings['entries']} entries, {listings['hit_rate']:.0%} hits; "
+        f"PDF text indexes {text_indexes['entries']} entries, {text_indexes['hit_rate']:.0%} hits",
+        f"Sessions: {store['sessions']} ({format_size(store['bytes'])}), {store['expired']} expired, {store['evicted']} evicted",
+        f"Unrouted messages: {router.unrouted}",
+        f"Sends: {sends['throttled']} throttled (429), {sends['retried']} retried",
+        "",
+        "Stage           count    p50     p99    bytes",
+    ]
+    current_operation = None
+    for (operation, stage), stats in metrics.tracer.stats().items():
+        if operation != current_operation:
+            current_operation = operation
+            lines.append(operation)
+        lines.append(
+            f"  {stage:<12} {stats['count']:>6} {stats['p50']:>6g}s {stats['p99']:>6g}s {format_size(stats['bytes']):>10}"
+        )
+    return '\n'.join(lines)
+
+
+# Prometheus metrics for /metrics on the web server
+def metrics_text():
+    stage_seconds, stage_bytes, stage_errors = metrics.tracer.series()
+    gauges = {'bot_unrouted_messages': router.unrouted}
+    for prefix, stats in (
+        ('bot_scheduler', scheduler.stats()),
+        ('bot_cache', result_cache.stats()),
+        ('bot_session_store', sessions.stats()),
+        ('bot_sender', api_sender.stats()),
+    ):
+        for name, value in stats.items():
+            gauges[f"{prefix}_{name}"] = value
+    return metrics.prometheus_text(
+        histograms={
+            'bot_stage_seconds': stage_seconds,
+            'bot_route_seconds': {(('route', name),): timing for name, timing in router.timings.items()},
+        },
+        counters={
+            'bot_stage_bytes_total': stage_bytes,
+            'bot_stage_errors_total': stage_errors,
+        },
+        gauges=gauges
+    )
+
+
+# Re-send a resize result from the cache; returns False on a miss
+def send_cached_resize(chat_id, session, params):
+    cached = result_cache.get(session['file_unique_id'], 'resizeimage', params)
+    if not cached:
+        return False
+    send_cached(chat_id, cached)
+    bot.send_message(chat_id, cached[0]['details'])
+    return True
+
+
+def cache_resize(session, params, sent, details):
+    output = output_of(sent)
+    output['details'] = details
+    result_cache.put(session['file_unique_id'], 'resizeimage', params, [output])
+
+
+# Feed a decoded webhook update into the bot's handlers
+def process_webhook_update(update):
+    bot.process_new_updates([telebot.types.Update.de_json(update)])
+
+
+# Import the heavy libraries and start the CPU worker processes before the
+# first command needs them. The workers' fork server preloads the image and
+# PDF modules, so they start with those loaded too.
+def prewarm():
+    for module in HEAVY_MODULES:
+        module.load()
+    scheduler.run_cpu(abs, 0)
+
+
+# Flask is only imported once the bot is already polling
+def start_web_server():
+    import webserver
+    webserver.expose_metrics(metrics_text, config.METRICS_TOKEN)
+    webserver.run(config.PORT)
 
 
-    
 # Start the bot
-keep_alive()
-bot.polling(none_stop=True, timeout=123)
+def main():
+    sweep_stale_workspaces()
+    scheduler.start()
+    if config.PREWARM:
+        threading.Thread(target=prewarm, name='prewarm', daemon=True).start()
+
+    if config.WEBHOOK_URL:
+        # Anyone who finds the URL could post fake updates without the secret
+        if not config.WEBHOOK_SECRET:
+            raise SystemExit("WEBHOOK_SECRET must be set when WEBHOOK_URL is.")
+        import webserver
+        # Telegram pushes updates to this instance's Flask app
+        webserver.start_webhook_dispatcher(
+            process_webhook_update, config.WEBHOOK_SECRET, config.WEBHOOK_QUEUE_SIZE, config.WEBHOOK_WORKERS
+        )
+        webserver.expose_metrics(metrics_text, config.METRICS_TOKEN)
+        webserver.keep_alive(config.PORT)
+        bot.remove_webhook()
+        bot.set_webhook(
+            url=config.WEBHOOK_URL.rstrip('/') + '/webhook',
+            secret_token=config.WEBHOOK_SECRET,
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS
+        )
+    else:
+        threading.Thread(target=start_web_server, name='web-server', daemon=True).start()
+        # getUpdates fails while a webhook from an earlier webhook-mode run is still set
+        bot.remove_webhook()
+        bot.polling(none_stop=True, timeout=123)
+
+
+if __name__ == '__main__':
+    main()
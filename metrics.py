@@ -0,0 +1,177 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Upper bounds in seconds, roughly logarithmic from 1 ms to 5 minutes
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+# Fixed-bucket histogram of durations, cheap enough to update on every call
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one counts values above every bucket
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    # Upper bound of the bucket holding the pct-th percentile
+    def percentile(self, pct):
+        with self.lock:
+            if not self.count:
+                return 0.0
+            rank = pct / 100 * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank and count:
+                    return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+
+# Name of the operation (bot command) the current thread works for, so stages
+# timed deep inside helpers are attributed to the command that caused them
+current = threading.local()
+
+
+def current_operation():
+    return getattr(current, 'operation', 'other')
+
+
+@contextmanager
+def operation(name):
+    previous = getattr(current, 'operation', None)
+    current.operation = name
+    try:
+        yield
+    finally:
+        current.operation = previous
+
+
+# Wrap a function so it runs under the caller's operation on another thread
+def bind(func):
+    name = current_operation()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with operation(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class Span:
+    def __init__(self):
+        self.bytes = 0
+
+    def add_bytes(self, count):
+        self.bytes += count
+
+
+# Time and bytes per (operation, stage), e.g. ('pdf2image', 'download')
+class Tracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.bytes = {}
+        self.errors = {}
+
+    @contextmanager
+    def trace(self, stage, operation=None):
+        span = Span()
+        started_at = time.monotonic()
+        failed = False
+        try:
+            yield span
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.observe(stage, time.monotonic() - started_at, span.bytes, operation, failed)
+
+    def observe(self, stage, seconds, count=0, operation=None, failed=False):
+        key = (operation or current_operation(), stage)
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = Histogram()
+                self.bytes[key] = 0
+                self.errors[key] = 0
+            self.bytes[key] += count
+            if failed:
+                self.errors[key] += 1
+        timing.observe(seconds)
+
+    def stats(self):
+        with self.lock:
+            keys = sorted(self.timings)
+        return {
+            key: dict(self.timings[key].stats(), bytes=self.bytes[key], errors=self.errors[key])
+            for key in keys
+        }
+
+    # (timings, bytes, errors) keyed by Prometheus labels, for prometheus_text()
+    def series(self):
+        with self.lock:
+            labels = {key: (('operation', key[0]), ('stage', key[1])) for key in self.timings}
+            return (
+                {labels[key]: self.timings[key] for key in labels},
+                {labels[key]: self.bytes[key] for key in labels},
+                {labels[key]: self.errors[key] for key in labels},
+            )
+
+
+tracer = Tracer()
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+# Prometheus text exposition. `histograms` and `counters` map a metric name to
+# {labels: Histogram or value}, labels being a tuple of (name, value) pairs;
+# `gauges` maps a metric name to a plain value.
+def prometheus_text(histograms=None, counters=None, gauges=None):
+    lines = []
+    for name, series in (histograms or {}).items():
+        lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in series.items():
+            counts, total, count = histogram.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+    for name, series in (counters or {}).items():
+        lines.append(f"# TYPE {name} counter")
+        for labels, value in series.items():
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    for name, value in (gauges or {}).items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return '\n'.join(lines) + '\n'
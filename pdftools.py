@@ -0,0 +1,398 @@
+import io
+import os
+import re
+import threading
+from array import array
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageDraw
+
+IMAGE_FORMATS = {
+    'png': 'png',
+    'jpg': 'jpeg',
+    'jpeg': 'jpeg',
+    'webp': 'webp',
+}
+
+# Contact sheet layout, in pixels
+SHEET_MARGIN = 6
+SHEET_LABEL_HEIGHT = 16
+
+
+# Render a single PDF page to an image file (runs in the scheduler's process pool)
+def render_page(pdf_path, page_number, dpi, image_format, image_path, gray=False):
+    with fitz.open(pdf_path) as pdf_document:
+        page = pdf_document[page_number]
+        pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY if gray else fitz.csRGB, alpha=False)
+        if image_format == 'png':
+            pix.save(image_path)
+        else:
+            # PyMuPDF can't write WebP, so lossy formats go through Pillow
+            image = Image.frombytes('L' if gray else 'RGB', (pix.width, pix.height), pix.samples)
+            image.save(image_path, format=image_format.upper(), quality=90)
+    return image_path
+
+
+# Render pages scaled to fit a (width, height) cell, for contact sheets (runs
+# in the scheduler's process pool). Returns (page_number, width, height, samples)
+# tuples; annotations are skipped and nothing outside the page box is drawn.
+def render_thumbnails(pdf_path, page_numbers, cell_size, gray=False):
+    colorspace = fitz.csGRAY if gray else fitz.csRGB
+    thumbnails = []
+    with fitz.open(pdf_path) as pdf_document:
+        for page_number in page_numbers:
+            page = pdf_document[page_number]
+            zoom = min(cell_size[0] / page.rect.width, cell_size[1] / page.rect.height)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace,
+                                  clip=page.rect, alpha=False, annots=False)
+            thumbnails.append((page_number, pix.width, pix.height, pix.samples))
+    return thumbnails
+
+
+# Tile thumbnails into one JPEG, `columns` per row, each centered in its cell
+# above its page number (runs in the scheduler's process pool)
+def tile_contact_sheet(thumbnails, columns, cell_size, image_path, gray=False):
+    mode = 'L' if gray else 'RGB'
+    cell_width, cell_height = cell_size[0] + 2 * SHEET_MARGIN, cell_size[1] + SHEET_LABEL_HEIGHT + SHEET_MARGIN
+    rows = -(-len(thumbnails) // columns)
+    sheet = Image.new(mode, (min(columns, len(thumbnails)) * cell_width, rows * cell_height), 'white')
+    draw = ImageDraw.Draw(sheet)
+    for index, (page_number, width, height, samples) in enumerate(thumbnails):
+        left = index % columns * cell_width + SHEET_MARGIN
+        top = index // columns * cell_height + SHEET_MARGIN
+        x, y = left + (cell_size[0] - width) // 2, top + (cell_size[1] - height) // 2
+        sheet.paste(Image.frombytes(mode, (width, height), samples), (x, y))
+        draw.rectangle((x - 1, y - 1, x + width, y + height), outline='gray')
+        draw.text((left + cell_size[0] // 2, top + cell_size[1] + SHEET_LABEL_HEIGHT // 2),
+                  str(page_number + 1), fill='black', anchor='mm')
+    sheet.save(image_path, format='JPEG', quality=80, optimize=True)
+    return image_path
+
+
+# Number of pages in a PDF file
+def page_count(pdf_path):
+    with fitz.open(pdf_path) as pdf_document:
+        return len(pdf_document)
+
+
+# Parse a page selection like "1-3,7,10-" into zero-based page numbers
+def parse_page_ranges(text, total_pages):
+    page_numbers = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            start = int(start) if start.strip() else 1
+            end = int(end) if end.strip() else total_pages
+        else:
+            start = end = int(part)
+        if start < 1 or end > total_pages or start > end:
+            raise ValueError(f"Invalid page range '{part}' for a PDF with {total_pages} pages.")
+        page_numbers.extend(range(start - 1, end))
+    return page_numbers
+
+
+# A new PDF with just the given pages, in that order (runs in the scheduler's process pool)
+def extract_pages(pdf_path, page_numbers, output_path):
+    with fitz.open(pdf_path) as pdf_document:
+        pdf_document.select(page_numbers)
+        pdf_document.save(output_path, garbage=3, deflate=True)
+    return output_path
+
+
+WORD = re.compile(r'\w+')
+
+
+# Extract the text of some pages (runs in the scheduler's process pool).
+# Returns the page texts in order, and the words of those pages as
+# {word: [page numbers]} postings for a TextIndex.
+def extract_text(pdf_path, page_numbers):
+    texts = []
+    postings = {}
+    with fitz.open(pdf_path) as pdf_document:
+        for page_number in page_numbers:
+            text = pdf_document[page_number].get_text()
+            texts.append(text)
+            for word in set(WORD.findall(text.casefold())):
+                postings.setdefault(word, []).append(page_number)
+    return texts, postings
+
+
+# Inverted index of a PDF's text: every word maps to the pages it is on, kept
+# as compact arrays of page numbers. Postings are added chunk by chunk in
+# page order, so every array stays sorted.
+class TextIndex:
+    def __init__(self, page_count):
+        self.page_count = page_count
+        self.postings = {}
+
+    def add(self, postings):
+        for word, page_numbers in postings.items():
+            self.postings.setdefault(word, array('I')).extend(page_numbers)
+
+    # Pages containing every word of the query, ignoring case. A word ending
+    # in '*' matches all words starting with it, e.g. 'invoic*'.
+    def search(self, query):
+        pages = None
+        for part in query.casefold().split():
+            words = WORD.findall(part)
+            if not words:
+                continue
+            for word in words[:-1]:
+                pages = self.intersect(pages, self.postings.get(word, ()))
+            if part.endswith('*'):
+                matches = set()
+                for word, page_numbers in self.postings.items():
+                    if word.startswith(words[-1]):
+                        matches.update(page_numbers)
+                pages = self.intersect(pages, matches)
+            else:
+                pages = self.intersect(pages, self.postings.get(words[-1], ()))
+        if pages is None:
+            raise ValueError("Nothing to search for.")
+        return sorted(pages)
+
+    @staticmethod
+    def intersect(pages, page_numbers):
+        return set(page_numbers) if pages is None else pages.intersection(page_numbers)
+
+    @property
+    def size(self):
+        return sum(len(word) + page_numbers.itemsize * len(page_numbers) for word, page_numbers in self.postings.items())
+
+
+# Page numbers as a compact selection like "1-3,7", the syntax parse_page_ranges() reads
+def format_page_ranges(page_numbers):
+    ranges = []
+    for page_number in page_numbers:
+        if ranges and page_number == ranges[-1][1] + 1:
+            ranges[-1][1] = page_number
+        else:
+            ranges.append([page_number, page_number])
+    return ','.join(str(start + 1) if start == end else f"{start + 1}-{end + 1}" for start, end in ranges)
+
+
+# Merges PDFs as they arrive, in whatever order their downloads finish. Each
+# input is appended to the merged document once, with its pages and links;
+# finish() then applies the final order and page selection by rearranging the
+# page tree, so no input is read a second time. Outlines are merged too, with
+# their entries pointing at where the pages ended up.
+class PdfMerger:
+    def __init__(self):
+        self.document = fitz.open()
+        self.lock = threading.Lock()
+        self.parts = {}  # index -> (first page, page count, outline)
+        self.size = 0  # Bytes of input added so far
+
+    # Append input `index`, given as bytes or as a local path
+    def add(self, index, source):
+        if isinstance(source, str):
+            pdf_document = fitz.open(source)  # Read in place, not copied into memory
+        else:
+            pdf_document = fitz.open(stream=source, filetype='pdf')
+        with pdf_document:
+            outline = pdf_document.get_toc(simple=True)
+            with self.lock:
+                first_page = len(self.document)
+                self.document.insert_pdf(pdf_document)
+                self.parts[index] = (first_page, len(pdf_document), outline)
+                self.size += os.path.getsize(source) if isinstance(source, str) else len(source)
+
+    def page_count(self, index):
+        return self.parts[index][1]
+
+    # Keep the pages of `selection`, a list of (input index, page numbers or None for all)
+    def finish(self, selection):
+        with self.lock:
+            pages = []
+            outline = []
+            for index, page_numbers in selection:
+                first_page, page_count, part_outline = self.parts[index]
+                new_numbers = {}
+                for page_number in range(page_count) if page_numbers is None else page_numbers:
+                    new_numbers.setdefault(page_number, len(pages))
+                    pages.append(first_page + page_number)
+                last_level = 0  # Each input starts at the top, never under the previous input's entries
+                for level, title, page in part_outline:
+                    if page - 1 in new_numbers:
+                        # Entries under dropped ones move up, levels may only grow one at a time
+                        level = last_level = min(level, last_level + 1)
+                        outline.append([level, title, new_numbers[page - 1] + 1])
+            self.document.select(pages)
+            self.document.set_toc(outline)
+
+    def tobytes(self):
+        with self.lock:
+            return self.document.tobytes(garbage=1, deflate=True)
+
+    def save(self, output_path):
+        with self.lock:
+            self.document.save(output_path, garbage=1, deflate=True)
+        return output_path
+
+    def close(self):
+        with self.lock:
+            self.document.close()
+
+
+# image2pdf page presets as (page size, margin) in points; no size means every page fits its image
+PAGE_PRESETS = {
+    'fit': (None, 0),
+    'a4': (fitz.paper_size('a4'), 20),
+    'letter': (fitz.paper_size('letter'), 20),
+}
+
+
+# Builds a PDF one image at a time as images arrive, in their original order.
+# Pages are added with insert_image from already encoded data, so JPEGs are
+# embedded as they are and no decoded bitmap is kept around.
+class PdfBuilder:
+    def __init__(self, page_size='fit', image_quality='original'):
+        self.page_size, self.margin = PAGE_PRESETS[page_size]
+        self.image_quality = image_quality  # Preset the images are prepared with before add()
+        self.document = fitz.open()
+        self.lock = threading.Lock()
+        self.next_index = 0
+        self.ready = {}  # index -> (data, width, height), or None for images that failed
+        self.failed = []  # Positions of the images that were skipped, in order
+        self.closed = False
+
+    # Add the image for position `index`; pages are appended as soon as every
+    # earlier position has arrived. An image that can't be inserted is skipped
+    # like a failed one, so it never holds up the pages after it. Images that
+    # arrive after close() are dropped.
+    def add(self, index, image=None):
+        with self.lock:
+            if self.closed:
+                return
+            self.ready[index] = image
+            while self.next_index in self.ready:
+                image = self.ready.pop(self.next_index)
+                try:
+                    if image is None:
+                        self.failed.append(self.next_index)
+                    else:
+                        self.append_page(*image)
+                except Exception:
+                    self.failed.append(self.next_index)
+                finally:
+                    self.next_index += 1
+
+    def skip(self, index):
+        self.add(index, None)
+
+    def append_page(self, data, width, height):
+        if self.page_size is None:
+            page = self.document.new_page(width=width, height=height)
+        else:
+            page_width, page_height = self.page_size
+            if (width > height) != (page_width > page_height):
+                page_width, page_height = page_height, page_width  # Landscape images get landscape pages
+            page = self.document.new_page(width=page_width, height=page_height)
+        rect = page.rect + (self.margin, self.margin, -self.margin, -self.margin)
+        try:
+            page.insert_image(rect, stream=data, keep_proportion=True)
+        except Exception:
+            self.document.delete_page(-1)  # Don't leave a blank page behind
+            raise
+
+    @property
+    def page_count(self):
+        return len(self.document)
+
+    def tobytes(self):
+        with self.lock:
+            return self.document.tobytes(garbage=1, deflate=True)
+
+    # Waits for an add() in progress, downloads may still be running when a flow ends
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.document.close()
+
+
+# /compresspdf presets: (target DPI of embedded images, JPEG quality)
+COMPRESS_PRESETS = {
+    'small': (96, 50),
+    'medium': (150, 65),
+    'high': (220, 80),
+}
+
+
+# Embedded images worth recompressing as (xref, scale) pairs, `scale` being
+# what brings the image down to `target_dpi` at the largest size it is shown
+# on any page (1.0 when it is already below). Images with transparency,
+# stencil masks and 1-bit images are left alone.
+def find_images(pdf_path, target_dpi):
+    display_dpi = {}
+    with fitz.open(pdf_path) as pdf_document:
+        for page in pdf_document:
+            for info in page.get_image_info(xrefs=True):
+                xref = info['xref']
+                bbox = fitz.Rect(info['bbox'])
+                if xref <= 0 or bbox.is_empty:
+                    continue
+                dpi = max(info['width'] * 72 / bbox.width, info['height'] * 72 / bbox.height)
+                display_dpi[xref] = min(dpi, display_dpi.get(xref, dpi))
+
+        images = []
+        for xref, dpi in display_dpi.items():
+            if (pdf_document.xref_get_key(xref, 'SMask')[0] != 'null'
+                    or pdf_document.xref_get_key(xref, 'ImageMask')[1] == 'true'
+                    or pdf_document.xref_get_key(xref, 'BitsPerComponent')[1] == '1'):
+                continue
+            images.append((xref, min(1.0, target_dpi / dpi)))
+    return images
+
+
+# Downsample and re-encode a batch of images as JPEG (runs in the scheduler's
+# process pool). Returns (xref, data, width, height, mode) for the images that
+# got at least 10% smaller.
+def recompress_images(pdf_path, images, quality):
+    results = []
+    with fitz.open(pdf_path) as pdf_document:
+        for xref, scale in images:
+            try:
+                pix = fitz.Pixmap(pdf_document, xref)
+            except (RuntimeError, ValueError):
+                continue
+            if pix.alpha:
+                continue
+            if pix.n not in (1, 3):
+                pix = fitz.Pixmap(fitz.csRGB, pix)  # CMYK and others
+            mode = 'L' if pix.n == 1 else 'RGB'
+            image = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+            del pix
+            if scale < 1:
+                size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+                image = image.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=quality, optimize=True)
+            data = buffer.getvalue()
+            if len(data) < 0.9 * len(pdf_document.xref_stream_raw(xref)):
+                results.append((xref, data, image.width, image.height, mode))
+    return results
+
+
+# Swap in the recompressed images, subset the fonts and save with duplicate
+# objects merged, unused ones dropped and streams and object streams deflated
+def write_compressed_pdf(pdf_path, images, output_path):
+    with fitz.open(pdf_path) as pdf_document:
+        for xref, data, width, height, mode in images:
+            pdf_document.update_stream(xref, data, compress=0)
+            pdf_document.xref_set_key(xref, 'Filter', '/DCTDecode')
+            pdf_document.xref_set_key(xref, 'Width', str(width))
+            pdf_document.xref_set_key(xref, 'Height', str(height))
+            pdf_document.xref_set_key(xref, 'ColorSpace', '/DeviceGray' if mode == 'L' else '/DeviceRGB')
+            pdf_document.xref_set_key(xref, 'BitsPerComponent', '8')
+            pdf_document.xref_set_key(xref, 'DecodeParms', 'null')
+            pdf_document.xref_set_key(xref, 'Decode', 'null')
+        try:
+            pdf_document.subset_fonts()
+        except Exception:
+            pass  # Fonts MuPDF can't subset are kept whole
+        pdf_document.save(output_path, garbage=4, deflate=True, deflate_fonts=True, use_objstms=1)
+    return os.path.getsize(output_path)
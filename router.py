@@ -0,0 +1,116 @@
+import time
+from functools import wraps
+
+import metrics
+
+
+# Trigger of a document message: what kind of file it is
+def document_kind(document):
+    mime_type = document.mime_type or ''
+    if mime_type == 'application/pdf':
+        return 'pdf'
+    if mime_type.startswith('image/'):
+        return 'image'
+    return None
+
+
+# Dispatches messages with a few dict lookups instead of trying every handler
+# filter in turn. Routes are keyed on (chat state, content type, trigger):
+#  - the state comes from state_of(chat_id), e.g. 'mergepdf' while a merge is
+#    being collected, or None for routes that apply in any state;
+#  - the trigger is '/command' or a registered keyword like 'done' for text,
+#    the document_kind() for documents, or None to match any message.
+# A specific trigger wins over a state's catch-all, so commands always work
+# in the middle of a flow, and a route for the current state wins over one
+# for any state.
+#
+# Messages whose route depends on the state are resolved inside a job, behind
+# the chat's earlier jobs, so a photo sent right after /image2pdf sees the
+# state that command's job sets rather than the one at arrival.
+class Router:
+    def __init__(self, state_of, job=None):
+        self.state_of = state_of
+        self.job = job  # Decorator that moves a handler onto the job scheduler
+        self.routes = {}
+        self.keywords = set()
+        self.stateful = set()  # Content types with routes that depend on the chat state
+        self.run_queued = job(self.run) if job else self.run
+        self.timings = {}  # Route name -> Histogram of handler run times
+        self.unrouted = 0
+
+    # Decorator registering a handler; with job=True it runs on the scheduler
+    def route(self, content_types=('text',), trigger=None, state=None, job=False):
+        if isinstance(content_types, str):
+            content_types = (content_types,)
+
+        def decorator(handler):
+            timing = self.timings.setdefault(handler.__name__, metrics.Histogram())
+
+            @wraps(handler)
+            def timed(*args, **kwargs):
+                started_at = time.monotonic()
+                try:
+                    with metrics.operation(handler.__name__):
+                        return handler(*args, **kwargs)
+                finally:
+                    timing.observe(time.monotonic() - started_at)
+
+            target = self.job(timed) if job else timed
+            for content_type in content_types:
+                key = (state, content_type, trigger)
+                if key in self.routes:
+                    raise ValueError(f"Route {key} is already registered")
+                self.routes[key] = (target, timed)
+                if state is not None:
+                    self.stateful.add(content_type)
+            if trigger is not None and not trigger.startswith('/') and 'text' in content_types:
+                self.keywords.add(trigger)
+            return handler
+        return decorator
+
+    def trigger_of(self, message):
+        if message.content_type == 'text':
+            text = message.text
+            if text.startswith('/'):
+                return '/' + text.split()[0][1:].split('@')[0]
+            text = text.lower()
+            return text if text in self.keywords else None
+        if message.content_type == 'document':
+            return document_kind(message.document)
+        return None
+
+    def resolve(self, message):
+        content_type = message.content_type
+        trigger = self.trigger_of(message)
+        state = self.state_of(message.chat.id) if content_type in self.stateful else None
+        routes = self.routes
+        return (routes.get((state, content_type, trigger))
+                or routes.get((None, content_type, trigger))
+                or routes.get((state, content_type, None))
+                or routes.get((None, content_type, None)))
+
+    def dispatch(self, message):
+        if message.content_type in self.stateful:
+            self.run_queued(message)
+            return
+        route = self.resolve(message)
+        if route is None:
+            self.unrouted += 1
+            return
+        target, _ = route
+        target(message)
+
+    # Resolve and run the handler in place, for messages already on a job
+    def run(self, message):
+        route = self.resolve(message)
+        if route is None:
+            self.unrouted += 1
+            return
+        _, handler = route
+        handler(message)
+
+    def stats(self):
+        return {
+            'routes': {name: timing.stats() for name, timing in self.timings.items()},
+            'unrouted': self.unrouted,
+        }
@@ -0,0 +1,233 @@
+import logging
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, chat_id, func, args, kwargs):
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted_at = time.monotonic()
+
+
+# Runs handler work on a bounded pool of worker threads.
+# Every chat has its own FIFO queue so jobs of one chat keep their order, and
+# workers pick chats round-robin so one huge job can't starve the others.
+class JobScheduler:
+    def __init__(self, max_workers=4, cpu_workers=1, max_per_chat=1, max_queued_per_chat=50, on_reject=None,
+                 cpu_preload=(), max_blocked=None):
+        self.max_workers = max_workers
+        self.max_blocked = max_workers if max_blocked is None else max_blocked  # Extra workers at most
+        self.cpu_workers = cpu_workers
+        self.cpu_preload = list(cpu_preload)  # Modules the worker processes start with
+        self.max_per_chat = max_per_chat
+        self.max_queued_per_chat = max_queued_per_chat
+        self.on_reject = on_reject
+
+        self.condition = threading.Condition()
+        self.queues = OrderedDict()  # chat_id -> deque of pending jobs
+        self.running = {}  # chat_id -> number of running jobs
+        self.workers = []
+        self.blocked = 0  # Jobs waiting in blocking(), each lends its slot to an extra worker
+        self.workers_started = 0
+        self.cpu_pool = None
+        self.cpu_pool_lock = threading.Lock()
+
+        # Metrics
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_queue_depth = 0
+        self.wait_times = deque(maxlen=1000)
+        self.run_times = deque(maxlen=1000)
+
+    def start(self):
+        with self.condition:
+            self.add_workers()
+
+    # Called with the condition held
+    def add_workers(self):
+        while len(self.workers) < self.max_workers + self.blocked:
+            worker = threading.Thread(target=self.worker_loop, name=f"job-worker-{self.workers_started}", daemon=True)
+            self.workers_started += 1
+            self.workers.append(worker)
+            worker.start()
+
+    # For jobs that wait on something other than work, like send pacing: while
+    # the job sleeps, an extra worker runs other chats' jobs in its place. The
+    # job still counts as running for its own chat, so that chat stays in order.
+    # Past max_blocked waiting jobs, further ones keep their slot while they wait,
+    # so no more than max_workers + max_blocked jobs ever run at once.
+    @contextmanager
+    def blocking(self):
+        with self.condition:
+            lent = self.blocked < self.max_blocked and threading.current_thread() in self.workers
+            if lent:
+                self.blocked += 1
+                self.add_workers()
+        try:
+            yield
+        finally:
+            if lent:
+                with self.condition:
+                    self.blocked -= 1
+                    self.condition.notify_all()  # Lets an idle extra worker retire
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        with self.condition:
+            queue = self.queues.get(chat_id)
+            if queue is None:
+                queue = self.queues[chat_id] = deque()
+            if len(queue) >= self.max_queued_per_chat:
+                self.rejected += 1
+                raise QueueFull(f"Too many pending jobs for chat {chat_id}")
+            queue.append(Job(chat_id, func, args, kwargs))
+            self.submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth())
+            self.condition.notify()
+        if not self.workers:
+            self.start()
+
+    # Decorator for bot handlers: the handler enqueues its work and returns right away
+    def job(self, func):
+        @wraps(func)
+        def wrapper(update, *args, **kwargs):
+            message = getattr(update, 'message', None) or update  # CallbackQuery or Message
+            chat_id = message.chat.id
+            try:
+                self.submit(chat_id, func, update, *args, **kwargs)
+            except QueueFull:
+                if self.on_reject:
+                    self.on_reject(chat_id)
+        return wrapper
+
+    # Run a CPU-heavy, picklable function in the process pool and wait for its result
+    def run_cpu(self, func, *args, **kwargs):
+        return self.submit_cpu(func, *args, **kwargs).result()
+
+    # Traced as the 'processing' stage, including the time spent waiting for a free process
+    def submit_cpu(self, func, *args, **kwargs):
+        started_at = time.monotonic()
+        operation = metrics.current_operation()
+        future = self.get_cpu_pool().submit(func, *args, **kwargs)
+        future.add_done_callback(lambda future: metrics.tracer.observe(
+            'processing', time.monotonic() - started_at, operation=operation,
+            failed=future.cancelled() or future.exception() is not None
+        ))
+        return future
+
+    # Workers are forked from a single-threaded fork server rather than from
+    # this process, whose job, download and sender threads may hold locks
+    # mid-fork. The server imports the main module and cpu_preload once, so
+    # new workers still start with them loaded.
+    def get_cpu_pool(self):
+        with self.cpu_pool_lock:
+            if self.cpu_pool is None:
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['__main__'] + self.cpu_preload)
+                self.cpu_pool = ProcessPoolExecutor(max_workers=self.cpu_workers, mp_context=context)
+            return self.cpu_pool
+
+    def next_job(self):
+        # Called with the condition held: pick the first chat in round-robin
+        # order that has pending work and hasn't reached its running limit
+        for chat_id, queue in self.queues.items():
+            if queue and self.running.get(chat_id, 0) < self.max_per_chat:
+                job = queue.popleft()
+                self.running[chat_id] = self.running.get(chat_id, 0) + 1
+                if queue:
+                    self.queues.move_to_end(chat_id)
+                else:
+                    del self.queues[chat_id]
+                return job
+        return None
+
+    def worker_loop(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                while job is None:
+                    if self.retire():
+                        return
+                    self.condition.wait()
+                    job = self.next_job()
+
+            started_at = time.monotonic()
+            try:
+                job.func(*job.args, **job.kwargs)
+                succeeded = True
+            except Exception:
+                logger.exception("Job %s failed for chat %s", getattr(job.func, '__name__', job.func), job.chat_id)
+                succeeded = False
+
+            with self.condition:
+                self.wait_times.append(started_at - job.submitted_at)
+                self.run_times.append(time.monotonic() - started_at)
+                if succeeded:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self.running[job.chat_id] -= 1
+                if self.running[job.chat_id] == 0:
+                    del self.running[job.chat_id]
+                self.condition.notify_all()
+                if self.retire():
+                    return
+
+    # Called with the condition held: an extra worker whose blocked job woke up leaves
+    def retire(self):
+        if len(self.workers) <= self.max_workers + self.blocked:
+            return False
+        self.workers.remove(threading.current_thread())
+        return True
+
+    # Whether the chat has jobs queued or running
+    def has_jobs(self, chat_id):
+        with self.condition:
+            return bool(self.queues.get(chat_id)) or chat_id in self.running
+
+    def queue_depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def stats(self):
+        with self.condition:
+            return {
+                'workers': len(self.workers),
+                'running': sum(self.running.values()),
+                'blocked': self.blocked,
+                'queue_depth': self.queue_depth(),
+                'max_queue_depth': self.max_queue_depth,
+                'queued_chats': len(self.queues),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'wait_p50': percentile(self.wait_times, 50),
+                'wait_p99': percentile(self.wait_times, 99),
+                'run_p50': percentile(self.run_times, 50),
+                'run_p99': percentile(self.run_times, 99),
+            }
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
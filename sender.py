@@ -0,0 +1,302 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from io import BytesIO
+
+import requests
+import telebot
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+# Bot API methods that post into a chat and count against Telegram's flood limits
+RATE_LIMITED_PREFIXES = ('send', 'edit', 'copy', 'forward')
+
+ALBUM_SIZE = 10  # Telegram's maximum album size
+OUTBOX_RESUMES = 3  # Times an Outbox resumes after the Sender gave up on flood limits
+
+
+# Token bucket refilled at `rate` tokens per second up to `capacity`. Callers
+# reserve a token and sleep for the returned delay, so waiting callers are
+# served in the order they arrived.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Take one token, returning the seconds to wait before using it
+    def reserve(self):
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    # No tokens for the next `seconds`, e.g. after a 429 with retry_after
+    def pause(self, seconds):
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def is_full(self):
+        with self.lock:
+            self.refill()
+            return self.tokens >= self.capacity
+
+
+# Sends Bot API requests that post into a chat at a pace Telegram accepts:
+# one token bucket per chat and one shared by all chats, so a chat sending
+# hundreds of files is slowed down on its own instead of starving the others.
+# 429 responses pause the chat for `retry_after` seconds and the request is
+# sent again, as are requests that failed to connect. Read timeouts and 5xx
+# responses go back to the caller, the message may have been delivered.
+#
+# Sleeps happen inside `blocking()`, so a job scheduler can run other chats'
+# jobs on the side while a paced job waits.
+class Sender:
+    def __init__(self, session, global_rate=30, chat_rate=1.0, chat_burst=5, retries=5, backoff=1.0,
+                 blocking=nullcontext):
+        self.session = session
+        self.blocking = blocking
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.throttled = 0  # 429 responses
+        self.retried = 0  # Requests sent again after a 429 or a connection error
+
+    def chat_bucket(self, chat_id):
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self.chat_buckets) >= 10000:
+                    # Full buckets carry no state worth keeping
+                    for idle_chat_id in [key for key, value in self.chat_buckets.items() if value.is_full()]:
+                        del self.chat_buckets[idle_chat_id]
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            return bucket
+
+    # Wait for the chat's token first, so a throttled chat holds no global token while it waits
+    def wait(self, chat_id):
+        delay = self.chat_bucket(chat_id).reserve()
+        if delay:
+            self.sleep(delay)
+        delay = self.global_bucket.reserve()
+        if delay:
+            self.sleep(delay)
+
+    def sleep(self, seconds):
+        with self.blocking():
+            time.sleep(seconds)
+
+    def request(self, chat_id, method, url, **kwargs):
+        positions = file_positions(kwargs.get('files'))
+        for attempt in range(self.retries + 1):
+            self.wait(chat_id)
+            rewind(positions)
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.ConnectionError as e:
+                if attempt == self.retries or not connect_failed(e):
+                    raise
+                self.retried += 1
+                self.sleep(self.backoff * 2 ** attempt)
+                continue
+            if response.status_code != 429 or attempt == self.retries:
+                return response
+            self.throttled += 1
+            self.retried += 1
+            self.chat_bucket(chat_id).pause(retry_after(response, self.backoff * 2 ** attempt))
+        return response
+
+    def stats(self):
+        return {'throttled': self.throttled, 'retried': self.retried, 'chats': len(self.chat_buckets)}
+
+
+# Whether a request failed before anything was sent. requests also reports
+# read timeouts as ConnectionError once urllib3 has given up on them.
+def connect_failed(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, 'reason', reason)  # MaxRetryError wraps the cause
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+# Seconds Telegram asked us to wait in a 429 response
+def retry_after(response, default):
+    try:
+        return float(response.json()['parameters']['retry_after'])
+    except (ValueError, KeyError, TypeError):
+        return default
+
+
+# Positions of the file objects in a multipart upload, to rewind them before a retry
+def file_positions(files):
+    positions = []
+    for value in (files or {}).values():
+        if isinstance(value, tuple):
+            value = value[1]
+        if hasattr(value, 'seek'):
+            positions.append((value, value.tell()))
+    return positions
+
+
+def rewind(positions):
+    for file, position in positions:
+        file.seek(position)
+
+
+# A local Bot API server reads files sent as file:// URIs itself, which works
+# for files up to 2 GB and copies nothing through this process
+def local_upload(path):
+    return 'file://' + os.path.abspath(path)
+
+
+# Cache entry for an output we just sent
+def output_of(sent_message):
+    if sent_message.content_type == 'photo':
+        return {'file_id': sent_message.photo[-1].file_id, 'kind': 'photo'}
+    return {'file_id': sent_message.document.file_id, 'kind': 'document'}
+
+
+# Outputs for one chat, sent in order. Consecutive documents or photos are
+# grouped into albums of up to 10 (unless album=False), and text items such as
+# directory headers are sent between them.
+#
+# Items leave the queue only once Telegram accepted them, so a send that keeps
+# hitting flood limits resumes with the first unsent item, never sending a
+# delivered item twice. When Telegram rejects an album, its items are sent
+# again one at a time; an item it rejects on its own is skipped and named in a
+# message at the end of the last flush(), so one bad file doesn't cost the
+# rest. Network errors leave the unsent items queued for the caller.
+class Outbox:
+    local_uploads = False  # Upload files by path, for a local Bot API server
+
+    def __init__(self, bot, chat_id, album=True):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.album = album
+        self.pending = deque()
+        self.outputs = []  # Cache entries of what was sent, in order
+        self.skipped = []  # Names of the items Telegram rejected
+        self.singles = 0  # Items left to send one at a time after a rejected album
+        self.resumes = 0  # Flood-limited sends in a row
+
+    # A file on disk; removed after it is sent when remove=True.
+    # `extra` is copied into the cache entry, e.g. dir='docs'.
+    def add_file(self, path, kind='document', remove=False, **extra):
+        self.add({'path': path, 'kind': kind, 'remove': remove, 'extra': extra})
+
+    def add_data(self, data, name, kind='document', **extra):
+        self.add({'data': data, 'name': name, 'kind': kind, 'extra': extra})
+
+    # An earlier output, re-sent by file_id
+    def add_output(self, output):
+        extra = {key: value for key, value in output.items() if key not in ('file_id', 'kind')}
+        self.add({'file_id': output['file_id'], 'kind': output['kind'], 'extra': extra})
+
+    def add_text(self, text):
+        self.add({'text': text})
+
+    # Queue an item and send everything that can't grow into a bigger album
+    def add(self, item):
+        self.pending.append(item)
+        self.flush(full_only=True)
+
+    # Send what is queued; with full_only, a trailing album that could still grow is kept
+    def flush(self, full_only=False):
+        while self.pending:
+            group = self.next_group()
+            if full_only and len(group) == len(self.pending) and 'text' not in group[0] and (
+                    self.album and len(group) < ALBUM_SIZE):
+                return self.outputs
+            try:
+                sent_messages = self.send_group(group)
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    # The Sender paused the chat, so the next try waits for it
+                    self.resumes += 1
+                    if self.resumes > OUTBOX_RESUMES:
+                        raise
+                    continue
+                if len(group) > 1:
+                    self.singles = len(group)
+                    continue
+                self.skipped.append(item_name(group[0]))
+                sent_messages = []
+            self.resumes = 0
+            for item, sent in zip(group, sent_messages):
+                output = output_of(sent)
+                output.update(item['extra'])
+                self.outputs.append(output)
+            for item in group:
+                self.pending.popleft()
+                self.singles = max(0, self.singles - 1)
+                if item.get('remove'):
+                    os.remove(item['path'])
+        if not full_only and self.skipped:
+            skipped, self.skipped = self.skipped, []
+            self.bot.send_message(self.chat_id, "Telegram refused these, so they were skipped: " + ', '.join(skipped))
+        return self.outputs
+
+    def next_group(self):
+        first = self.pending[0]
+        if 'text' in first or not self.album or self.singles:
+            return [first]
+        group = []
+        for item in self.pending:
+            if 'text' in item or item['kind'] != first['kind'] or len(group) == ALBUM_SIZE:
+                break
+            group.append(item)
+        return group
+
+    def send_group(self, group):
+        if 'text' in group[0]:
+            self.bot.send_message(self.chat_id, group[0]['text'])
+            return []
+        files = []
+        try:
+            media = [self.open(item, files) for item in group]
+            if len(group) > 1:
+                media_type = telebot.types.InputMediaPhoto if group[0]['kind'] == 'photo' else telebot.types.InputMediaDocument
+                return self.bot.send_media_group(self.chat_id, [media_type(source) for source in media])
+            if group[0]['kind'] == 'photo':
+                return [self.bot.send_photo(self.chat_id, media[0])]
+            return [self.bot.send_document(self.chat_id, media[0])]
+        finally:
+            for file in files:
+                file.close()
+
+    @staticmethod
+    def open(item, files):
+        if 'file_id' in item:
+            return item['file_id']
+        if 'path' in item:
+            if Outbox.local_uploads:
+                return local_upload(item['path'])
+            file = open(item['path'], 'rb')
+        else:
+            file = BytesIO(item['data'])
+            file.name = item['name']
+        files.append(file)
+        return file
+
+
+# How an item is named when telling the user it was skipped
+def item_name(item):
+    if 'text' in item:
+        return 'a message'
+    if 'path' in item:
+        return os.path.basename(item['path'])
+    return item.get('name') or item['extra'].get('name') or 'an earlier file'
@@ -0,0 +1,198 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# Keeps records in this process, least recently used first
+class MemoryBackend:
+    def __init__(self):
+        self.records = OrderedDict()  # (chat_id, kind) -> (data json, updated)
+
+    def get(self, key):
+        record = self.records.get(key)
+        if record is not None:
+            self.records.move_to_end(key)
+        return record
+
+    def put(self, key, data, updated):
+        self.records[key] = (data, updated)
+        self.records.move_to_end(key)
+
+    def delete(self, key):
+        self.records.pop(key, None)
+
+    def expired(self, before):
+        return [key for key, (_, updated) in self.records.items() if updated < before]
+
+    def total_size(self):
+        return sum(len(data) for data, _ in self.records.values())
+
+    # Least recently used first
+    def keys(self):
+        return list(self.records)
+
+    def count(self):
+        return len(self.records)
+
+
+# Keeps records in SQLite so they survive restarts and can be shared by
+# several bot processes using the same database file
+class SqliteBackend:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "chat_id INTEGER, kind TEXT, data TEXT, updated REAL, PRIMARY KEY (chat_id, kind))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+
+    def get(self, key):
+        row = self.connection.execute(
+            "SELECT data, updated FROM sessions WHERE chat_id = ? AND kind = ?", key
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def put(self, key, data, updated):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO sessions (chat_id, kind, data, updated) VALUES (?, ?, ?, ?)",
+            (*key, data, updated)
+        )
+
+    def delete(self, key):
+        self.connection.execute("DELETE FROM sessions WHERE chat_id = ? AND kind = ?", key)
+
+    def expired(self, before):
+        rows = self.connection.execute("SELECT chat_id, kind FROM sessions WHERE updated < ?", (before,))
+        return [tuple(row) for row in rows]
+
+    def total_size(self):
+        return self.connection.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) FROM sessions").fetchone()[0]
+
+    # Least recently used first
+    def keys(self):
+        return [tuple(row) for row in self.connection.execute("SELECT chat_id, kind FROM sessions ORDER BY updated")]
+
+    def count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+# Per-chat session records, one per (chat_id, kind), e.g. (42, 'splitpdf').
+#
+# Records are JSON-serializable dicts that reference inputs by Telegram
+# file_id, never by decoded content. They expire after `ttl` seconds without
+# an update, and the least recently used ones are evicted while the total
+# size is over `max_bytes`. Sessions that are `busy` (with downloads or jobs
+# still in flight) are never dropped; they expire or are evicted once idle.
+# One session may hold `max_session_bytes`, handlers check over_limit()
+# before adding input to it.
+#
+# Objects that can't be stored (workspaces, PDF builders, futures) go in
+# runtime(), a process-local dict that is released together with the record
+# through `on_release`. Code using it must cope with it being empty, e.g.
+# after a restart or when another process handled the earlier messages.
+class SessionStore:
+    def __init__(self, backend=None, ttl=3600, max_bytes=16 * 1024 * 1024, max_session_bytes=None, on_release=None,
+                 runtime_size=None, busy=None):
+        self.backend = backend or MemoryBackend()
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_session_bytes = max_session_bytes or max_bytes
+        self.on_release = on_release
+        self.runtime_size = runtime_size
+        self.busy = busy  # busy(chat_id, runtime) -> True while work for the session is in flight
+        self.lock = threading.RLock()
+        self.runtimes = {}
+        self.evicted = 0
+        self.expired = 0
+
+    def get(self, chat_id, kind):
+        key = (chat_id, kind)
+        with self.lock:
+            record = self.backend.get(key)
+            if record is None:
+                self.release(key)
+                return None
+            data, updated = record
+            if time.time() - updated > self.ttl and not self.is_busy(key):
+                self.expired += 1
+                self.drop(key)
+                return None
+            return json.loads(data)
+
+    def put(self, chat_id, kind, session):
+        key = (chat_id, kind)
+        with self.lock:
+            self.backend.put(key, json.dumps(session), time.time())
+            self.sweep()
+            self.enforce_limit(keep=key)
+
+    def end(self, chat_id, kind):
+        with self.lock:
+            self.drop((chat_id, kind))
+
+    def runtime(self, chat_id, kind):
+        with self.lock:
+            return self.runtimes.setdefault((chat_id, kind), {})
+
+    def sweep(self):
+        with self.lock:
+            for key in self.backend.expired(time.time() - self.ttl):
+                if not self.is_busy(key):
+                    self.expired += 1
+                    self.drop(key)
+
+    # Evict idle sessions, least recently used first, until the total fits.
+    # A session is charged at most max_session_bytes, so one session going
+    # over its own limit never pushes the others out.
+    def enforce_limit(self, keep=None):
+        if self.memory_used(self.max_session_bytes) <= self.max_bytes:
+            return
+        for key in self.backend.keys():
+            if key == keep or self.is_busy(key):
+                continue
+            self.evicted += 1
+            self.drop(key)
+            if self.memory_used(self.max_session_bytes) <= self.max_bytes:
+                return
+
+    def is_busy(self, key):
+        runtime = self.runtimes.get(key)
+        return bool(self.busy and runtime and self.busy(key[0], runtime))
+
+    # Whether the session holds as much as one session may
+    def over_limit(self, chat_id, kind):
+        key = (chat_id, kind)
+        with self.lock:
+            record = self.backend.get(key)
+            used = len(record[0]) if record else 0
+            runtime = self.runtimes.get(key)
+            if runtime and self.runtime_size:
+                used += self.runtime_size(runtime)
+            return used >= self.max_session_bytes
+
+    def memory_used(self, per_session=None):
+        used = self.backend.total_size()
+        if self.runtime_size:
+            used += sum(min(self.runtime_size(runtime), per_session or float('inf')) for runtime in self.runtimes.values())
+        return used
+
+    def drop(self, key):
+        self.backend.delete(key)
+        self.release(key)
+
+    def release(self, key):
+        runtime = self.runtimes.pop(key, None)
+        if runtime and self.on_release:
+            self.on_release(runtime)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'sessions': self.backend.count(),
+                'bytes': self.memory_used(),
+                'expired': self.expired,
+                'evicted': self.evicted,
+            }
@@ -1,15 +1,106 @@
-from flask import Flask
+import hmac
+import queue
+from flask import Flask, Response, abort, request
 from threading import Thread
 
 app = Flask(__name__)
 
+# Set by start_webhook_dispatcher() when the bot runs in webhook mode
+webhook = None
+
+# Set by expose_metrics(): returns the Prometheus text served on /metrics
+metrics_source = None
+metrics_token = ''
+
+
+# The chat an update belongs to (or the user, for updates without a chat)
+def update_chat_id(update):
+    for key, value in update.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        for source in (value.get('chat'), value.get('message', {}).get('chat'), value.get('from'), value.get('user')):
+            if isinstance(source, dict) and 'id' in source:
+                return source['id']
+    return 0
+
+
+# Receives updates from Telegram and hands them to a few dispatcher threads
+# through bounded queues. Each chat always goes to the same queue, so its
+# updates are handled in the order Telegram sent them. When a queue is full
+# the request is refused with 503, so Telegram backs off and redelivers the
+# update later instead of us buffering without limit.
+class WebhookDispatcher:
+    def __init__(self, handle_update, secret_token, queue_size, workers):
+        self.handle_update = handle_update
+        self.secret_token = secret_token
+        self.shards = [queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self.accepted = 0
+        self.refused = 0
+        for index, updates in enumerate(self.shards):
+            Thread(target=self.run, args=(updates,), name=f"webhook-dispatcher-{index}", daemon=True).start()
+
+    def run(self, updates):
+        while True:
+            update = updates.get()
+            try:
+                self.handle_update(update)
+            except Exception:
+                app.logger.exception("Failed to handle update")
+
+    def offer(self, update):
+        updates = self.shards[update_chat_id(update) % len(self.shards)]
+        try:
+            updates.put_nowait(update)
+        except queue.Full:
+            self.refused += 1
+            return False
+        self.accepted += 1
+        return True
+
+
 @app.route('/')
 def home():
     return "I'm alive"
 
-def run():
-    app.run(host='0.0.0.0', port=3021)
+@app.route('/webhook', methods=['POST'])
+def receive_update():
+    if webhook is None:
+        abort(404)
+    if webhook.secret_token:
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        # Bytes, since compare_digest raises on non-ASCII strings
+        if not hmac.compare_digest(token.encode(), webhook.secret_token.encode()):
+            abort(403)
+    update = request.get_json(force=True, silent=True)
+    if not isinstance(update, dict):
+        abort(400)
+    if not webhook.offer(update):
+        return "Busy", 503
+    return ""
+
+@app.route('/metrics')
+def serve_metrics():
+    if metrics_source is None:
+        abort(404)
+    if metrics_token:
+        authorization = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization, f"Bearer {metrics_token}"):
+            abort(403)
+    return Response(metrics_source(), mimetype='text/plain; version=0.0.4')
+
+def expose_metrics(source, token=''):
+    global metrics_source, metrics_token
+    metrics_source = source
+    metrics_token = token
+
+def start_webhook_dispatcher(handle_update, secret_token, queue_size=1000, workers=4):
+    global webhook
+    webhook = WebhookDispatcher(handle_update, secret_token, queue_size, workers)
+    return webhook
+
+def run(port=3021):
+    app.run(host='0.0.0.0', port=port, threaded=True)
 
-def keep_alive():
-    t = Thread(target=run)
+def keep_alive(port=3021):
+    t = Thread(target=run, args=(port,))
     t.start()
@@ -0,0 +1,107 @@
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+
+import config
+
+# Workspaces that are still open in this process, removed at exit
+active_workspaces = set()
+ram_reserved = 0
+lock = threading.Lock()
+
+
+# A unique scratch directory for one job.
+# It is placed on tmpfs when the job's estimated size fits in the RAM budget,
+# otherwise on disk, and it is always removed when the job ends:
+#
+#     with Workspace('split', size_hint=file_size * 2) as ws:
+#         pdf_path = ws.path('input.pdf')
+class Workspace:
+    def __init__(self, prefix='job', size_hint=None):
+        self.prefix = prefix
+        self.size_hint = size_hint
+        self.ram_bytes = 0
+        self.directory = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    def open(self):
+        root = config.SCRATCH_DIR
+        if self.size_hint and reserve_ram(self.size_hint):
+            self.ram_bytes = self.size_hint
+            root = config.RAM_SCRATCH_DIR
+        os.makedirs(root, exist_ok=True)
+        # The pid in the name lets sweep_stale_workspaces() find leftovers of crashed processes
+        self.directory = tempfile.mkdtemp(prefix=f"{self.prefix}-{os.getpid()}-", dir=root)
+        with lock:
+            active_workspaces.add(self)
+        return self
+
+    # Path of a file inside the workspace; parent directories are created
+    def path(self, *parts):
+        file_path = os.path.join(self.directory, *parts)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        return file_path
+
+    def cleanup(self):
+        global ram_reserved
+        with lock:
+            if self not in active_workspaces:
+                return
+            active_workspaces.discard(self)
+            ram_reserved -= self.ram_bytes
+            self.ram_bytes = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# Reserve RAM scratch space if both the budget and the tmpfs have room
+def reserve_ram(size):
+    global ram_reserved
+    ram_root = os.path.dirname(config.RAM_SCRATCH_DIR.rstrip('/')) or '/'
+    if not os.path.isdir(ram_root):
+        return False
+    with lock:
+        if ram_reserved + size > config.RAM_SCRATCH_BUDGET:
+            return False
+        if shutil.disk_usage(ram_root).free < size:
+            return False
+        ram_reserved += size
+        return True
+
+
+# Remove workspaces left behind by processes that no longer exist
+def sweep_stale_workspaces():
+    for root in (config.SCRATCH_DIR, config.RAM_SCRATCH_DIR):
+        if not os.path.isdir(root):
+            continue
+        for name in os.listdir(root):
+            parts = name.rsplit('-', 2)
+            if len(parts) < 3 or not parts[1].isdigit():
+                continue
+            pid = int(parts[1])
+            if pid != os.getpid() and not pid_alive(pid):
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@atexit.register
+def cleanup_all():
+    with lock:
+        workspaces = list(active_workspaces)
+    for workspace in workspaces:
+        workspace.cleanup()